@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the hot paths of taskbar against local stand-ins: the locmem cache, SQLite and a fake current_task.
+
+It runs N tasks side by side, each doing M percent updates and K report() errors, while P clients poll
+task_api for every task. For each run it reports the cache operations per update, the bytes moved per poll,
+the p50/p99 latencies and the DB queries per task.
+
+Example:
+    python benchmarks/bench_taskbar.py --tasks 20 --updates 500 --errors 50 --clients 2
+    python benchmarks/bench_taskbar.py --min-interval 1 --updates 5000
+    python benchmarks/bench_taskbar.py --etag --clients 4
+"""
+from __future__ import print_function, absolute_import, division
+
+import argparse
+import json
+import os
+import pickle
+import sys
+import tempfile
+import uuid
+from timeit import default_timer
+
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir, os.pardir)))
+
+import django
+from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache
+
+
+class CountingCache(LocMemCache):
+
+    """ The locmem cache with the append and the time= keyword of memcached, and counters of the operations
+        and the bytes moved
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CountingCache, self).__init__(*args, **kwargs)
+        self.depth = 0
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.ops = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def count(self, method, *args, **kwargs):
+        # set_many and the like call the other methods internally. Only the outer call is a round trip.
+        outer = self.depth == 0
+        if outer:
+            self.ops += 1
+        self.depth += 1
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self.depth -= 1
+
+    @staticmethod
+    def size(value):
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) if value is not None else 0
+
+    def get(self, key, default=None, version=None):
+        value = self.count(super(CountingCache, self).get, key, default, version)
+        if self.depth == 0:
+            self.bytes_read += self.size(value)
+        return value
+
+    def get_many(self, keys, version=None):
+        values = self.count(super(CountingCache, self).get_many, keys, version)
+        self.bytes_read += sum(self.size(value) for value in values.values())
+        return values
+
+    def set(self, key, value, *args, **kwargs):
+        if 'time' in kwargs:
+            kwargs['timeout'] = kwargs.pop('time')
+        if self.depth == 0:
+            self.bytes_written += self.size(value)
+        return self.count(super(CountingCache, self).set, key, value, *args, **kwargs)
+
+    def set_many(self, data, *args, **kwargs):
+        self.bytes_written += sum(self.size(value) for value in data.values())
+        return self.count(super(CountingCache, self).set_many, data, *args, **kwargs)
+
+    def add(self, key, value, *args, **kwargs):
+        self.bytes_written += self.size(value)
+        return self.count(super(CountingCache, self).add, key, value, *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self.count(super(CountingCache, self).delete, *args, **kwargs)
+
+    def delete_many(self, *args, **kwargs):
+        return self.count(super(CountingCache, self).delete_many, *args, **kwargs)
+
+    def incr(self, *args, **kwargs):
+        return self.count(super(CountingCache, self).incr, *args, **kwargs)
+
+    def append(self, key, value, version=None):
+        def append():
+            current = LocMemCache.get(self, key, version=version)
+            if current is None:
+                return False
+            LocMemCache.set(self, key, current + value, version=version)
+            return True
+        self.bytes_written += self.size(value)
+        return self.count(append)
+
+
+def setup_django(db_path):
+    settings.configure(
+        DEBUG=True,
+        SECRET_KEY="taskbar-benchmark",
+        INSTALLED_APPS=(
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'taskbar',
+        ),
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': db_path}},
+        CACHES={'default': {'BACKEND': 'bench_taskbar.CountingCache' if __name__ == '__main__'
+                            else '%s.CountingCache' % __name__}},
+        USE_TZ=True,
+    )
+    django.setup()
+
+    from django.core.management import call_command
+    if django.VERSION >= (1, 9):
+        call_command('migrate', run_syncdb=True, verbosity=0)
+    else:
+        # Django 1.8 creates the tables of the apps without migrations itself
+        call_command('migrate', verbosity=0)
+
+
+class FakeRequest(object):
+
+    def __init__(self):
+        self.id = str(uuid.uuid4())
+
+
+class FakeTask(object):
+
+    """ Stands in for celery's current_task """
+
+    name = "taskbar.benchmark"
+
+    def __init__(self):
+        self.request = FakeRequest()
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+class Phase(object):
+
+    """ Collects the latencies, cache operations, bytes and DB queries of one part of the benchmark """
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.ops = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.response_bytes = 0
+        self.queries = 0
+
+    def run(self, fn, *args, **kwargs):
+        from django.core.cache import caches
+        from django.db import connection
+
+        cache_backend = caches['default']
+        cache_backend.reset_counters()
+        queries_before = len(connection.queries)
+
+        start = default_timer()
+        result = fn(*args, **kwargs)
+        self.latencies.append(default_timer() - start)
+
+        self.queries += len(connection.queries) - queries_before
+        self.ops += cache_backend.ops
+        self.bytes_read += cache_backend.bytes_read
+        self.bytes_written += cache_backend.bytes_written
+        return result
+
+    def row(self, per):
+        count = len(self.latencies) or 1
+        return "%-10s %8d %10.2f %12.1f %12.1f %10.3f %10.3f %10.2f" % (
+            self.name, len(self.latencies), self.ops / count, (self.bytes_read + self.response_bytes) / count,
+            self.bytes_written / count, percentile(self.latencies, 50) * 1000,
+            percentile(self.latencies, 99) * 1000, self.queries / per)
+
+
+def run(options):
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test import RequestFactory
+    from taskbar.tasks import celery_progressbar_stat
+    from taskbar.views import register_task, task_api
+
+    # DEBUG is needed for connection.queries
+    connection.force_debug_cursor = True
+
+    user = User.objects.create_user("benchmark-%s" % uuid.uuid4().hex[:8], password="x")
+    factory = RequestFactory()
+
+    start, update, report, poll, exit_ = (Phase("start"), Phase("update"), Phase("report"), Phase("poll"),
+                                          Phase("exit"))
+
+    stats = []
+    for i in range(options.tasks):
+        task = FakeTask()
+        register_task(user, task.request.id, "")
+        stats.append(start.run(
+            celery_progressbar_stat, task, user.id, min_interval=options.min_interval,
+            min_percent_delta=options.min_percent_delta))
+
+    cursors = dict((c_stat.task_id, 0) for c_stat in stats)
+    etags = {}
+    error_every = options.updates // options.errors if options.errors else 0
+
+    for step in range(1, options.updates + 1):
+        for c_stat in stats:
+            update.run(setattr, c_stat, "percent", step * 100 // options.updates)
+            if error_every and step % error_every == 0:
+                report.run(c_stat.report, "Error: row %s is not valid" % step, e="err-%s" % step)
+
+        for client in range(options.clients):
+            for c_stat in stats:
+                headers = {}
+                if options.etag and c_stat.task_id in etags:
+                    headers['HTTP_IF_NONE_MATCH'] = etags[c_stat.task_id]
+                request = factory.post("/task_api", {'id': c_stat.task_id,
+                                                     'msg_index_client': cursors[c_stat.task_id]}, **headers)
+                request.user = user
+                response = poll.run(task_api, request)
+                poll.response_bytes += len(response.content)
+                if client == 0 and response.status_code == 200:
+                    cursors[c_stat.task_id] = json.loads(response.content.decode('utf-8'))['msg_index']
+                    etags[c_stat.task_id] = response['ETag']
+
+    for c_stat in stats:
+        exit_.run(c_stat.__exit__, None, None, None)
+
+    print("%d tasks, %d updates, %d errors, %d clients, min_interval=%s, min_percent_delta=%s, etag=%s" % (
+        options.tasks, options.updates, options.errors, options.clients, options.min_interval,
+        options.min_percent_delta, options.etag))
+    print("%-10s %8s %10s %12s %12s %10s %10s %10s" % (
+        "phase", "calls", "cache ops", "bytes read", "bytes written", "p50 ms", "p99 ms", "queries"))
+    for phase in (start, update, report, poll, exit_):
+        print(phase.row(options.tasks))
+    print("\nqueries are per task, the other columns are per call. bytes read of poll include the response.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', type=int, default=10, help="number of concurrent tasks (N)")
+    parser.add_argument('--updates', type=int, default=200, help="percent updates per task (M)")
+    parser.add_argument('--errors', type=int, default=20, help="report() errors per task (K)")
+    parser.add_argument('--clients', type=int, default=1, help="clients polling task_api per task (P)")
+    parser.add_argument('--min-interval', type=float, default=None)
+    parser.add_argument('--min-percent-delta', type=float, default=None)
+    parser.add_argument('--etag', action='store_true', help="clients poll with If-None-Match")
+    options = parser.parse_args(argv)
+
+    db_file = tempfile.NamedTemporaryFile(suffix=".sqlite3", delete=False)
+    db_file.close()
+    try:
+        setup_django(db_file.name)
+        run(options)
+    finally:
+        os.remove(db_file.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""
+Lets pytest run the tests too, with the settings of runtests.py
+"""
+from __future__ import print_function, absolute_import, division
+
+import runtests
+
+old_config = []
+
+
+def pytest_configure(config):
+    runtests.configure()
+    from django.test.utils import setup_test_environment, setup_databases
+    setup_test_environment()
+    old_config.append(setup_databases(verbosity=0, interactive=False))
+
+
+def pytest_unconfigure(config):
+    from django.test.utils import teardown_databases, teardown_test_environment
+    if old_config:
+        teardown_databases(old_config.pop(), verbosity=0)
+        teardown_test_environment()
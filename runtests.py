@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runs the tests of taskbar against the locmem cache and an in-memory SQLite database.
+
+Example:
+    python runtests.py
+    python runtests.py taskbar.tests.test_tasks
+
+The Redis and Celery result backend tests need fakeredis and celery and are skipped without them.
+"""
+from __future__ import print_function, absolute_import, division
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import django
+from django.conf import settings
+
+
+def configure():
+    settings.configure(
+        DEBUG=False,
+        SECRET_KEY="taskbar-tests",
+        INSTALLED_APPS=(
+            'django.contrib.admin',
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'django.contrib.messages',
+            'django.contrib.sessions',
+            'taskbar',
+            'taskbar.tests',
+        ),
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        CACHES={'default': {'BACKEND': 'taskbar.tests.utils.AppendLocMemCache'}},
+        ROOT_URLCONF='taskbar.urls',
+        # What the admin checks for
+        MIDDLEWARE=['django.contrib.sessions.middleware.SessionMiddleware',
+                    'django.contrib.auth.middleware.AuthenticationMiddleware',
+                    'django.contrib.messages.middleware.MessageMiddleware'],
+        TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates', 'APP_DIRS': True,
+                    'OPTIONS': {'context_processors': ['django.template.context_processors.request',
+                                                       'django.contrib.auth.context_processors.auth',
+                                                       'django.contrib.messages.context_processors.messages']}}],
+        PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+        USE_TZ=True,
+        # The models of taskbar do not set their auto field
+        DEFAULT_AUTO_FIELD='django.db.models.AutoField',
+        # The tests go through the errors that taskbar logs
+        LOGGING={'version': 1, 'disable_existing_loggers': False,
+                 'handlers': {'null': {'class': 'logging.NullHandler'}},
+                 'loggers': {'taskbar': {'handlers': ['null'], 'propagate': False}}},
+    )
+    django.setup()
+
+
+def main(labels):
+    configure()
+    from django.test.utils import get_runner
+    runner = get_runner(settings)(verbosity=1)
+    failures = runner.run_tests(labels or ['taskbar.tests'])
+    sys.exit(bool(failures))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
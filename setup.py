@@ -1,5 +1,5 @@
 import os
-from setuptools import setup
+from setuptools import find_packages, setup
 
 try:
     with open('README.md') as file:
@@ -19,7 +19,7 @@ setup(name='taskbar',
       author='Seperman',
       author_email='sep@zepworks.com',
       license='MIT',
-      packages=['taskbar'],
+      packages=find_packages(exclude=['benchmarks', 'taskbar.tests']),
       include_package_data=True,
       zip_safe=False,
       install_requires=[
@@ -1,4 +1,3 @@
-from .functions import *
-from .models import *
-from .tasks import *
-from .views import *
\ No newline at end of file
+# -*- coding: utf-8 -*-
+# The models, tasks and views are imported from their modules (taskbar.tasks.celery_progressbar_stat,
+# taskbar.views.progressbarit, ...). Importing them here would load the models before the app registry is ready.
@@ -1,12 +1,38 @@
 # -*- coding: utf-8 -*-
 from django.contrib import admin
-from taskbar.models import CeleryTasks
+from django.contrib.admin.views.main import ChangeList
+from collections import defaultdict
+from django.db.models import DurationField, ExpressionWrapper, F
+from django.utils.safestring import mark_safe
+from taskbar.analytics import percentiles
+from taskbar.backends import get_backend
+from taskbar.models import CeleryTasks, TaskStatsBin, TaskStatsBucket
+from taskbar.tasks import terminate_tasks
+from taskbar.utils import timedelta_to_hms
+
+
+def get_live_stats(task_ids):
+    """
+    returns a dictionary of task id to the stat of the task, read in one round trip
+    """
+    return get_backend().read_stats(task_ids)
+
+
+class CeleryTasksChangeList(ChangeList):
+
+    """ Fetches the live stats of all the tasks on the page at once """
+
+    def get_results(self, request):
+        super(CeleryTasksChangeList, self).get_results(request)
+        live_stats = get_live_stats([obj.task_id for obj in self.result_list])
+        for obj in self.result_list:
+            obj.live_stat = live_stats[obj.task_id]
 
 
 class CeleryTasksAdmin(admin.ModelAdmin):
     model = CeleryTasks
 
-    list_display = (
+    readonly_fields = (
         'task_id',
         'creation_date',
         'start_date',
@@ -16,9 +42,9 @@ class CeleryTasksAdmin(admin.ModelAdmin):
         'key',
         'user',)
 
-    readonly_fields = list_display
+    list_display = readonly_fields + ('live_progress', 'live_msg',)
 
-    actions = ('double_check_state',)
+    actions = ('double_check_state', 'terminate_selected',)
 
     def has_add_permission(self, request):
         return False
@@ -27,17 +53,40 @@ class CeleryTasksAdmin(admin.ModelAdmin):
         actions = super(CeleryTasksAdmin, self).get_actions(request)
         return actions
 
+    def get_queryset(self, request):
+        # The duration is computed in the database so the list can be sorted by it
+        queryset = super(CeleryTasksAdmin, self).get_queryset(request)
+        return queryset.annotate(
+            run_time=ExpressionWrapper(F('end_date') - F('start_date'), output_field=DurationField()))
+
+    def get_changelist(self, request, **kwargs):
+        return CeleryTasksChangeList
+
+    def duration(self, obj):
+        if obj.run_time is None:
+            return "Not finished" if not obj.end_date else "Err"
+        return timedelta_to_hms(obj.run_time)
+
+    duration.admin_order_field = 'run_time'
+
+    def live_progress(self, obj):
+        live_stat = getattr(obj, 'live_stat', None)
+        return "%s%%" % live_stat['progress_percent'] if live_stat else "-"
+
+    live_progress.short_description = "Progress"
+
+    def live_msg(self, obj):
+        live_stat = getattr(obj, 'live_stat', None)
+        return live_stat['msg'] if live_stat else "-"
+
+    live_msg.short_description = "Message"
+
     def double_check_state(self, request, queryset):
         """removing from deleted item """
 
-        from django.utils.safestring import mark_safe
-        from django.core.cache import cache
-
         selected_tasks_stats = ""
-        for task_obj in queryset:
-            task_id = task_obj.task_id
-            task_key = "celery-stat-%s" % task_id
-            task_stat = cache.get(task_key)
+        live_stats = get_live_stats(queryset.values_list('task_id', flat=True))
+        for task_id, task_stat in live_stats.items():
             if task_stat:
                 task_stat_formatted = ', '.join(
                     ['%s: %s' % (key, value) for (key, value) in task_stat.items()])
@@ -53,4 +102,78 @@ class CeleryTasksAdmin(admin.ModelAdmin):
 
     double_check_state.short_description = "Retrieve the state of selected items!"
 
+    def terminate_selected(self, request, queryset):
+        self.message_user(request, "%s tasks were terminated" % terminate_tasks(queryset))
+
+    terminate_selected.short_description = "Terminate the selected tasks"
+
 admin.site.register(CeleryTasks, CeleryTasksAdmin)
+
+
+class TaskStatsChangeList(ChangeList):
+
+    """ Fetches the histograms of all the buckets on the page at once """
+
+    def get_results(self, request):
+        super(TaskStatsChangeList, self).get_results(request)
+        histograms = defaultdict(lambda: defaultdict(dict))
+        bins = TaskStatsBin.objects.filter(key__in=set(obj.key for obj in self.result_list),
+                                           bucket__in=set(obj.bucket for obj in self.result_list))
+        for row in bins:
+            histograms[(row.key, row.bucket)][row.metric][row.bin] = row.count
+        for obj in self.result_list:
+            obj.percentiles = dict((metric, percentiles(histograms[(obj.key, obj.bucket)][metric],
+                                                        getattr(obj, metric + '_max')))
+                                   for metric in ("wait", "run"))
+
+
+def rate(count, total):
+    return "%.1f%%" % (100. * count / total) if total else "-"
+
+
+def seconds(value):
+    return "-" if value is None else "%ss" % value
+
+
+class TaskStatsBucketAdmin(admin.ModelAdmin):
+    model = TaskStatsBucket
+
+    list_display = ('key', 'bucket', 'total', 'failure_rate', 'kill_rate', 'wait_p50', 'wait_p90', 'run_avg',
+                    'run_p50', 'run_p90', 'run_p99', 'run_max',)
+    list_filter = ('key',)
+    date_hierarchy = 'bucket'
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_readonly_fields(self, request, obj=None):
+        return [field.name for field in self.model._meta.fields]
+
+    def get_changelist(self, request, **kwargs):
+        return TaskStatsChangeList
+
+    def failure_rate(self, obj):
+        return rate(obj.error + obj.failed, obj.total)
+
+    def kill_rate(self, obj):
+        return rate(obj.killed, obj.total)
+
+    def run_avg(self, obj):
+        return seconds(round(obj.run_sum / obj.run_count, 3) if obj.run_count else None)
+
+    def wait_p50(self, obj):
+        return seconds(obj.percentiles["wait"]["p50"])
+
+    def wait_p90(self, obj):
+        return seconds(obj.percentiles["wait"]["p90"])
+
+    def run_p50(self, obj):
+        return seconds(obj.percentiles["run"]["p50"])
+
+    def run_p90(self, obj):
+        return seconds(obj.percentiles["run"]["p90"])
+
+    def run_p99(self, obj):
+        return seconds(obj.percentiles["run"]["p99"])
+
+admin.site.register(TaskStatsBucket, TaskStatsBucketAdmin)
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Historical analytics of the tasks: queue wait and run time percentiles and failure and kill rates per task key and
+time bucket.
+
+rollup_task_stats adds the CeleryTasks objects that have ended since its last run to one TaskStatsBucket per key
+and TASKBAR_STATS_BUCKET_HOURS of creation date, and their wait and run times to a log-scaled histogram of
+TaskStatsBin rows. Every object is rolled up once, so a run only reads the tasks that are new and the rollups
+outlive the history that purge_task_history deletes. The stats are then summed up over the buckets by the database
+and the percentiles are read off the summed histograms, so a dashboard never scans the history.
+"""
+from __future__ import print_function, absolute_import, division
+
+import math
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max, Sum
+
+from taskbar.models import CeleryTasks, TaskStatsBin, TaskStatsBucket, TERMINAL_STATUSES
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+# The size of the time buckets of the rollups. It should divide 24.
+TASKBAR_STATS_BUCKET_HOURS = getattr(settings, 'TASKBAR_STATS_BUCKET_HOURS', 1)
+# How many CeleryTasks objects are rolled up in one transaction
+TASKBAR_STATS_BATCH_SIZE = getattr(settings, 'TASKBAR_STATS_BATCH_SIZE', 1000)
+
+# The bins of the histograms start at BIN_MIN seconds and each is BIN_RATIO times as wide as the previous one, so
+# a percentile is off by less than 10% whatever the scale of the times.
+BIN_MIN = .01
+BIN_RATIO = 2 ** .25
+BIN_MAX = 200
+
+PERCENTILES = (50, 90, 99)
+
+# Keeps two rollups from counting the same tasks
+ROLLUP_LOCK_KEY = "taskbar-stats-rollup-lock"
+ROLLUP_LOCK_TTL = 3600
+
+STATUS_FIELDS = {"finished": "finished", "error": "error", "killed": "killed", "must have failed": "failed"}
+
+
+def time_bin(seconds):
+    if seconds < BIN_MIN:
+        return 0
+    return min(int(math.log(seconds / BIN_MIN, BIN_RATIO)), BIN_MAX)
+
+
+def bin_value(bin_index):
+    """
+    The middle of the bin (in seconds) that stands for the times in it
+    """
+    return round(BIN_MIN * BIN_RATIO ** (bin_index + .5), 3)
+
+
+def time_bucket(date):
+    return date.replace(hour=date.hour - date.hour % TASKBAR_STATS_BUCKET_HOURS, minute=0, second=0,
+                        microsecond=0)
+
+
+def seconds_between(start, end):
+    if start is None or end is None:
+        return None
+    return max((end - start).total_seconds(), 0)
+
+
+def rollup_task_stats(batch_size=None):
+    """
+    Rolls up the CeleryTasks objects that have ended and were not rolled up yet and returns how many there were
+    """
+    batch_size = TASKBAR_STATS_BATCH_SIZE if batch_size is None else batch_size
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    if not cache.add(ROLLUP_LOCK_KEY, 1, ROLLUP_LOCK_TTL):
+        logger.info("Task stats rollup skipped, another one is running")
+        return 0
+
+    total = 0
+    try:
+        while True:
+            rolled_up = rollup_batch(batch_size)
+            total += rolled_up
+            if rolled_up < batch_size:
+                return total
+    finally:
+        cache.delete(ROLLUP_LOCK_KEY)
+
+
+@transaction.atomic
+def rollup_batch(batch_size):
+    tasks = list(CeleryTasks.objects.filter(rolled_up=False, status__in=TERMINAL_STATUSES).order_by('pk').values_list(
+        'pk', 'key', 'status', 'creation_date', 'start_date', 'end_date')[:batch_size])
+    if not tasks:
+        return 0
+
+    buckets = defaultdict(lambda: defaultdict(int))
+    bins = defaultdict(int)
+    for pk, key, status, creation_date, start_date, end_date in tasks:
+        bucket = buckets[(key, time_bucket(creation_date))]
+        bucket['total'] += 1
+        bucket[STATUS_FIELDS[status]] += 1
+        for metric, seconds in (("wait", seconds_between(creation_date, start_date)),
+                                ("run", seconds_between(start_date, end_date))):
+            if seconds is None:
+                continue
+            bucket[metric + '_count'] += 1
+            bucket[metric + '_sum'] += seconds
+            bucket[metric + '_max'] = max(bucket[metric + '_max'], seconds)
+            bins[(key, time_bucket(creation_date), metric, time_bin(seconds))] += 1
+
+    add_to_buckets(buckets)
+    add_to_bins(bins)
+    CeleryTasks.objects.filter(pk__in=[task[0] for task in tasks]).update(rolled_up=True)
+    return len(tasks)
+
+
+def existing_rows(model, keys, buckets):
+    """
+    returns the rows of the model in the keys and the buckets, locked until the end of the transaction
+    """
+    return model.objects.select_for_update().filter(key__in=set(keys), bucket__in=set(buckets))
+
+
+def add_to_buckets(buckets):
+    existing = dict(((row.key, row.bucket), row) for row in existing_rows(
+        TaskStatsBucket, [key for key, bucket in buckets], [bucket for key, bucket in buckets]))
+
+    new_rows = []
+    for (key, bucket), counts in buckets.items():
+        row = existing.get((key, bucket))
+        if row is None:
+            new_rows.append(TaskStatsBucket(key=key, bucket=bucket, **counts))
+            continue
+        for field, value in counts.items():
+            if field.endswith('_max'):
+                setattr(row, field, max(getattr(row, field), value))
+            else:
+                setattr(row, field, getattr(row, field) + value)
+        row.save()
+    TaskStatsBucket.objects.bulk_create(new_rows)
+
+
+def add_to_bins(bins):
+    existing = dict(((row.key, row.bucket, row.metric, row.bin), row) for row in existing_rows(
+        TaskStatsBin, [key for key, bucket, metric, bin_index in bins],
+        [bucket for key, bucket, metric, bin_index in bins]))
+
+    new_rows = []
+    for (key, bucket, metric, bin_index), count in bins.items():
+        row = existing.get((key, bucket, metric, bin_index))
+        if row is None:
+            new_rows.append(TaskStatsBin(key=key, bucket=bucket, metric=metric, bin=bin_index, count=count))
+        else:
+            row.count += count
+            row.save(update_fields=['count'])
+    TaskStatsBin.objects.bulk_create(new_rows)
+
+
+def percentiles(histogram, max_value=None):
+    """
+    returns the PERCENTILES of the {bin: count} histogram. They are at most max_value, the largest of the times.
+    """
+    total = sum(histogram.values())
+    result = dict(("p%s" % percentile, None) for percentile in PERCENTILES)
+    if not total:
+        return result
+
+    seen = 0
+    pending = list(PERCENTILES)
+    for bin_index in sorted(histogram):
+        seen += histogram[bin_index]
+        while pending and seen >= total * pending[0] / 100:
+            value = bin_value(bin_index)
+            result["p%s" % pending.pop(0)] = min(value, max_value) if max_value is not None else value
+    return result
+
+
+def filter_stats(queryset, keys=None, since=None, until=None):
+    if keys:
+        queryset = queryset.filter(key__in=keys)
+    if since:
+        queryset = queryset.filter(bucket__gte=time_bucket(since))
+    if until:
+        queryset = queryset.filter(bucket__lt=until)
+    return queryset
+
+
+def task_stats(keys=None, since=None, until=None, group=("key",)):
+    """
+    returns the stats of the tasks created between since and until, per the group fields ("key" and/or "bucket").
+
+    since is rounded down to its bucket and until is exclusive. The counts, the sums and the histograms are summed
+    up by the database, in one query each.
+    """
+    group = list(group)
+    buckets = filter_stats(TaskStatsBucket.objects.all(), keys, since, until).values(*group).annotate(
+        Sum('total'), Sum('finished'), Sum('error'), Sum('killed'), Sum('failed'), Sum('wait_count'),
+        Sum('wait_sum'), Max('wait_max'), Sum('run_count'), Sum('run_sum'), Max('run_max')).order_by(*group)
+
+    histograms = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+    bins = filter_stats(TaskStatsBin.objects.all(), keys, since, until).values(
+        *group + ['metric', 'bin']).annotate(Sum('count')).order_by()
+    for row in bins:
+        histograms[tuple(row[field] for field in group)][row['metric']][row['bin']] = row['count__sum']
+
+    return [stats_item(row, group, histograms[tuple(row[field] for field in group)]) for row in buckets]
+
+
+def stats_item(row, group, histograms):
+    total = row['total__sum']
+    item = dict((field, row[field]) for field in group)
+    item.update({
+        'total': total,
+        'finished': row['finished__sum'],
+        'error': row['error__sum'],
+        'killed': row['killed__sum'],
+        'must_have_failed': row['failed__sum'],
+        'failure_rate': (row['error__sum'] + row['failed__sum']) / total if total else None,
+        'kill_rate': row['killed__sum'] / total if total else None,
+    })
+    for metric in ("wait", "run"):
+        count = row[metric + '_count__sum']
+        max_value = row[metric + '_max__max'] if count else None
+        item[metric] = dict(percentiles(histograms[metric], max_value), count=count, max=max_value,
+                            avg=row[metric + '_sum__sum'] / count if count else None)
+    return item
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Async versions of the taskbar views for ASGI deployments. They return the same JSON and apply the same
+permission rules as the views in taskbar.views, but a poll does not hold a thread while it waits on the cache.
+
+Needs Python 3 and Django 3.1+ (async views), and Django 4.2+ for task_stream (async streaming responses). The rest
+of the package also runs on the older versions, which just don't import this module.
+
+The async cache methods of Django (4.0+) are used when they are available. The ORM calls and the backends
+that read more than the Django cache go through sync_to_async which is also what the async ORM methods of Django do.
+"""
+import asyncio
+from functools import wraps
+from time import time
+
+import django
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, PermissionDenied
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+
+from taskbar import locks, views
+from taskbar.backends import get_backend
+from taskbar.models import CeleryTasks, TERMINAL_STATUSES
+from taskbar.utils import decorator_with_args
+
+if django.VERSION < (3, 1):
+    raise ImproperlyConfigured("taskbar.async_views needs Django 3.1 or later")
+
+# Django streams the responses of async generators from 4.2 on
+ASYNC_STREAMING = django.VERSION >= (4, 2)
+
+
+async def cache_get_many(keys):
+    if hasattr(cache, 'aget_many'):
+        return await cache.aget_many(keys)
+    return await sync_to_async(cache.get_many)(keys)
+
+
+async def cache_set(key, value, timeout):
+    if hasattr(cache, 'aset'):
+        return await cache.aset(key, value, timeout)
+    return await sync_to_async(cache.set)(key, value, timeout)
+
+
+async def get_user(request):
+    """
+    Loads the lazy request.user in a thread so its attributes can be read in the async code
+    """
+    if hasattr(request, 'auser'):
+        return await request.auser()
+
+    def load_user():
+        request.user.is_active
+        return request.user
+
+    return await sync_to_async(load_user)()
+
+
+async def get_task_stats(user, task_ids, msg_indexes):
+    backend = get_backend()
+    if not backend.cache_only:
+        return await sync_to_async(backend.read_task_stats)(user, task_ids, msg_indexes)
+
+    cached = await cache_get_many(backend.stats_keys(task_ids))
+    task_stats, chunks_to_read = backend.parse_stats(user, task_ids, msg_indexes, cached)
+
+    segment_keys = backend.chunk_keys(chunks_to_read)
+    if segment_keys:
+        backend.add_chunks(task_stats, chunks_to_read, await cache_get_many(segment_keys))
+
+    return task_stats
+
+
+async def read_version(user, task_id):
+    backend = get_backend()
+    if not backend.cache_only:
+        return await sync_to_async(backend.read_version)(user, task_id)
+    return backend.parse_version(user, task_id, await cache_get_many(backend.version_keys(task_id)))
+
+
+async def set_kill(task_id, timeout):
+    backend = get_backend()
+    if backend.cache_only:
+        return await cache_set(backend.kill_key(task_id), True, timeout)
+    return await sync_to_async(backend.set_kill)(task_id, timeout)
+
+
+@decorator_with_args
+def progressbarit(fn, task_key="", only_staff=True):
+    """
+    The async version of taskbar.views.progressbarit. The decorated view is a coroutine function that sends
+    the task to celery and returns the task id.
+    """
+    @wraps(fn)
+    async def wrapped(request, *args, **kwargs):
+
+        user = await get_user(request)
+        views.check_user(user, only_staff)
+
+        if task_key and not await sync_to_async(locks.acquire)(task_key):
+            return views.json_response("Error: %s Task is already running" % task_key)
+
+        try:
+            task_id = await fn(request, *args, **kwargs)
+        except:
+            if task_key:
+                await sync_to_async(locks.release)(task_key)
+            return views.json_response("Error: %s Task failed to run" % task_key)
+
+        await sync_to_async(views.register_task)(user, task_id, task_key)
+
+        return views.json_response(task_id)
+
+    return wrapped
+
+
+async def task_api(request):
+    """ The async version of taskbar.views.task_api """
+
+    user = await get_user(request)
+    if not user.is_active:
+        raise PermissionDenied
+
+    task_id, terminate, msg_index_client = views.get_task_api_params(request)
+
+    if task_id:
+        if request.META.get('HTTP_IF_NONE_MATCH') and terminate != "1":
+            if views.is_not_modified(request, await read_version(user, task_id), msg_index_client):
+                return HttpResponseNotModified()
+
+        task_stat = (await get_task_stats(user, [task_id], [msg_index_client]))[task_id]
+        if task_stat is None:
+            task_stat = await sync_to_async(views.get_history_stat)(user, task_id)
+        if task_stat is None:
+            return HttpResponse('Unauthorized', status=401)
+        task_stat['poll_after'] = views.poll_after(task_stat)
+    else:
+        task_stat = None
+
+    if task_stat and terminate == "1":
+        await set_kill(task_id, 60 * 5)
+
+    return views.add_etag(views.json_response(task_stat), task_stat)
+
+
+async def task_batch_api(request):
+    """ The async version of taskbar.views.task_batch_api """
+
+    user = await get_user(request)
+    if not user.is_active:
+        raise PermissionDenied
+
+    task_ids, msg_indexes = views.get_task_batch_api_params(request)
+
+    task_stats = await get_task_stats(user, task_ids, msg_indexes)
+    missing = [task_id for task_id, task_stat in task_stats.items() if task_stat is None]
+    if missing:
+        task_stats.update(await sync_to_async(views.get_history_stats)(user, missing))
+    return views.json_response(views.add_poll_after(task_stats))
+
+
+async def task_stream(request):
+    """ The async version of taskbar.views.task_stream. Needs Django 4.2+ for async streaming responses. """
+
+    if not ASYNC_STREAMING:
+        raise ImproperlyConfigured("taskbar.async_views.task_stream needs Django 4.2 or later, "
+                                   "use taskbar.views.task_stream")
+
+    user = await get_user(request)
+    if not user.is_active:
+        raise PermissionDenied
+
+    task_id, msg_index_client = views.get_task_stream_params(request)
+
+    if not task_id:
+        return HttpResponse('Unauthorized', status=401)
+
+    task_stat = (await get_task_stats(user, [task_id], [msg_index_client]))[task_id]
+    if task_stat is None and not await sync_to_async(
+            CeleryTasks.objects.filter(task_id=task_id, user=user).exists)():
+        return HttpResponse('Unauthorized', status=401)
+
+    response = StreamingHttpResponse(
+        stream_task_events(user, task_id, msg_index_client, task_stat), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def stream_task_events(user, task_id, msg_index_client, task_stat=None):
+    seen = None
+    deadline = time() + views.TASKBAR_STREAM_TIMEOUT
+
+    while True:
+        if task_stat is None:
+            if seen is not None:
+                return
+
+        elif views.stat_version(task_stat) != seen:
+            seen = views.stat_version(task_stat)
+            msg_index_client = task_stat['msg_index']
+            yield views.format_task_event(task_stat)
+
+            if task_stat.get('status') in TERMINAL_STATUSES:
+                return
+
+        if time() >= deadline:
+            return
+
+        await asyncio.sleep(views.TASKBAR_STREAM_INTERVAL)
+        if get_backend().reads_versions:
+            version = await read_version(user, task_id)
+            if version is None:
+                task_stat = None
+                continue
+            if version == seen:
+                continue
+        task_stat = (await get_task_stats(user, [task_id], [msg_index_client]))[task_id]
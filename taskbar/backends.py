@@ -0,0 +1,731 @@
+# -*- coding: utf-8 -*-
+"""
+The backends keep the task stats, the kill flags and the message logs.
+
+DjangoCacheBackend is the default. It keeps the stat as one pickled dictionary in the Django cache and the
+message log as segments (see taskbar.msglog).
+
+RedisBackend keeps the stat as a Redis hash and only writes the fields that have changed, in the same pipeline
+as the kill check. The message log is a Redis list plus a counter of the messages, which several writers can
+append to without a lock. Its msg_index is a number of messages.
+
+CeleryResultBackend publishes the stat as the meta of the PROGRESS state of the task in the Celery result
+backend, like current_task.update_state does, along with the tail of the message log. A kill revokes the task.
+
+The backend is chosen with TASKBAR_BACKEND. The counters of the child tasks (taskbar.rollup), the task key
+locks and the metrics stay in the Django cache with either backend.
+"""
+from __future__ import print_function, absolute_import, division
+
+import json
+import weakref
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+from taskbar import msglog, rollup
+from taskbar.models import CeleryTasks, TERMINAL_STATUSES
+from taskbar.msglog import MessageLog, SharedMessageLog
+
+try:
+    from itertools import zip_longest
+except ImportError:
+    from itertools import izip_longest as zip_longest
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+TASKBAR_BACKEND = getattr(settings, 'TASKBAR_BACKEND', 'taskbar.backends.DjangoCacheBackend')
+TASKBAR_REDIS_URL = getattr(settings, 'TASKBAR_REDIS_URL', 'redis://localhost:6379/0')
+
+INVALID_MSG_INDEX = "Error in pointer index server call"
+
+
+def owned_stat(task_stat, user):
+    """
+    returns the stat if it belongs to the user, otherwise None
+    """
+    try:
+        if task_stat['user_id'] != user.id:
+            return None
+    except TypeError:
+        return None
+    return task_stat
+
+
+def history_stat(user_id, status):
+    """
+    returns a stat made up from the status of the CeleryTasks object of a task that has no stat, for example
+    because it is still in the queue or has returned
+    """
+    return {'msg': "WAITING" if status == "waiting" else '', 'sticky_msg': '',
+            'progress_percent': 100 if status == "finished" else 0,
+            'is_killed': status in TERMINAL_STATUSES and status != "finished", 'user_id': user_id, 'msg_index': 0,
+            'status': status, 'version': 0, 'percent_per_sec': None, 'items_per_sec': None, 'eta': None}
+
+
+def with_cursors(task_ids, msg_indexes):
+    return zip_longest(task_ids, msg_indexes[:len(task_ids)], fillvalue=False)
+
+
+class BaseBackend(object):
+
+    """ The interface of the backends """
+
+    # If the backend can write only the changed fields of the stat
+    partial_writes = False
+    # If the backend can check the kill flags in the same round trip as the stat write
+    piggyback_kill = False
+    # If everything is read from the Django cache, so the async views can use its async methods
+    cache_only = False
+    # If read_version can tell the version of a stat without reading the stat
+    reads_versions = False
+
+    def stat_key(self, task_id):
+        return "celery-stat-%s" % task_id
+
+    def kill_key(self, task_id):
+        return "celery-kill-%s" % task_id
+
+    def write_stat(self, task_id, result, timeout, changed=None, kill_ids=None):
+        """
+        Writes the stat of the task. changed is the dictionary of the fields that have changed since the last
+        write when partial_writes is on. If kill_ids are passed and piggyback_kill is on, returns whether any of
+        those tasks is killed. Otherwise returns None.
+        """
+        raise NotImplementedError
+
+    def read_kill(self, task_ids):
+        """
+        returns True if any of the tasks is killed
+        """
+        raise NotImplementedError
+
+    def set_kill(self, task_id, timeout=60 * 5):
+        raise NotImplementedError
+
+    def set_kills(self, task_ids, timeout=60 * 5):
+        for task_id in task_ids:
+            self.set_kill(task_id, timeout)
+
+    def message_log(self, task_id, cache_time, shared=False):
+        """
+        returns the writer of the message log of the task. shared is for the logs that child tasks write to.
+        """
+        raise NotImplementedError
+
+    def share_log(self, msg_log, cache_time):
+        """
+        returns the shared log that takes over from the log of a task once it has child tasks
+        """
+        shared_log = self.message_log(msg_log.task_id, cache_time, shared=True)
+        shared_log.starts, shared_log.first = msg_log.starts, msg_log.first
+        shared_log.length = msg_log.length
+        shared_log.share()
+        return shared_log
+
+    def read_stats(self, task_ids):
+        """
+        returns a dictionary of task id to the stat of the task, or None if there is none
+        """
+        raise NotImplementedError
+
+    def read_task_stats(self, user, task_ids, msg_indexes):
+        """
+        returns a dictionary of task id to the stat of the task including the msg_chunk after the client's
+        msg index. The stat is None if the task does not belong to the user.
+        """
+        raise NotImplementedError
+
+    def read_version(self, user, task_id):
+        """
+        returns the version and the msg_index of the stat of the task without reading the stat, or None if the
+        task does not belong to the user or the backend can't tell
+        """
+        return None
+
+
+class DjangoCacheBackend(BaseBackend):
+
+    cache_only = True
+    reads_versions = True
+
+    def version_key(self, task_id):
+        return "celery-%s-version" % task_id
+
+    def write_stat(self, task_id, result, timeout, changed=None, kill_ids=None):
+        # The small version key lets task_api answer the polls of unchanged stats without reading the stat
+        cache.set_many({self.stat_key(task_id): result,
+                        self.version_key(task_id): (result['user_id'], result['version'], result['msg_index'])},
+                       timeout)
+
+    def read_kill(self, task_ids):
+        if len(task_ids) == 1:
+            return bool(cache.get(self.kill_key(task_ids[0])))
+        return any(cache.get_many([self.kill_key(task_id) for task_id in task_ids]).values())
+
+    def set_kill(self, task_id, timeout=60 * 5):
+        cache.set(self.kill_key(task_id), True, timeout)
+
+    def set_kills(self, task_ids, timeout=60 * 5):
+        cache.set_many(dict((self.kill_key(task_id), True) for task_id in task_ids), timeout)
+
+    def message_log(self, task_id, cache_time, shared=False):
+        return (SharedMessageLog if shared else MessageLog)(task_id, cache_time)
+
+    def read_stats(self, task_ids):
+        task_stats = cache.get_many([self.stat_key(task_id) for task_id in task_ids])
+        return dict((task_id, task_stats.get(self.stat_key(task_id))) for task_id in task_ids)
+
+    def read_task_stats(self, user, task_ids, msg_indexes):
+        # All the stats are read with one get_many and all the message log tails with another one
+        cached = self.read_cached(task_ids)
+        task_stats, chunks_to_read = self.parse_stats(user, task_ids, msg_indexes, cached)
+
+        segment_keys = self.chunk_keys(chunks_to_read)
+        if segment_keys:
+            self.add_chunks(task_stats, chunks_to_read, cache.get_many(segment_keys))
+
+        return task_stats
+
+    def read_version(self, user, task_id):
+        return self.parse_version(user, task_id, cache.get_many(self.version_keys(task_id)))
+
+    # The steps of read_task_stats and read_version are separate methods so the async views can do the cache
+    # reads themselves
+
+    def version_keys(self, task_id):
+        return [self.version_key(task_id)] + rollup.rollup_keys(task_id)
+
+    def parse_version(self, user, task_id, cached):
+        try:
+            user_id, version, msg_index = cached[self.version_key(task_id)]
+        except KeyError:
+            return None
+        if user_id != user.id:
+            return None
+        # The counters are only there if the task is a parent of other tasks
+        return rollup.rollup_version(version, msg_index, cached, task_id)
+
+    def read_cached(self, task_ids):
+        return cache.get_many(self.stats_keys(task_ids))
+
+    def stats_keys(self, task_ids):
+        keys = []
+        for task_id in task_ids:
+            keys.extend((self.stat_key(task_id), msglog.index_key(task_id)))
+            # In case the task is a parent of other tasks. The misses cost nothing in the same round trip.
+            keys.extend(rollup.rollup_keys(task_id))
+        return keys
+
+    def parse_stats(self, user, task_ids, msg_indexes, cached):
+        """
+        returns the stats of the tasks that belong to the user out of the cached values and the log chunks
+        that need to be read for them
+        """
+        task_stats = {}
+        chunks_to_read = {}
+        for task_id, msg_index_client in with_cursors(task_ids, msg_indexes):
+            task_stat = owned_stat(cached.get(self.stat_key(task_id)), user)
+            task_stats[task_id] = task_stat
+            if task_stat is None:
+                continue
+
+            if task_stat.get('children'):
+                rollup.apply_rollup(task_stat, cached, task_id)
+
+            try:
+                msg_index_client = int(msg_index_client)
+            except:
+                task_stat['msg_chunk'] = INVALID_MSG_INDEX
+            else:
+                if msg_index_client < task_stat['msg_index']:
+                    index = msglog.parse_index(cached.get(msglog.index_key(task_id)))
+                    chunks_to_read[task_id] = (index, msg_index_client)
+
+        return task_stats, chunks_to_read
+
+    def chunk_keys(self, chunks_to_read):
+        segment_keys = []
+        for task_id, (index, msg_index_client) in chunks_to_read.items():
+            segment_keys.extend(msglog.chunk_keys(task_id, index, msg_index_client))
+        return segment_keys
+
+    def add_chunks(self, task_stats, chunks_to_read, segments):
+        for task_id, (index, msg_index_client) in chunks_to_read.items():
+            task_stat = task_stats[task_id]
+            task_stat['msg_chunk'] = msglog.join_chunk(task_id, index, msg_index_client, segments,
+                                                       task_stat['msg_index'])
+
+
+class MetaMessageLog(object):
+
+    """ The message log of a task as the last messages in the meta of its PROGRESS state.
+
+        The tail goes out with every write of the stat, so only the last TASKBAR_MSG_SEGMENT_SIZE characters or so
+        are kept. msg_tail_start is the offset of the first message of the tail, so the offsets of the clients stay
+        valid and the readers tell that the log was truncated.
+    """
+
+    def __init__(self, task_id, max_size=None):
+        self.task_id = task_id
+        self.max_size = max_size or msglog.TASKBAR_MSG_SEGMENT_SIZE
+        self.reset()
+
+    def reset(self):
+        self.messages = []
+        self.size = 0
+        self.length = 0
+
+    def append(self, val):
+        self.messages.append(val)
+        self.size += len(val)
+        self.length += len(val)
+        # Keeping the last message
+        while self.size > self.max_size and len(self.messages) > 1:
+            self.size -= len(self.messages.pop(0))
+
+    def close(self, cache_time=60):
+        # The tail goes away with the meta once the task returns
+        pass
+
+    def stat_fields(self):
+        return {'msg_tail': "".join(self.messages), 'msg_tail_start': self.length - self.size}
+
+
+def tail_chunk(task_stat, offset):
+    """
+    returns the log from the offset up to the msg_index of the stat out of the tail in the stat
+    """
+    tail, start = task_stat['msg_tail'], task_stat['msg_tail_start']
+    stop = max(task_stat['msg_index'] - start, 0)
+    if offset < start:
+        return msglog.TRUNCATED_MARKER + tail[:stop]
+    return tail[offset - start:stop]
+
+
+class CeleryResultBackend(DjangoCacheBackend):
+
+    """ Keeps the stat in the Celery result backend as the meta of the PROGRESS state of the task.
+
+        The meta carries the tail of the message log too, so a poll is one read of the result backend. Only the
+        parents of child tasks keep their log in the Django cache, where the children append to it.
+
+        A kill revokes the task: the workers drop it if it is still queued and its state becomes REVOKED, which
+        the task reads at its kill checks. The writes read the state first so they don't replace the REVOKED.
+
+        Once the task returns, Celery replaces the meta with the return value. From then on the stat is made up
+        from the CeleryTasks object of the task, without the messages. The result backend of Celery has to be
+        enabled and the tasks must not have ignore_result set.
+    """
+
+    cache_only = False
+    piggyback_kill = True
+    state = "PROGRESS"
+    ready_states = ("SUCCESS", "FAILURE", "REVOKED")
+    tail_fields = ('msg_tail', 'msg_tail_start')
+
+    def __init__(self):
+        # The logs of the tasks that run in this process, whose tails go out with their stats
+        self.logs = weakref.WeakValueDictionary()
+
+    @property
+    def result_backend(self):
+        from celery import current_app
+        return current_app.backend
+
+    def write_stat(self, task_id, result, timeout, changed=None, kill_ids=None):
+        revoked = self.revoked(kill_ids or [task_id])
+        if task_id in revoked:
+            return True
+
+        msg_log = self.logs.get(task_id)
+        if msg_log is not None:
+            result = dict(result, **msg_log.stat_fields())
+        # This is what current_task.update_state(state=..., meta=...) does. The expiry is Celery's result_expires.
+        self.result_backend.store_result(task_id, result, self.state)
+        # Without kill_ids only the state of the task itself was read
+        if kill_ids:
+            return bool(revoked)
+        return None
+
+    def revoked(self, task_ids):
+        """
+        returns the ids of the tasks that are revoked, either in this worker or in the result backend
+        """
+        from celery.worker import state as worker_state
+        revoked = set(task_id for task_id in task_ids if task_id in worker_state.revoked)
+        metas = self.read_metas([task_id for task_id in task_ids if task_id not in revoked])
+        revoked.update(meta['task_id'] for meta in metas if meta['status'] == "REVOKED")
+        return revoked
+
+    def read_kill(self, task_ids):
+        return bool(self.revoked(task_ids))
+
+    def set_kill(self, task_id, timeout=60 * 5):
+        self.set_kills([task_id], timeout)
+
+    def set_kills(self, task_ids, timeout=60 * 5):
+        # The REVOKED state lasts for Celery's result_expires rather than timeout
+        from celery import current_app
+        current_app.control.revoke(task_ids)
+        for task_id in task_ids:
+            self.result_backend.mark_as_revoked(task_id, "terminated")
+
+    def message_log(self, task_id, cache_time, shared=False):
+        if shared:
+            return SharedMessageLog(task_id, cache_time)
+        msg_log = MetaMessageLog(task_id)
+        self.logs[task_id] = msg_log
+        return msg_log
+
+    def share_log(self, msg_log, cache_time):
+        # The tail moves to the Django cache as the current segment, so the offsets go on from the same length
+        shared_log = SharedMessageLog(msg_log.task_id, cache_time)
+        fields = msg_log.stat_fields()
+        shared_log.starts, shared_log.first = [fields['msg_tail_start']], 0
+        shared_log.length = msg_log.length
+        cache.set_many({msglog.segment_key(msg_log.task_id, 0): fields['msg_tail'],
+                        msglog.index_key(msg_log.task_id): shared_log.index}, cache_time)
+        shared_log.share()
+        self.logs.pop(msg_log.task_id, None)
+        return shared_log
+
+    def read_metas(self, task_ids):
+        """
+        returns the metas of the tasks. The key-value result backends (Redis, memcached, ...) read them all with
+        one mget, the others with one get_task_meta per task.
+        """
+        result_backend = self.result_backend
+        if not hasattr(result_backend, "mget"):
+            return [dict(result_backend.get_task_meta(task_id), task_id=task_id) for task_id in task_ids]
+        if not task_ids:
+            return []
+
+        keys = [result_backend.get_key_for_task(task_id) for task_id in task_ids]
+        values = result_backend.mget(keys)
+        if hasattr(values, "items"):
+            # Some clients return a dictionary of the keys that were found
+            values = [values.get(key) for key in keys]
+        return [dict({'status': "PENDING", 'result': None} if value is None else result_backend.decode_result(value),
+                     task_id=task_id) for task_id, value in zip(task_ids, values)]
+
+    def read_stats(self, task_ids):
+        task_stats = self.read_stats_with_tails(task_ids)
+        for task_stat in task_stats.values():
+            self.pop_tail(task_stat)
+        return task_stats
+
+    def pop_tail(self, task_stat):
+        if task_stat is not None:
+            for field in self.tail_fields:
+                task_stat.pop(field, None)
+
+    def read_stats_with_tails(self, task_ids):
+        task_stats = {}
+        ready = []
+        for task_id, meta in zip(task_ids, self.read_metas(task_ids)):
+            if meta['status'] == self.state and isinstance(meta['result'], dict):
+                task_stats[task_id] = meta['result']
+            else:
+                task_stats[task_id] = None
+                if meta['status'] in self.ready_states:
+                    ready.append(task_id)
+
+        if ready:
+            for task_id, user_id, status in CeleryTasks.objects.filter(task_id__in=ready).values_list(
+                    'task_id', 'user_id', 'status'):
+                task_stats[task_id] = history_stat(user_id, status)
+
+        return task_stats
+
+    def read_task_stats(self, user, task_ids, msg_indexes):
+        cached = self.read_cached(task_ids)
+        task_stats, chunks_to_read = self.parse_stats(user, task_ids, msg_indexes, cached)
+
+        for task_id, (index, msg_index_client) in list(chunks_to_read.items()):
+            task_stat = task_stats[task_id]
+            if 'msg_tail' in task_stat and not task_stat.get('children'):
+                task_stat['msg_chunk'] = tail_chunk(task_stat, msg_index_client)
+                del chunks_to_read[task_id]
+
+        segment_keys = self.chunk_keys(chunks_to_read)
+        if segment_keys:
+            self.add_chunks(task_stats, chunks_to_read, cache.get_many(segment_keys))
+
+        for task_stat in task_stats.values():
+            self.pop_tail(task_stat)
+        return task_stats
+
+    def read_version(self, user, task_id):
+        # There is no version key. The meta is read as a whole anyway.
+        return None
+
+    def read_cached(self, task_ids):
+        cached = dict((self.stat_key(task_id), task_stat)
+                      for task_id, task_stat in self.read_stats_with_tails(task_ids).items())
+        # The index of the log and the counters are only in the Django cache for the parents of child tasks
+        keys = []
+        for task_id in task_ids:
+            if (cached[self.stat_key(task_id)] or {}).get('children'):
+                keys.append(msglog.index_key(task_id))
+                keys.extend(rollup.rollup_keys(task_id))
+        if keys:
+            cached.update(cache.get_many(keys))
+        return cached
+
+
+class RedisMessageLog(object):
+
+    """ The message log of a task as a Redis list of the messages plus a counter of the messages.
+
+        The offsets in the log (the msg_index) are numbers of messages rather than characters, so a reader can
+        fetch what comes after its offset with one LRANGE.
+
+        Only the last TASKBAR_MSG_MAX_SIZE characters or so are kept: the oldest messages are popped from the list
+        once it is longer. The offset of the first message that is kept is the count minus the length of the list,
+        so the offsets of the clients stay valid and the readers tell that the log was truncated.
+    """
+
+    def __init__(self, client, task_id, cache_time, max_size=None):
+        self.client = client
+        self.task_id = task_id
+        self.cache_time = cache_time
+        # None keeps all the messages
+        self.max_size = max_size or msglog.TASKBAR_MSG_MAX_SIZE
+        self.length = 0
+        self.starts = [0]
+        self.first = 0
+
+    @staticmethod
+    def list_key(task_id):
+        return "celery-%s-msg" % task_id
+
+    @staticmethod
+    def size_key(task_id):
+        return "celery-%s-msg-size" % task_id
+
+    def reset(self):
+        self.length = 0
+        pipe = self.client.pipeline()
+        pipe.delete(self.list_key(self.task_id))
+        pipe.set(msglog.length_key(self.task_id), 0, ex=self.cache_time)
+        pipe.set(self.size_key(self.task_id), 0, ex=self.cache_time)
+        pipe.execute()
+
+    def share(self):
+        # The length is always in Redis
+        pass
+
+    def append(self, val):
+        # The pipeline is a MULTI/EXEC transaction so the list and its length stay in step with several writers
+        pipe = self.client.pipeline()
+        pipe.rpush(self.list_key(self.task_id), val)
+        pipe.incr(msglog.length_key(self.task_id))
+        pipe.incrby(self.size_key(self.task_id), len(val))
+        pipe.expire(self.list_key(self.task_id), self.cache_time)
+        pipe.expire(msglog.length_key(self.task_id), self.cache_time)
+        pipe.expire(self.size_key(self.task_id), self.cache_time)
+        list_length, self.length, size = pipe.execute()[:3]
+        if self.max_size:
+            self.trim(size, list_length)
+
+    def trim(self, size, list_length):
+        """
+        Pops the oldest messages until the log fits in max_size, keeping the last message. LPOP rather than LTRIM
+        because the size of what is dropped is only known from the messages themselves.
+        """
+        while size > self.max_size and list_length > 1:
+            pipe = self.client.pipeline()
+            pipe.lpop(self.list_key(self.task_id))
+            pipe.llen(self.list_key(self.task_id))
+            dropped, list_length = pipe.execute()
+            if dropped is None:
+                return
+            size = self.client.decrby(self.size_key(self.task_id), len(RedisBackend.decode(dropped)))
+
+    def close(self, cache_time=60):
+        pipe = self.client.pipeline()
+        pipe.delete(self.list_key(self.task_id), self.size_key(self.task_id))
+        pipe.expire(msglog.length_key(self.task_id), cache_time)
+        pipe.execute()
+
+
+class RedisBackend(BaseBackend):
+
+    """ Keeps the stats as Redis hashes. The values of the fields are JSON encoded. """
+
+    partial_writes = True
+    piggyback_kill = True
+    reads_versions = True
+
+    # How many times the chunks are read again if the logs are trimmed in the middle of a read
+    chunk_retries = 3
+
+    def __init__(self, client=None, url=None):
+        if client is None:
+            import redis
+            client = redis.StrictRedis.from_url(url or TASKBAR_REDIS_URL)
+        self.client = client
+
+    @staticmethod
+    def decode(value):
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def decode_stat(self, fields):
+        if not fields:
+            return None
+        return dict((self.decode(key), json.loads(self.decode(value))) for key, value in fields.items())
+
+    def write_stat(self, task_id, result, timeout, changed=None, kill_ids=None):
+        fields = result if changed is None else changed
+        pipe = self.client.pipeline(transaction=False)
+        # The EXPIRE comes first to tell if the hash is still there
+        pipe.expire(self.stat_key(task_id), timeout)
+        if fields:
+            pipe.hset(self.stat_key(task_id), mapping=self.encode_stat(fields))
+            pipe.expire(self.stat_key(task_id), timeout)
+        if kill_ids:
+            pipe.mget([self.kill_key(kill_id) for kill_id in kill_ids])
+        replies = pipe.execute()
+
+        if not replies[0] and changed is not None:
+            # The hash has expired, so the changed fields alone would make a stat without its user_id
+            pipe = self.client.pipeline(transaction=False)
+            pipe.hset(self.stat_key(task_id), mapping=self.encode_stat(result))
+            pipe.expire(self.stat_key(task_id), timeout)
+            pipe.execute()
+
+        if kill_ids:
+            return any(replies[-1])
+        return None
+
+    @staticmethod
+    def encode_stat(fields):
+        return dict((key, json.dumps(value)) for key, value in fields.items())
+
+    def read_kill(self, task_ids):
+        return any(self.client.mget([self.kill_key(task_id) for task_id in task_ids]))
+
+    def set_kill(self, task_id, timeout=60 * 5):
+        self.client.set(self.kill_key(task_id), 1, ex=timeout)
+
+    def set_kills(self, task_ids, timeout=60 * 5):
+        pipe = self.client.pipeline(transaction=False)
+        for task_id in task_ids:
+            pipe.set(self.kill_key(task_id), 1, ex=timeout)
+        pipe.execute()
+
+    def message_log(self, task_id, cache_time, shared=False):
+        return RedisMessageLog(self.client, task_id, cache_time)
+
+    def read_stats(self, task_ids):
+        pipe = self.client.pipeline(transaction=False)
+        for task_id in task_ids:
+            pipe.hgetall(self.stat_key(task_id))
+        return dict((task_id, self.decode_stat(fields)) for task_id, fields in zip(task_ids, pipe.execute()))
+
+    def read_task_stats(self, user, task_ids, msg_indexes):
+        # The stat, the length of the log and the length of the list are read in one MULTI so they agree
+        pipe = self.client.pipeline()
+        for task_id in task_ids:
+            pipe.hgetall(self.stat_key(task_id))
+            pipe.get(msglog.length_key(task_id))
+            pipe.llen(RedisMessageLog.list_key(task_id))
+        replies = pipe.execute()
+
+        task_stats = {}
+        chunks_to_read = {}
+        parents = []
+        for number, (task_id, msg_index_client) in enumerate(with_cursors(task_ids, msg_indexes)):
+            fields, length, list_length = replies[number * 3:number * 3 + 3]
+            task_stat = owned_stat(self.decode_stat(fields), user)
+            task_stats[task_id] = task_stat
+            if task_stat is None:
+                continue
+
+            # The length of the log is the msg_index, also when child tasks write to the log
+            task_stat['msg_index'] = int(length or 0)
+            if task_stat.get('children'):
+                parents.append(task_id)
+
+            try:
+                msg_index_client = int(msg_index_client)
+            except:
+                task_stat['msg_chunk'] = INVALID_MSG_INDEX
+            else:
+                if msg_index_client < task_stat['msg_index']:
+                    # The list holds the messages from base on
+                    base = task_stat['msg_index'] - list_length
+                    chunks_to_read[task_id] = (msg_index_client, task_stat['msg_index'], base)
+
+        if parents:
+            keys = []
+            for task_id in parents:
+                keys.extend(rollup.rollup_keys(task_id))
+            cached = cache.get_many(keys)
+            for task_id in parents:
+                rollup.apply_rollup(task_stats[task_id], cached, task_id)
+
+        for task_id, chunk in self.read_chunks(chunks_to_read).items():
+            task_stats[task_id]['msg_chunk'] = chunk
+
+        return task_stats
+
+    def read_version(self, user, task_id):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hmget(self.stat_key(task_id), ['user_id', 'version', 'children'])
+        pipe.get(msglog.length_key(task_id))
+        fields, length = pipe.execute()
+
+        user_id, version, children = [None if value is None else json.loads(self.decode(value)) for value in fields]
+        if user_id is None or user_id != user.id:
+            return None
+        if children:
+            return rollup.rollup_version(version, int(length or 0), cache.get_many(rollup.rollup_keys(task_id)),
+                                         task_id)
+        return version, int(length or 0)
+
+    def read_chunks(self, wanted):
+        """
+        returns the messages from the offset up to the end offset of the log of each task, wanted being task id
+        to (offset, end, base) where base is the offset of the first message in the list. All the tasks are read
+        in one MULTI along with the lengths, which tell if the list has been trimmed since base was read.
+        """
+        chunks = {}
+        for attempt in range(self.chunk_retries + 1):
+            pipe = self.client.pipeline()
+            for task_id, (offset, end, base) in wanted.items():
+                pipe.get(msglog.length_key(task_id))
+                pipe.llen(RedisMessageLog.list_key(task_id))
+                pipe.lrange(RedisMessageLog.list_key(task_id), max(offset - base, 0), end - base - 1)
+            replies = pipe.execute()
+
+            trimmed = {}
+            for number, (task_id, (offset, end, base)) in enumerate(wanted.items()):
+                length, list_length, messages = replies[number * 3:number * 3 + 3]
+                current_base = int(length or 0) - list_length
+                if current_base != base and attempt < self.chunk_retries:
+                    trimmed[task_id] = (offset, end, current_base)
+                    continue
+                chunk = "".join(self.decode(message) for message in messages)
+                chunks[task_id] = msglog.TRUNCATED_MARKER + chunk if offset < base else chunk
+
+            if not trimmed:
+                break
+            wanted = trimmed
+
+        return chunks
+
+
+backend = None
+
+
+def get_backend():
+    global backend
+    if backend is None:
+        backend = import_string(TASKBAR_BACKEND)()
+    return backend
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Mutual exclusion of the tasks that share a task key.
+
+progressbarit takes the lock with an atomic cache.add before sending the task to celery, so two requests can't
+both start the same keyed job. The task releases the lock when it exits. The lock also expires after
+TASKBAR_TASK_KEY_LOCK_TTL seconds in case the task never gets to exit.
+"""
+from __future__ import print_function, absolute_import, division
+
+from django.conf import settings
+from django.core.cache import cache
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+TASKBAR_TASK_KEY_LOCK_TTL = getattr(settings, 'TASKBAR_TASK_KEY_LOCK_TTL', 24 * 3600)
+
+# The value of the lock between it is taken and the task id is known
+PENDING = "pending"
+
+
+def lock_key(task_key):
+    return "celery-lock-%s" % task_key
+
+
+def lock_owner_key(task_id):
+    return "celery-lockof-%s" % task_id
+
+
+def acquire(task_key):
+    """
+    returns True if the lock of the task key was free and is now taken
+    """
+    return cache.add(lock_key(task_key), PENDING, TASKBAR_TASK_KEY_LOCK_TTL)
+
+
+def release(task_key):
+    cache.delete(lock_key(task_key))
+
+
+def assign(task_key, task_id):
+    """
+    Hands over the lock of the task key to the task that was just sent to celery
+    """
+    cache.set(lock_key(task_key), task_id, TASKBAR_TASK_KEY_LOCK_TTL)
+    if not cache.add(lock_owner_key(task_id), task_key, TASKBAR_TASK_KEY_LOCK_TTL):
+        # The task has already finished before we got here
+        release_if_owner(task_key, task_id)
+
+
+def release_for_task(task_id):
+    """
+    Releases the lock that the task holds, if any. Called by the task when it exits.
+    """
+    task_key = cache.get(lock_owner_key(task_id))
+    if task_key is None:
+        # Letting assign know that the task is already done in case the lock is handed over to us later
+        if cache.add(lock_owner_key(task_id), "", TASKBAR_TASK_KEY_LOCK_TTL):
+            return
+        task_key = cache.get(lock_owner_key(task_id))
+
+    if task_key:
+        release_if_owner(task_key, task_id)
+
+
+def release_if_owner(task_key, task_id):
+    if cache.get(lock_key(task_key)) == task_id:
+        release(task_key)
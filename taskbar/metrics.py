@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Optional instrumentation of the progress reporting overhead.
+
+When TASKBAR_METRICS is on, celery_progressbar_stat counts its cache round trips, the bytes it writes, the DB
+saves and the time spent in each of them. The counters are kept in memory and added to the totals of the task
+name and task key in the cache (with cache.incr) when the task exits and every TASKBAR_METRICS_PUSH_INTERVAL
+seconds. task_metrics serves the totals in the Prometheus text format.
+
+Every (task name, task key) label gets a slot number the first time it is pushed and the totals are kept under
+the slot, so the keys of the cache don't depend on what the labels contain. The slots are taken with cache.incr
+and cache.add, so the workers that push at the same time never lose each other's labels.
+
+When it is off, the stat gets NULL_METRICS whose methods do nothing.
+"""
+from __future__ import print_function, absolute_import, division
+
+import hashlib
+import pickle
+from time import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from taskbar.models import CeleryTasks
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+TASKBAR_METRICS = getattr(settings, 'TASKBAR_METRICS', False)
+TASKBAR_METRICS_PUSH_INTERVAL = getattr(settings, 'TASKBAR_METRICS_PUSH_INTERVAL', 60)
+# The totals expire if nothing is pushed for this long
+TASKBAR_METRICS_CACHE_TIME = getattr(settings, 'TASKBAR_METRICS_CACHE_TIME', 7 * 24 * 3600)
+
+# The number of slots taken so far
+SLOTS_KEY = "taskbar-metrics-slots"
+
+# name: (prometheus metric, help)
+COUNTERS = {
+    'tasks': ("taskbar_tasks_total", "Tasks that reported their metrics"),
+    'cache_ops': ("taskbar_cache_ops_total", "Cache round trips of celery_progressbar_stat"),
+    'cache_bytes_written': ("taskbar_cache_bytes_written_total", "Bytes written to the cache"),
+    'db_saves': ("taskbar_db_saves_total", "DB writes of celery_progressbar_stat and report()"),
+}
+
+# The time spent in each operation is kept in microseconds since cache.incr only takes integers
+TIMERS = ('set_cache', 'msg_log', 'kill_check', 'obj_saves', 'history')
+
+
+def counter_key(slot, name):
+    return "taskbar-metrics-%s-%s" % (slot, name)
+
+
+def timer_key(slot, operation):
+    return "taskbar-metrics-%s-us-%s" % (slot, operation)
+
+
+def slot_key(slot):
+    return "taskbar-metrics-slot-%s" % slot
+
+
+def label_key(label):
+    return "taskbar-metrics-label-%s" % hashlib.md5(repr(label).encode('utf-8')).hexdigest()
+
+
+def add_to_total(key, value, timeout):
+    """
+    Adds the value to the total in the cache and creates the total if it is not there. The add is retried if
+    the total has expired in between, so no value is lost.
+    """
+    while True:
+        try:
+            return cache.incr(key, value)
+        except ValueError:
+            if cache.add(key, value, timeout):
+                return value
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exit_type, exit_value, traceback):
+        return False
+
+
+class NullMetrics(object):
+
+    """ Used when the metrics are off """
+
+    timer_context = NullTimer()
+
+    def count(self, name, value=1):
+        pass
+
+    def written(self, value):
+        pass
+
+    def timer(self, operation):
+        return self.timer_context
+
+    def push(self, force=False):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+class Timer(object):
+
+    def __init__(self, metrics, operation):
+        self.metrics = metrics
+        self.operation = operation
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, exit_type, exit_value, traceback):
+        self.metrics.timers[self.operation] += int((time() - self.start) * 1000000)
+        return False
+
+
+class TaskMetrics(object):
+
+    """ The counters and timers of one task. The task key is looked up in the CeleryTasks object of the task. """
+
+    def __init__(self, name, task_id=None):
+        self.name = name
+        self.task_id = task_id
+        # None until it is looked up
+        self.task_key = None
+        self.counters = dict((name, 0) for name in COUNTERS)
+        self.counters['tasks'] = 1
+        self.timers = dict((operation, 0) for operation in TIMERS)
+        self.last_push = time()
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def written(self, value):
+        """
+        counts one cache write of the value
+        """
+        self.counters['cache_ops'] += 1
+        if isinstance(value, str):
+            self.counters['cache_bytes_written'] += len(value)
+        else:
+            self.counters['cache_bytes_written'] += len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def timer(self, operation):
+        return Timer(self, operation)
+
+    def push(self, force=False):
+        """
+        Adds the counters to the totals in the cache and resets them
+        """
+        if not force and time() - self.last_push < TASKBAR_METRICS_PUSH_INTERVAL:
+            return
+        self.last_push = time()
+
+        try:
+            slot = register_label(self.label)
+            totals = dict((counter_key(slot, name), value) for name, value in self.counters.items())
+            totals.update((timer_key(slot, operation), value) for operation, value in self.timers.items())
+            for key, value in totals.items():
+                if value:
+                    add_to_total(key, value, TASKBAR_METRICS_CACHE_TIME)
+        except Exception:
+            # The metrics should never break the task
+            logger.error("Unable to push the taskbar metrics", exc_info=True)
+
+        self.counters = dict((name, 0) for name in COUNTERS)
+        self.timers = dict((operation, 0) for operation in TIMERS)
+
+    @property
+    def label(self):
+        """
+        The task name and the task key. The key is looked up once the CeleryTasks object of the task is there,
+        and then kept, "" included.
+        """
+        if self.task_key is None and self.task_id:
+            self.task_key = CeleryTasks.objects.filter(task_id=self.task_id).values_list('key', flat=True).first()
+        return self.name, self.task_key or ""
+
+
+def register_label(label):
+    """
+    returns the slot of the label, taking a new one if the label has none
+    """
+    slot = cache.get(label_key(label))
+    if slot is not None:
+        return slot
+
+    # The slot is taken before the label is claimed so a label is never claimed without being listed
+    slot = add_to_total(SLOTS_KEY, 1, None)
+    while not cache.add(slot_key(slot), label, None):
+        slot = add_to_total(SLOTS_KEY, 1, None)
+    if cache.add(label_key(label), slot, None):
+        return slot
+
+    # Another worker has claimed the label in the meantime
+    cache.delete(slot_key(slot))
+    return cache.get(label_key(label))
+
+
+def get_metrics(name, task_id=None):
+    return TaskMetrics(name, task_id) if TASKBAR_METRICS else NULL_METRICS
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus():
+    """
+    returns the totals of all the task names and task keys in the Prometheus text format
+    """
+    slots = range(1, (cache.get(SLOTS_KEY) or 0) + 1)
+    slot_labels = cache.get_many([slot_key(slot) for slot in slots])
+    # The slots of the labels, in case a label is in more than one
+    labels = {}
+    for slot in slots:
+        label = slot_labels.get(slot_key(slot))
+        if label is not None:
+            labels.setdefault(tuple(label), []).append(slot)
+
+    keys = []
+    for slot in slots:
+        keys.extend(counter_key(slot, name) for name in COUNTERS)
+        keys.extend(timer_key(slot, operation) for operation in TIMERS)
+    totals = cache.get_many(keys) if keys else {}
+
+    def total(key_of, label, name):
+        return sum(totals.get(key_of(slot, name), 0) for slot in labels[label])
+
+    def label_text(label):
+        return 'task="%s",key="%s"' % (escape_label(label[0]), escape_label(label[1]))
+
+    lines = []
+    for name in sorted(COUNTERS):
+        metric, help_text = COUNTERS[name]
+        lines.append("# HELP %s %s" % (metric, help_text))
+        lines.append("# TYPE %s counter" % metric)
+        for label in sorted(labels):
+            lines.append('%s{%s} %s' % (metric, label_text(label), total(counter_key, label, name)))
+
+    lines.append("# HELP taskbar_seconds_total Time spent by celery_progressbar_stat per operation")
+    lines.append("# TYPE taskbar_seconds_total counter")
+    for label in sorted(labels):
+        for operation in TIMERS:
+            lines.append('taskbar_seconds_total{%s,operation="%s"} %.6f' % (
+                label_text(label), operation, total(timer_key, label, operation) / 1000000))
+
+    return "\n".join(lines) + "\n"
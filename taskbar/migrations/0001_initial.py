@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CeleryTasks',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(db_index=True, max_length=50, unique=True, verbose_name='task id')),
+                ('status', models.CharField(db_index=True, default='waiting', max_length=40, verbose_name='state')),
+                ('creation_date', models.DateTimeField(auto_now_add=True, verbose_name='Creation Date')),
+                ('start_date', models.DateTimeField(null=True, verbose_name='Start Date')),
+                ('end_date', models.DateTimeField(default=None, null=True, verbose_name='End Date')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tasks_of_user',
+                                           to=settings.AUTH_USER_MODEL)),
+                ('key', models.CharField(blank=True, db_index=True, default='', max_length=50,
+                                         verbose_name='Task Blocking Key')),
+            ],
+            options={
+                'verbose_name': 'Task History',
+                'verbose_name_plural': 'Tasks History',
+            },
+        ),
+    ]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taskbar', '0002_celerytasks_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='celerytasks',
+            name='rolled_up',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.CreateModel(
+            name='TaskStatsBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(blank=True, default='', max_length=50, verbose_name='Task Blocking Key')),
+                ('bucket', models.DateTimeField(db_index=True, verbose_name='Bucket')),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('finished', models.PositiveIntegerField(default=0)),
+                ('error', models.PositiveIntegerField(default=0)),
+                ('killed', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0, verbose_name='must have failed')),
+                ('wait_count', models.PositiveIntegerField(default=0)),
+                ('wait_sum', models.FloatField(default=0)),
+                ('wait_max', models.FloatField(default=0)),
+                ('run_count', models.PositiveIntegerField(default=0)),
+                ('run_sum', models.FloatField(default=0)),
+                ('run_max', models.FloatField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Task Stats',
+                'verbose_name_plural': 'Task Stats',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='taskstatsbucket',
+            unique_together=set([('key', 'bucket')]),
+        ),
+        migrations.CreateModel(
+            name='TaskStatsBin',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(blank=True, default='', max_length=50, verbose_name='Task Blocking Key')),
+                ('bucket', models.DateTimeField(verbose_name='Bucket')),
+                ('metric', models.CharField(choices=[('wait', 'wait'), ('run', 'run')], max_length=4)),
+                ('bin', models.SmallIntegerField()),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='taskstatsbin',
+            unique_together=set([('key', 'bucket', 'metric', 'bin')]),
+        ),
+    ]
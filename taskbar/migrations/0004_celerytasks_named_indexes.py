@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taskbar', '0003_task_stats'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='celerytasks',
+            index_together=set(),
+        ),
+        migrations.AddIndex(
+            model_name='celerytasks',
+            index=models.Index(fields=['status', 'creation_date'], name='taskbar_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='celerytasks',
+            index=models.Index(fields=['user', 'creation_date'], name='taskbar_user_created_idx'),
+        ),
+    ]
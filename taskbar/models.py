@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.cache import cache
 from django.db import models
+from django.db.models import Count, Q
 from django.contrib.auth.models import User
+from django.utils import timezone
+from datetime import datetime, timedelta
 from taskbar.utils import datetime_difference
 
 import logging
@@ -8,12 +13,106 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+# The statuses a task does not leave anymore
+TERMINAL_STATUSES = ("finished", "error", "killed", "must have failed")
+
+# How long (seconds) the counts of the tasks of a user per status are cached
+TASKBAR_STATUS_COUNTS_CACHE_TIME = getattr(settings, 'TASKBAR_STATUS_COUNTS_CACHE_TIME', 300)
+
+# Bumped by the changes of status that touch the tasks of many users at once
+COUNTS_GENERATION_KEY = "taskbar-status-counts-generation"
+
+
+def status_counts_key(user_id):
+    return "taskbar-status-counts-%s" % user_id
+
+
+def invalidate_status_counts(user_id=None):
+    """
+    Drops the cached counts of the user. Without user_id, drops the counts of all the users.
+    """
+    if user_id is not None:
+        cache.delete(status_counts_key(user_id))
+        return
+    try:
+        cache.incr(COUNTS_GENERATION_KEY)
+    except ValueError:
+        cache.set(COUNTS_GENERATION_KEY, 1, None)
+
+
+class CeleryTasksManager(models.Manager):
+
+    def page_of_user(self, user, statuses=None, key=None, cursor=None, limit=20):
+        """
+        returns a page of the tasks of the user, newest first, and the cursor of the next page or None. Raises
+        ValueError if the cursor is not valid.
+
+        It is a keyset pagination on (user, creation_date) so every page is one range scan of that index, however
+        deep it is. The pk breaks the ties of the tasks created at the same time.
+        """
+        queryset = self.filter(user=user)
+        if statuses:
+            queryset = queryset.filter(status__in=statuses)
+        if key:
+            queryset = queryset.filter(key=key)
+
+        if cursor:
+            creation_date, pk = parse_cursor(cursor)
+            queryset = queryset.filter(Q(creation_date__lt=creation_date) | Q(creation_date=creation_date, pk__lt=pk))
+
+        # One more to know if there is a next page
+        tasks = list(queryset.order_by('-creation_date', '-pk')[:limit + 1])
+        next_cursor = make_cursor(tasks[limit - 1]) if len(tasks) > limit else None
+        return tasks[:limit], next_cursor
+
+    def status_counts(self, user):
+        """
+        returns the number of the tasks of the user per status. The counts are cached until a task of the user
+        changes its status.
+        """
+        cached = cache.get_many([status_counts_key(user.id), COUNTS_GENERATION_KEY])
+        generation = cached.get(COUNTS_GENERATION_KEY, 0)
+        counts = cached.get(status_counts_key(user.id))
+        if counts is not None and counts[0] == generation:
+            return counts[1]
+
+        counts = dict(self.filter(user=user).values_list('status').annotate(Count('pk')).order_by())
+        cache.set(status_counts_key(user.id), (generation, counts), TASKBAR_STATUS_COUNTS_CACHE_TIME)
+        return counts
+
+
+def epoch():
+    if settings.USE_TZ:
+        return timezone.make_aware(datetime(1970, 1, 1), timezone.get_fixed_timezone(0))
+    return datetime(1970, 1, 1)
+
+
+def make_cursor(task):
+    """
+    returns the cursor after the task: its creation_date in microseconds since the epoch and its pk. It has
+    nothing to escape in a URL and keeps the exact creation_date.
+    """
+    delta = task.creation_date - epoch()
+    return "%d_%d" % ((delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds, task.pk)
+
+
+def parse_cursor(cursor):
+    """
+    returns the creation_date and the pk in the cursor. Raises ValueError if the cursor is not valid.
+    """
+    try:
+        microseconds, pk = cursor.split("_")
+        return epoch() + timedelta(microseconds=int(microseconds)), int(pk)
+    except (AttributeError, OverflowError, ValueError):
+        raise ValueError("Invalid cursor %r" % cursor)
+
+
 class CeleryTasks(models.Model):
 
     """
     Keeps track of celery Tasks
     """
-    # objects = GenericManager()
+    objects = CeleryTasksManager()
 
     task_id = models.CharField(
         'task id', max_length=50, unique=True, db_index=True)
@@ -22,9 +121,11 @@ class CeleryTasks(models.Model):
     creation_date = models.DateTimeField('Creation Date', auto_now_add=True)
     start_date = models.DateTimeField('Start Date', null=True)
     end_date = models.DateTimeField('End Date', default=None, null=True)
-    user = models.ForeignKey(User, related_name="tasks_of_user")
+    user = models.ForeignKey(User, related_name="tasks_of_user", on_delete=models.CASCADE)
     key = models.CharField(
         "Task Blocking Key", max_length=50, db_index=True, default="", blank=True)
+    # Set once the task has been added to the TaskStatsBucket of its key by rollup_task_stats
+    rolled_up = models.BooleanField(default=False, db_index=True)
 
     @property
     def duration(self):
@@ -41,6 +142,55 @@ class CeleryTasks(models.Model):
     class Meta:
         verbose_name_plural = 'Tasks History'
         verbose_name = 'Task History'
+        # The history is listed by status or by user, newest first
+        indexes = [
+            models.Index(fields=["status", "creation_date"], name="taskbar_status_created_idx"),
+            models.Index(fields=["user", "creation_date"], name="taskbar_user_created_idx"),
+        ]
 
     def __unicode__(self):
         return "%s: %s" % (self.task_id, self.status)
+
+
+class TaskStatsBucket(models.Model):
+
+    """
+    The rollup of the ended tasks of a key that were created in one time bucket (see taskbar.analytics)
+    """
+    key = models.CharField("Task Blocking Key", max_length=50, default="", blank=True)
+    bucket = models.DateTimeField('Bucket', db_index=True)
+    total = models.PositiveIntegerField(default=0)
+    finished = models.PositiveIntegerField(default=0)
+    error = models.PositiveIntegerField(default=0)
+    killed = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField('must have failed', default=0)
+    # Seconds between the creation and the start of the tasks, and between their start and their end
+    wait_count = models.PositiveIntegerField(default=0)
+    wait_sum = models.FloatField(default=0)
+    wait_max = models.FloatField(default=0)
+    run_count = models.PositiveIntegerField(default=0)
+    run_sum = models.FloatField(default=0)
+    run_max = models.FloatField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'Task Stats'
+        verbose_name = 'Task Stats'
+        unique_together = (("key", "bucket"),)
+
+    def __unicode__(self):
+        return "%s: %s" % (self.key, self.bucket)
+
+
+class TaskStatsBin(models.Model):
+
+    """
+    The number of the tasks of a TaskStatsBucket whose wait or run time falls in a bin of the histogram
+    """
+    key = models.CharField("Task Blocking Key", max_length=50, default="", blank=True)
+    bucket = models.DateTimeField('Bucket')
+    metric = models.CharField(max_length=4, choices=(("wait", "wait"), ("run", "run")))
+    bin = models.SmallIntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (("key", "bucket", "metric", "bin"),)
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+The message log of a task is kept in the cache as numbered segments of a fixed maximum size plus an index.
+The index is the list of the offsets where each segment starts. It is only rewritten when a segment is sealed.
+
+The clients keep polling with the offset (msg_index) of the last message they have. So a poll only fetches the
+segments that have anything after that offset instead of the whole history of the task.
+
+The sealed segments are compressed with zlib. Only the last TASKBAR_MSG_MAX_SIZE characters or so are kept: once
+there are more segments than that, the oldest ones are dropped. A client whose offset is in a dropped segment gets
+the log from the first segment that is kept, after TRUNCATED_MARKER. The offsets never change so the cursors of
+the clients stay valid.
+"""
+from __future__ import print_function, absolute_import, division
+
+import uuid
+import zlib
+from bisect import bisect_right
+from time import sleep, time
+from django.conf import settings
+from django.core.cache import cache
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+TASKBAR_MSG_SEGMENT_SIZE = getattr(settings, 'TASKBAR_MSG_SEGMENT_SIZE', 64 * 1024)
+TASKBAR_MSG_MAX_SIZE = getattr(settings, 'TASKBAR_MSG_MAX_SIZE', 1024 * 1024)
+
+TRUNCATED_MARKER = "<p class='taskbar-truncated'>[The earlier messages are not kept]</p>"
+
+
+def index_key(task_id):
+    return "celery-%s-msg-idx" % task_id
+
+
+def segment_key(task_id, number):
+    return "celery-%s-msg-%s" % (task_id, number)
+
+
+def parse_index(value):
+    """
+    returns the index as the offsets where the segments start and the number of the first segment that is kept
+    """
+    if not value:
+        return [0], 0
+    if isinstance(value, list):
+        # Written before the old segments were dropped
+        return value, 0
+    return value
+
+
+def compress(segment):
+    return ("zlib", zlib.compress(segment.encode('utf-8')))
+
+
+def decompress(segment):
+    if isinstance(segment, tuple):
+        return zlib.decompress(segment[1]).decode('utf-8')
+    return segment or ""
+
+
+def segments_after(index, offset):
+    """
+    returns the numbers of the kept segments that have any data at or after the offset
+    """
+    starts, first = index
+    return list(range(max(bisect_right(starts, offset) - 1, first), len(starts)))
+
+
+def chunk_keys(task_id, index, offset):
+    """
+    returns the cache keys of the segments that need to be fetched to read the log from the offset
+    """
+    return [segment_key(task_id, number) for number in segments_after(index, offset)]
+
+
+def join_chunk(task_id, index, offset, segments, end=None):
+    """
+    Joins the fetched segments and returns the log from the offset up to the end offset.
+    segments is a dictionary of the segment cache keys to their values as returned by cache.get_many
+
+    end should be the msg_index of the stat that is sent along with the chunk. The clients move their offset to
+    that msg_index, so what has been appended after the stat was written is left for their next poll.
+    """
+    numbers = segments_after(index, offset)
+    chunk = "".join(decompress(segments.get(segment_key(task_id, number))) for number in numbers)
+    start = index[0][numbers[0]]
+    stop = None if end is None else max(end - start, 0)
+    if offset < start:
+        return TRUNCATED_MARKER + chunk[:stop]
+    return chunk[offset - start:stop]
+
+
+def read_from(task_id, offset, index=None, end=None):
+    """
+    returns the log of the task from the offset up to the end offset. index is the index of the log if it is
+    already fetched.
+    """
+    if index is None:
+        index = parse_index(cache.get(index_key(task_id)))
+    segments = cache.get_many(chunk_keys(task_id, index, offset))
+    return join_chunk(task_id, index, offset, segments, end)
+
+
+class MessageLog(object):
+
+    """ The writer side of the message log of a task.
+
+        There is only one writer per task so the length of the log, the index and the current segment are kept
+        in memory.
+    """
+
+    def __init__(self, task_id, cache_time=3000, segment_size=None, max_size=None):
+        self.task_id = task_id
+        self.cache_time = cache_time
+        self.segment_size = segment_size or TASKBAR_MSG_SEGMENT_SIZE
+        max_size = max_size or TASKBAR_MSG_MAX_SIZE
+        # None keeps all the segments
+        self.max_segments = max(max_size // self.segment_size, 1) if max_size else None
+        self.starts = [0]
+        self.first = 0
+        self.length = 0
+        self.current = ""
+
+    @property
+    def index(self):
+        return self.starts, self.first
+
+    def reset(self):
+        self.starts = [0]
+        self.first = 0
+        self.length = 0
+        self.current = ""
+        cache.set_many({segment_key(self.task_id, 0): "", index_key(self.task_id): self.index}, self.cache_time)
+
+    def append(self, val):
+        current_start = self.starts[-1]
+        current_length = self.length - current_start
+
+        if current_length and current_length + len(val) > self.segment_size:
+            # sealing the current segment and starting a new one
+            sealed = len(self.starts) - 1
+            values = {segment_key(self.task_id, sealed): compress(self.sealed_segment()),
+                      segment_key(self.task_id, sealed + 1): val}
+            self.starts.append(self.length)
+
+            dropped = []
+            while self.max_segments and len(self.starts) - self.first > self.max_segments:
+                dropped.append(segment_key(self.task_id, self.first))
+                self.first += 1
+
+            values[index_key(self.task_id)] = self.index
+            cache.set_many(values, self.cache_time)
+            if dropped:
+                cache.delete_many(dropped)
+            self.current = val
+        else:
+            cache.append(segment_key(self.task_id, len(self.starts) - 1), val)
+            self.current += val
+
+        self.length += len(val)
+
+    def sealed_segment(self):
+        return self.current
+
+    def close(self, cache_time=60):
+        """
+        Empties the log. The index remains for cache_time so the clients that are still polling read empty chunks.
+        """
+        keys = [segment_key(self.task_id, number) for number in range(self.first, len(self.starts))]
+        cache.delete_many(keys)
+        cache.set(index_key(self.task_id), self.index, cache_time)
+
+
+def length_key(task_id):
+    return "celery-%s-msg-len" % task_id
+
+
+def lock_key(task_id):
+    return "celery-%s-msg-lock" % task_id
+
+
+class SharedMessageLog(MessageLog):
+
+    """ The message log of a parent task that its child tasks write to as well.
+
+        The length of the log and the index are kept in the cache and every append takes a short lock, so the
+        segments stay in the order of the offsets. The current segment is read back from the cache to seal it.
+        The readers get the length from length_key instead of the msg_index of the parent's stat.
+
+        A writer that can't get the lock within lock_timeout seconds drops its message rather than write without
+        it, and counts it in dropped.
+    """
+
+    lock_timeout = 5
+
+    def __init__(self, *args, **kwargs):
+        super(SharedMessageLog, self).__init__(*args, **kwargs)
+        self.dropped = 0
+
+    def reset(self):
+        super(SharedMessageLog, self).reset()
+        cache.set(length_key(self.task_id), 0, self.cache_time)
+
+    def share(self):
+        """
+        Publishes the length of a log that was written by a single writer so far
+        """
+        cache.set(length_key(self.task_id), self.length, self.cache_time)
+
+    def append(self, val):
+        token = self.acquire()
+        if token is None:
+            self.dropped += 1
+            logger.warning("Could not lock the message log of %s. Dropped the message, %s so far."
+                           % (self.task_id, self.dropped))
+            return
+
+        try:
+            cached = cache.get_many([index_key(self.task_id), length_key(self.task_id)])
+            self.starts, self.first = parse_index(cached.get(index_key(self.task_id)))
+            self.length = cached.get(length_key(self.task_id)) or 0
+            self.current = ""
+            super(SharedMessageLog, self).append(val)
+            cache.set(length_key(self.task_id), self.length, self.cache_time)
+        finally:
+            self.release(token)
+
+    def sealed_segment(self):
+        return cache.get(segment_key(self.task_id, len(self.starts) - 1)) or ""
+
+    def acquire(self):
+        """
+        returns the token the lock was taken with, or None if it could not be taken within lock_timeout seconds
+        """
+        token = uuid.uuid4().hex
+        deadline = time() + self.lock_timeout
+        while not cache.add(lock_key(self.task_id), token, self.lock_timeout):
+            if time() > deadline:
+                return None
+            sleep(.01)
+        return token
+
+    def release(self, token):
+        # Once the lock has expired, another writer can hold it
+        if cache.get(lock_key(self.task_id)) == token:
+            cache.delete(lock_key(self.task_id))
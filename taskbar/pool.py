@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Aggregates the progress of the workers of a thread or process pool that a task fans out to.
+
+The workers don't touch the celery_progressbar_stat. They add to a shared counter and put their messages on a
+queue. A reporter thread in the task merges them into the stat once per interval, so the stat has one writer and
+the cache is written at a fixed rate however many workers there are.
+
+With threads:
+
+    with PoolProgress(c_stat, total=len(items)) as progress:
+        with ThreadPoolExecutor(8) as executor:
+            for result in executor.map(lambda item: work(item, progress), items):
+                ...
+
+    def work(item, progress):
+        ...
+        progress.advance()
+
+With processes, the workers get the counter and the queue through the initializer of the pool:
+
+    with PoolProgress(c_stat, total=len(items), processes=True) as progress:
+        pool = multiprocessing.Pool(4, initializer=taskbar.pool.init_worker, initargs=progress.worker_args)
+        pool.map(work, items)
+
+    def work(item):
+        ...
+        taskbar.pool.advance()
+
+Terminating the task sets the stopped flag of the workers and raises SystemExit in the task when the block ends.
+"""
+from __future__ import print_function, absolute_import, division
+
+import multiprocessing
+import threading
+
+from django.conf import settings
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+TASKBAR_POOL_FLUSH_INTERVAL = getattr(settings, 'TASKBAR_POOL_FLUSH_INTERVAL', 1)
+
+
+class WorkerProgress(object):
+
+    """ What the workers report through """
+
+    def __init__(self, done, stop, messages):
+        self.done = done
+        self.stop = stop
+        self.messages = messages
+
+    @property
+    def worker_args(self):
+        return self.done, self.stop, self.messages
+
+    def advance(self, count=1):
+        with self.done.get_lock():
+            self.done.value += count
+
+    def report(self, msg):
+        """
+        Adds the message to the message log of the task, like c_stat.err
+        """
+        self.messages.put(msg)
+
+    @property
+    def stopped(self):
+        """
+        True once the task is terminated. The workers should stop then.
+        """
+        return bool(self.stop.value)
+
+
+class PoolProgress(WorkerProgress):
+
+    """ Merges the progress of the workers into the stat of the task in a reporter thread.
+
+        total is the number of items the workers go through. The percent moves across the current stage of the
+        stat (see celery_progressbar_stat.stage). The stat should not be used by the task itself inside the block.
+    """
+
+    def __init__(self, c_stat, total, interval=None, processes=False):
+        super(PoolProgress, self).__init__(multiprocessing.Value('q', 0), multiprocessing.Value('b', 0),
+                                           multiprocessing.Queue() if processes else queue.Queue())
+        self.c_stat = c_stat
+        self.total = total
+        self.interval = TASKBAR_POOL_FLUSH_INTERVAL if interval is None else interval
+        self.base, self.span = c_stat.stages[-1][0], c_stat.stages[-1][1]
+        self.last_percent = int(c_stat.percent)
+        self.finished = threading.Event()
+        self.thread = None
+
+    # The final flush waits this long (seconds) for the messages that are still on their way from the worker
+    # processes
+    drain_timeout = .1
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exit_type, exit_value, traceback):
+        # An error of the block is not replaced by the SystemExit of a kill
+        self.join(raise_killed=exit_type is None)
+        return False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="taskbar-pool-progress")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.finished.wait(self.interval):
+            self.flush()
+
+    def join(self, raise_killed=True):
+        """
+        Stops the reporter thread and merges what is left. Raises SystemExit if the task was terminated.
+        """
+        self.finished.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush(final=True)
+        if raise_killed and self.stopped:
+            raise SystemExit
+
+    def drain_messages(self, final=False):
+        """
+        returns the queued messages. The final drain blocks for a moment on an empty queue, since a message that a
+        process has put may still be in the feeder thread of the queue.
+        """
+        messages = []
+        while True:
+            try:
+                if final:
+                    messages.append(self.messages.get(timeout=self.drain_timeout))
+                else:
+                    messages.append(self.messages.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def flush(self, final=False):
+        if self.stopped:
+            return
+        try:
+            # All the messages go to the log in one append and to the cache with the percent in one write
+            messages = self.drain_messages(final)
+            if messages:
+                self.c_stat.add_errs(messages, write=False)
+
+            percent = int(self.base + self.span * min(self.done.value, self.total) / self.total) if self.total else 0
+            if percent > self.last_percent:
+                self.last_percent = percent
+                # Checks the kill flag too
+                self.c_stat.percent = percent
+            else:
+                if messages:
+                    self.c_stat.set_cache()
+                if self.c_stat.kill:
+                    raise SystemExit
+        except SystemExit:
+            self.stop.value = 1
+        except Exception:
+            # The reporter thread should never take the task down
+            logger.error("Unable to report the progress of the pool of task %s" % self.c_stat.task_id,
+                         exc_info=True)
+
+
+# Set in the worker processes by init_worker
+worker_progress = None
+
+
+def init_worker(done, stop, messages):
+    """
+    The initializer of the pool processes. initargs is PoolProgress.worker_args.
+    """
+    global worker_progress
+    worker_progress = WorkerProgress(done, stop, messages)
+
+
+def advance(count=1):
+    worker_progress.advance(count)
+
+
+def report(msg):
+    worker_progress.report(msg)
+
+
+def stopped():
+    return worker_progress.stopped
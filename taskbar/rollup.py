@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Rolls up the progress of child tasks (for example the tasks of a celery group or chord) into their parent.
+
+The parent declares how many children it has with celery_progressbar_stat.add_children before sending them.
+Each child is created with parent_id and adds the change of its integer percent to the parent's percent sum
+with cache.incr. It also counts itself as done on exit. The children's messages are appended to the
+parent's message log. So a poll of the parent reads a couple of counters along with the parent's stat and
+never looks at the children's stats.
+
+A parent that exits before its children keeps its CeleryTasks object active and its task key lock. It leaves
+its end status in the cache and whichever of it and its last child sees the other done ends the job.
+"""
+from __future__ import print_function, absolute_import, division
+
+from django.core.cache import cache
+
+from taskbar import msglog
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def percent_sum_key(task_id):
+    return "celery-%s-children-percent" % task_id
+
+
+def done_key(task_id):
+    return "celery-%s-children-done" % task_id
+
+
+def failed_key(task_id):
+    return "celery-%s-children-failed" % task_id
+
+
+def changes_key(task_id):
+    return "celery-%s-children-changes" % task_id
+
+
+def count_key(task_id):
+    return "celery-%s-children-count" % task_id
+
+
+def ended_key(task_id):
+    return "celery-%s-ended" % task_id
+
+
+def ending_key(task_id):
+    return "celery-%s-ending" % task_id
+
+
+def rollup_keys(task_id):
+    """
+    The keys that are read along with the stat of a task in case it has children
+    """
+    return [percent_sum_key(task_id), done_key(task_id), failed_key(task_id), changes_key(task_id),
+            msglog.length_key(task_id)]
+
+
+def init_counters(task_id, cache_time):
+    for key in (percent_sum_key(task_id), done_key(task_id), failed_key(task_id), changes_key(task_id),
+                count_key(task_id)):
+        cache.add(key, 0, cache_time)
+
+
+def incr(key, delta, cache_time):
+    """
+    cache.incr that creates the key if it has expired or was never added. If another child creates it in
+    between, the incr is tried again so no delta is lost.
+    """
+    while True:
+        try:
+            return cache.incr(key, delta)
+        except ValueError:
+            if cache.add(key, delta, cache_time):
+                return delta
+
+
+def changed(task_id, cache_time):
+    """
+    Bumps the counter of the changes the children have made to the parent's stat
+    """
+    incr(changes_key(task_id), 1, cache_time)
+
+
+def rollup_version(version, msg_index, cached, task_id):
+    """
+    returns the version and the msg_index of the parent's stat with the counters of its children
+    """
+    changes = cached.get(changes_key(task_id)) or 0
+    length = cached.get(msglog.length_key(task_id)) or 0
+    # The parent's version, the changes and the length of the log only grow, so the sum does too
+    return version + changes + length, max(msg_index, length)
+
+
+def parent_ended(task_id, status, user_id, cache_time):
+    """
+    Records the end status of a parent whose children might still be running. returns True if they have all
+    ended and the parent should end the job itself.
+    """
+    cache.set(ended_key(task_id), (status, user_id), cache_time)
+    cached = cache.get_many([done_key(task_id), count_key(task_id)])
+    if (cached.get(done_key(task_id)) or 0) < (cached.get(count_key(task_id)) or 0):
+        return False
+    return claim_end(task_id, cache_time)
+
+
+def child_ended(parent_id, done, cache_time):
+    """
+    returns the end status and the user id of the parent if the child that has just made the done count of the
+    parent reach done is the last one and the parent has ended, otherwise None. The caller then ends the job.
+    """
+    cached = cache.get_many([count_key(parent_id), ended_key(parent_id)])
+    ended = cached.get(ended_key(parent_id))
+    if ended is None or done < (cached.get(count_key(parent_id)) or 0):
+        return None
+    return ended if claim_end(parent_id, cache_time) else None
+
+
+def claim_end(task_id, cache_time):
+    """
+    Makes sure only one of the parent and its children ends the job
+    """
+    return cache.add(ending_key(task_id), 1, cache_time)
+
+
+def apply_rollup(task_stat, cached, task_id):
+    """
+    Replaces the percent, msg_index, status and version of the parent's stat with the rolled up values
+    """
+    children = task_stat['children']
+    percent_sum = cached.get(percent_sum_key(task_id)) or 0
+    done = cached.get(done_key(task_id)) or 0
+
+    task_stat['progress_percent'] = min(100, percent_sum // children)
+    task_stat['version'], task_stat['msg_index'] = rollup_version(
+        task_stat.get('version', 0), task_stat['msg_index'], cached, task_id)
+    task_stat['children_done'] = done
+    task_stat['children_failed'] = cached.get(failed_key(task_id)) or 0
+    # The rate of the parent's own percent says nothing about its children
+    task_stat['percent_per_sec'] = task_stat['items_per_sec'] = task_stat['eta'] = None
+
+    # The parent itself might have finished while its children are still running
+    if done < children and task_stat.get('status') == "finished":
+        task_stat['status'] = "active"
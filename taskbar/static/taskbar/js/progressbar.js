@@ -75,6 +75,8 @@ function progress_class(options){
   var previous_sticky_msg = "";
   var msg_index_client = 0;
   var previous_msg_index_client = 0;
+  var etag = null;
+  var poll_interval = sec;
 
 
 
@@ -107,6 +109,17 @@ function progress_class(options){
   };
 
 
+  // follows the poll_after (seconds) that task_api recommends
+  var reschedule = function(poll_after) {
+    var interval = poll_after ? poll_after * 1000 : sec;
+    if (interval !== poll_interval) {
+      poll_interval = interval;
+      clearInterval(progressbar_updator);
+      progressbar_updator = setInterval(function() { get_task_status(); }, poll_interval);
+    }
+  };
+
+
   var terminate_progressbar = function() {
     clearInterval(progressbar_updator);
     setTimeout( function(){progressbar.parent().parent().remove();} , 100 );
@@ -125,9 +138,17 @@ function progress_class(options){
       url: "/generics/task_api",
       type: "POST",
       cache: false,
-      data: {id: the_id, terminate: terminate, msg_index_client: msg_index_client}
+      data: {id: the_id, terminate: terminate, msg_index_client: msg_index_client},
+      headers: etag ? {"If-None-Match": etag} : {}
       } )
-      .done(function(celery_respone) {  //?? I changed (celery_respone, s) to (celery_respone)
+      .done(function(celery_respone, text_status, xhr) {  //?? I changed (celery_respone, s) to (celery_respone, text_status, xhr)
+
+        // 304: the task stat has not changed since the last poll
+        if (xhr.status === 304) {
+          waiting = false;
+          return;
+        }
+        etag = xhr.getResponseHeader("ETag");
 
         if (celery_respone !== null) {
           if (celery_respone.msg !== null && celery_respone.msg !=="") {
@@ -151,6 +172,7 @@ function progress_class(options){
             }
             $("#tasks_sticky_msg").html(celery_respone.sticky_msg);
           }
+          reschedule(celery_respone.poll_after);
           if (celery_respone.is_killed === true || celery_respone.progress_percent == 100 ){
             terminate_progressbar();
           }
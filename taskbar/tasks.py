@@ -2,11 +2,18 @@
 from __future__ import print_function, absolute_import, division
 
 from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Max, Min, Q
 from django.utils import timezone
 from django.contrib.auth.models import User
-from time import sleep
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from time import time
 import re
-from taskbar.models import CeleryTasks
+from taskbar import analytics, locks, rollup
+from taskbar.backends import get_backend
+from taskbar.metrics import NULL_METRICS, get_metrics
+from taskbar.models import CeleryTasks, TERMINAL_STATUSES, invalidate_status_counts
 
 import logging
 logger = logging.getLogger(__name__)
@@ -15,6 +22,41 @@ logger.setLevel(logging.INFO)
 
 LOG_MSG_MAX_LENGTH = getattr(settings, 'LOG_MSG_MAX_LENGTH', None)
 
+# The fields that report and clean_err set on the objects
+ERR_FIELDS = ["err_fields", "is_fine", "err_msg", ]
+
+# Buffering of the error field saves of report and clean_err. When it is on, the changes are written with
+# bulk_update once TASKBAR_ERR_SAVE_BATCH_SIZE objects are pending or TASKBAR_ERR_SAVE_INTERVAL seconds have
+# passed, and when the task exits.
+TASKBAR_BUFFER_ERR_SAVES = getattr(settings, 'TASKBAR_BUFFER_ERR_SAVES', False)
+TASKBAR_ERR_SAVE_BATCH_SIZE = getattr(settings, 'TASKBAR_ERR_SAVE_BATCH_SIZE', 500)
+TASKBAR_ERR_SAVE_INTERVAL = getattr(settings, 'TASKBAR_ERR_SAVE_INTERVAL', 5)
+
+# Coalescing of the progress writes. When either of these is set, the changes to the task stat are kept in memory
+# and only written to the cache once the interval (in seconds) has passed or the percent moved by the given delta.
+TASKBAR_MIN_WRITE_INTERVAL = getattr(settings, 'TASKBAR_MIN_WRITE_INTERVAL', None)
+TASKBAR_MIN_PERCENT_DELTA = getattr(settings, 'TASKBAR_MIN_PERCENT_DELTA', None)
+
+# The kill flag is only read from the cache once per this many seconds. It is the deadline for a terminate
+# request sent from task_api to reach the task (plus the time until the task's next percent update or report).
+TASKBAR_KILL_CHECK_INTERVAL = getattr(settings, 'TASKBAR_KILL_CHECK_INTERVAL', 1)
+
+# The rate and the ETA are computed over the last TASKBAR_RATE_WINDOW samples of the percent. A sample is taken
+# when the percent changes, at most once per TASKBAR_RATE_SAMPLE_INTERVAL seconds. A task is reported as stalled
+# once its percent has not changed for TASKBAR_RATE_STALL_FACTOR times the average gap between its changes.
+TASKBAR_RATE_WINDOW = getattr(settings, 'TASKBAR_RATE_WINDOW', 10)
+TASKBAR_RATE_SAMPLE_INTERVAL = getattr(settings, 'TASKBAR_RATE_SAMPLE_INTERVAL', 1)
+TASKBAR_RATE_STALL_FACTOR = getattr(settings, 'TASKBAR_RATE_STALL_FACTOR', 3)
+
+# While the integer percent stays the same, track() checks the kill flag once per this many seconds
+TASKBAR_TRACK_INTERVAL = getattr(settings, 'TASKBAR_TRACK_INTERVAL', 1)
+
+# Used by purge_task_history: the tasks that are still waiting or active after TASKBAR_HISTORY_STALE_HOURS are
+# marked as "must have failed" and the ones older than TASKBAR_HISTORY_RETENTION_HOURS are deleted.
+TASKBAR_HISTORY_STALE_HOURS = getattr(settings, 'TASKBAR_HISTORY_STALE_HOURS', 24)
+TASKBAR_HISTORY_RETENTION_HOURS = getattr(settings, 'TASKBAR_HISTORY_RETENTION_HOURS', 600)
+TASKBAR_PURGE_BATCH_SIZE = getattr(settings, 'TASKBAR_PURGE_BATCH_SIZE', 1000)
+
 # Trying to load celery
 try:
     from celery import shared_task, current_task
@@ -43,55 +85,101 @@ class celery_progressbar_stat(object):
 
         During setting percentage and during reporting, we check to see if is_killed flag is set in the cache.
         In that case, we terminate the task.
+
+        Writes to the cache can be coalesced by passing min_interval (seconds) and/or min_percent_delta.
+        The changes are then batched in memory and flushed once either threshold is reached.
+        The final state is always flushed on exit, including when the task is terminated by an error.
+
+        The kill flag is read at most once per kill_check_interval seconds.
+
+        With TASKBAR_METRICS on, the cache round trips, bytes written, DB saves and the time spent in them are
+        counted per task name and task key. See taskbar.metrics.
+
+        For jobs that are split into child tasks (celery groups or chords), the parent calls add_children before
+        sending them and each child is created with parent_id. The children's percent and messages are rolled up
+        into the parent, which task_api reports as usual. A terminate of the parent reaches the children too.
+        See taskbar.rollup.
+
+        The stat carries percent_per_sec and eta (seconds) and, if c_stat.total is set to the number of items,
+        items_per_sec.
+
+        The stat, the kill flag and the message log are kept by the backend set with TASKBAR_BACKEND.
+        See taskbar.backends.
+
+        With buffer_saves, the error fields that report and clean_err set on the objects are saved in batches
+        with bulk_update instead of one save per object.
+
+        Instead of setting the percent in a loop, the items can be passed through track, which only sets the
+        percent when its integer value changes. The task can be split into weighted stages:
+
+        with c_stat.stage(20):
+            rows = [row for row in c_stat.track(reader, total=row_count)]
+        with c_stat.stage(80):
+            for row in c_stat.track(rows):
+                process(row)
     """
 
-    def __init__(self, task, user_id, cache_time=3000):
+    def __init__(self, task, user_id, cache_time=3000, min_interval=None, min_percent_delta=None,
+                 kill_check_interval=None, parent_id=None, buffer_saves=None):
         self.task_id = task.request.id
-        # user is used by other code that deal with celery progress bar
-        self.user = User.objects.get(id=user_id)
+        self.user_id = user_id
+        self.metrics = get_metrics(getattr(task, "name", None) or "unknown", self.task_id)
         self.task_stat_id = "celery-stat-%s" % self.task_id
         self.task_kill_id = "celery-kill-%s" % self.task_id
-        self.task_msg_all_id = "celery-%s-msg-all" % self.task_id
         self.cache_time = cache_time
+        self.backend = get_backend()
+        self.msg_log = self.backend.message_log(self.task_id, cache_time)
         self.result = {'msg': "IN PROGRESS", 'sticky_msg': '', 'progress_percent': 0, 'is_killed': False,
-                       'user_id': user_id, 'msg_index': 0, }
+                       'user_id': user_id, 'msg_index': 0, 'status': "active", 'version': 0, }
         self.last_err = ""
         self.last_err_type = None
         self.fatal = False
+        self.init_coalescing(min_interval, min_percent_delta)
+        self.init_parent(parent_id)
+        self.init_kill_check(kill_check_interval)
+        self.init_rate()
+        self.init_stages()
+        self.init_saves(buffer_saves)
 
         self.msg = ""
-        cache.set(self.task_msg_all_id, "", self.cache_time)
+        with self.metrics.timer("msg_log"):
+            self.msg_log.reset()
+        self.metrics.count("cache_ops")
 
-        # Normally we want to have created the CeleryTasks object before even the task is run. Reason: if the task is in the queue, we want to know that.
-        # In that case these lines are not even run yet! However, we need some delay here before the task is created and the CeleryTasks object created
-        # so we can get the object. Otherwise it can't "get" the object and it
-        # thinks it doesn't exist
+        with self.metrics.timer("history"):
+            self.start_task_history()
+        self.metrics.count("db_saves")
 
-        for j in range(1, 10):
-            sleep(.3)
-            try:
-                self.celery_task_history_obj = CeleryTasks.objects.get(
-                    task_id=self.task_id)
-                break
-            except CeleryTasks.DoesNotExist:
-                pass
-
-        if j >= 9:
-            raise Exception("Could not get the celery_task_history_obj")
-
-        self.celery_task_history_obj.status = "active"
-        self.celery_task_history_obj.start_date = timezone.now()
-        self.celery_task_history_obj.save(
-            update_fields=["status", "start_date"])
+    def start_task_history(self):
+        """
+        Marks the CeleryTasks object of the task as active.
+
+        Normally progressbarit creates the object right after sending the task to celery, so we know about the task
+        while it is in the queue. But the task can start before that, in which case we create the object here and
+        progressbarit fills in the task key. Either way it is one indexed write and no waiting.
+        """
         now = timezone.now()
-        try:
-            CeleryTasks.objects.filter(creation_date__lte=now - timezone.timedelta(hours=24),
-                                       status__in=["active", "waiting"]).update(status="must have failed")
-            CeleryTasks.objects.filter(
-                creation_date__lte=now - timezone.timedelta(hours=600)).delete()
-        except:
-            logger.error(
-                "Error in cleaning up CeleryTasks History", exc_info=True)
+        if not CeleryTasks.objects.filter(task_id=self.task_id).update(status="active", start_date=now):
+            try:
+                with transaction.atomic():
+                    CeleryTasks.objects.create(task_id=self.task_id, user_id=self.user_id, status="active",
+                                               start_date=now)
+            except IntegrityError:
+                # progressbarit created it in the meantime
+                CeleryTasks.objects.filter(task_id=self.task_id).update(status="active", start_date=now)
+        invalidate_status_counts(self.user_id)
+
+    @property
+    def user(self):
+        # user is used by other code that deal with celery progress bar. It is only fetched if needed.
+        if not hasattr(self, "_user"):
+            self._user = User.objects.get(id=self.user_id)
+        return self._user
+
+    @property
+    def celery_task_history_obj(self):
+        # Kept for the code that used to read the object off the stat. We don't hold it anymore.
+        return CeleryTasks.objects.get(task_id=self.task_id)
 
     def __enter__(self):
         return self
@@ -99,7 +187,7 @@ class celery_progressbar_stat(object):
     def __exit__(self, exit_type, exit_value, traceback):
 
         if exit_type == SystemExit:
-            self.celery_task_history_obj.status = "killed"
+            status = "killed"
             # killed by error but we still set is_killed to true
             self.is_killed = True
             self.sticky_msg = "%s [Task Terminated]" % self.msg
@@ -107,21 +195,53 @@ class celery_progressbar_stat(object):
                 self.last_err, self.msg), exc_info=True)
 
         elif exit_type:
-            self.celery_task_history_obj.status = "error"
+            status = "error"
             self.sticky_msg = "%s [Task Terminated]" % self.msg
             # killed by error but we still set is_killed to true
             self.is_killed = True
             logger.error("Task terminated in error: %s, message: %s" %
                          (self.last_err, self.msg), exc_info=True)
         else:
-            self.celery_task_history_obj.status = "finished"
+            status = "finished"
 
-        self.celery_task_history_obj.end_date = timezone.now()
-        self.celery_task_history_obj.save(update_fields=["status", "end_date"])
+        try:
+            self.flush_saves()
+        except Exception:
+            logger.error("Unable to save the error fields of the objects of task %s" % self.task_id, exc_info=True)
 
-        # The cache to remain for another minute
-        cache.replace(self.task_stat_id, self.result, time=60)
-        cache.replace(self.task_msg_all_id, "", time=60)
+        # A parent keeps its history active and its task key lock until its last child has ended
+        if self.result.get("children"):
+            ends_job = rollup.parent_ended(self.task_id, status, self.user_id, self.cache_time)
+        else:
+            ends_job = True
+        if ends_job:
+            with self.metrics.timer("history"):
+                end_task_history(self.task_id, self.user_id, status)
+            self.metrics.count("db_saves")
+        self.result["status"] = status
+
+        if self.parent_id:
+            self.report_to_parent(100)
+            if status != "finished":
+                rollup.incr(rollup.failed_key(self.parent_id), 1, self.cache_time)
+            done = rollup.incr(rollup.done_key(self.parent_id), 1, self.cache_time)
+            rollup.changed(self.parent_id, self.cache_time)
+            parent_ended = rollup.child_ended(self.parent_id, done, self.cache_time)
+            if parent_ended:
+                parent_status, parent_user_id = parent_ended
+                end_task_history(self.parent_id, parent_user_id, parent_status)
+
+        if self.result.get("children"):
+            # The children are still reporting to the stat and the log of the parent
+            self.flush()
+        else:
+            # The cache to remain for another minute. We set it rather than replace it since with coalescing on,
+            # the stat might not have been written yet.
+            self.flush(cache_time=60)
+            with self.metrics.timer("msg_log"):
+                self.msg_log.close(cache_time=60)
+            self.metrics.count("cache_ops", 2)
+        self.metrics.push(force=True)
 
         # exit should return True once done
         return True
@@ -134,7 +254,9 @@ class celery_progressbar_stat(object):
             raise SystemExit
 
         self.result["progress_percent"] = val
-        self.set_cache()
+        self.sample_rate(val)
+        # The last percent should never wait for the next flush
+        self.set_cache(force=val >= 100)
 
     def get_msg(self):
         return self.result["msg"]
@@ -147,11 +269,24 @@ class celery_progressbar_stat(object):
         return self.last_err
 
     def set_err(self, val):
-        self.last_err = val
-        val = "<hr class='line-seperator'><p>%s</p>" % val
-        self.result["msg_index"] += len(val)
-        self.set_cache()
-        cache.append(self.task_msg_all_id, val)
+        self.add_errs([val])
+
+    def add_errs(self, vals, write=True):
+        """
+        Adds the messages to the message log with one append, like setting err to each of them. With write=False
+        the stat is left for the next write.
+        """
+        self.last_err = vals[-1]
+        val = "".join("<hr class='line-seperator'><p>%s</p>" % val for val in vals)
+        # The log is written before the stat so a client never gets a msg_index that is ahead of the log
+        with self.metrics.timer("msg_log"):
+            self.msg_log.append(val)
+            if self.parent_log:
+                self.parent_log.append(val)
+        self.metrics.written(val)
+        self.result["msg_index"] = self.msg_log.length
+        if write:
+            self.set_cache()
 
     def get_sticky_msg(self):
         return self.result["sticky_msg"]
@@ -165,16 +300,232 @@ class celery_progressbar_stat(object):
 
     def set_is_killed(self, val):
         self.result["is_killed"] = val
-        self.set_cache()
+        self.set_cache(force=True)
+
+    def init_kill_check(self, kill_check_interval):
+        self.kill_check_interval = TASKBAR_KILL_CHECK_INTERVAL if kill_check_interval is None else kill_check_interval
+        self.last_kill_check = 0
+        self.kill_seen = False
+
+    def is_kill_check_due(self):
+        return not self.kill_seen and time() - self.last_kill_check >= self.kill_check_interval
+
+    def kill_ids(self):
+        # Terminating the parent terminates its children
+        return [self.task_id, self.parent_id] if self.parent_id else [self.task_id]
 
     def get_kill(self):
-        return cache.get(self.task_kill_id)
+        # Kills are rare so we don't want a cache round trip on every update. Once the flag is seen, it sticks.
+        if self.is_kill_check_due():
+            self.last_kill_check = time()
+            with self.metrics.timer("kill_check"):
+                self.kill_seen = self.backend.read_kill(self.kill_ids())
+            self.metrics.count("cache_ops")
+        return self.kill_seen
+
+    def init_parent(self, parent_id):
+        self.parent_id = parent_id
+        self.parent_percent = 0
+        self.parent_log = self.backend.message_log(parent_id, self.cache_time, shared=True) if parent_id else None
+
+    def add_children(self, count):
+        """
+        Declares that the task has count more child tasks, which are created with parent_id=task_id of this task.
+        Call it before sending the children to celery.
+        """
+        if not self.result.get("children"):
+            rollup.init_counters(self.task_id, self.cache_time)
+            # From now on the children write to our log too
+            self.msg_log = self.backend.share_log(self.msg_log, self.cache_time)
+
+        rollup.incr(rollup.count_key(self.task_id), count, self.cache_time)
+        self.result["children"] = self.result.get("children", 0) + count
+        self.set_cache(force=True)
+
+    def init_rate(self):
+        # The number of items the task goes through, if known
+        self.total = None
+        self.rate_samples = deque([(time(), self.result["progress_percent"])], maxlen=TASKBAR_RATE_WINDOW)
+        self.result.update({'percent_per_sec': None, 'items_per_sec': None, 'eta': None})
+
+    def sample_rate(self, percent):
+        """
+        Records a change of the percent. The last sample is always the latest change: within the sample interval
+        it is moved forward instead of adding one.
+        """
+        now = time()
+        last_time, last_percent = self.rate_samples[-1]
+        if percent == last_percent:
+            return
+        if percent < last_percent:
+            # Started over, the older samples say nothing about the rate from here
+            self.rate_samples.clear()
+        elif len(self.rate_samples) > 1 and now - self.rate_samples[-2][0] < TASKBAR_RATE_SAMPLE_INTERVAL:
+            self.rate_samples.pop()
+        self.rate_samples.append((now, percent))
+
+    def update_rate(self):
+        """
+        Sets the rate and the ETA in the stat from the samples in the window. There is no rate until the percent
+        has changed. A task that has not changed for TASKBAR_RATE_STALL_FACTOR times the average gap between its
+        changes gets a rate of 0 and no ETA.
+        """
+        first_time, first_percent = self.rate_samples[0]
+        last_time, last_percent = self.rate_samples[-1]
+        elapsed = last_time - first_time
+        if elapsed <= 0 or last_percent <= first_percent:
+            self.result.update({'percent_per_sec': None, 'items_per_sec': None, 'eta': None})
+            return
+
+        now = time()
+        gap = elapsed / (len(self.rate_samples) - 1)
+        if last_percent < 100 and now - last_time > TASKBAR_RATE_STALL_FACTOR * max(gap, TASKBAR_RATE_SAMPLE_INTERVAL):
+            self.result["percent_per_sec"] = 0
+            self.result["items_per_sec"] = 0 if self.total else None
+            self.result["eta"] = None
+            return
+
+        rate = (last_percent - first_percent) / elapsed
+        self.result["percent_per_sec"] = round(rate, 4)
+        self.result["items_per_sec"] = round(rate * self.total / 100, 2) if self.total else None
+        self.result["eta"] = max(int((100 - last_percent) / rate - (now - last_time)), 0)
+
+    def init_stages(self):
+        # The base percent, the span and the part (in percent) that the sub stages have used of each open stage
+        self.stages = [[0, 100, 0]]
+
+    @contextmanager
+    def stage(self, weight):
+        """
+        A part of the task that takes weight percent of the stage it is in, after the stages before it.
+        The percent moves to the end of the stage once it is done.
+        """
+        parent = self.stages[-1]
+        base = parent[0] + parent[1] * parent[2] / 100
+        span = parent[1] * weight / 100
+        self.stages.append([base, span, 0])
+        try:
+            yield self
+        finally:
+            self.stages.pop()
+
+        parent[2] += weight
+        end = int(base + span)
+        if end > self.percent:
+            self.percent = end
+
+    def track(self, iterable, total=None, interval=None):
+        """
+        Yields the items of the iterable and moves the percent across the current stage as they are consumed.
+        total is the number of items, len(iterable) by default. The percent is only set when its integer value
+        changes, otherwise the kill flag is checked once per interval seconds. Without a total the percent does
+        not move.
+        """
+        if total is None:
+            try:
+                total = len(iterable)
+            except TypeError:
+                total = None
+        if total and len(self.stages) == 1 and self.total is None:
+            self.total = total
+        interval = TASKBAR_TRACK_INTERVAL if interval is None else interval
+        base, span = self.stages[-1][0], self.stages[-1][1]
+
+        last_percent = int(self.percent)
+        last_check = time()
+        done = 0
+        for item in iterable:
+            yield item
+            done += 1
+
+            if total:
+                percent = int(base + span * min(done, total) / total)
+                if percent > last_percent:
+                    last_percent, last_check = percent, time()
+                    self.percent = percent
+                    continue
+
+            if time() - last_check >= interval:
+                last_check = time()
+                if self.kill:
+                    raise SystemExit
+
+    def report_to_parent(self, percent=None):
+        """
+        Adds the change of the integer percent since the last report to the parent's percent sum
+        """
+        if percent is None:
+            percent = self.result["progress_percent"]
+        percent = min(int(percent), 100)
+        delta = percent - self.parent_percent
+        if delta:
+            rollup.incr(rollup.percent_sum_key(self.parent_id), delta, self.cache_time)
+            rollup.changed(self.parent_id, self.cache_time)
+            self.parent_percent = percent
+            self.metrics.count("cache_ops", 2)
 
     # def set_kill(self, val):
     #     cache.set(self.task_kill_id, True, 60 * 5)
 
-    def set_cache(self):
-        cache.set(self.task_stat_id, self.result, time=self.cache_time)
+    def init_coalescing(self, min_interval, min_percent_delta):
+        self.min_interval = TASKBAR_MIN_WRITE_INTERVAL if min_interval is None else min_interval
+        self.min_percent_delta = TASKBAR_MIN_PERCENT_DELTA if min_percent_delta is None else min_percent_delta
+        self.coalesce = self.min_interval is not None or self.min_percent_delta is not None
+        self.dirty = False
+        self.last_flush_time = 0
+        self.last_flush_percent = 0
+        # What the backend has of the stat, for the backends that write only the changed fields
+        self.written = {}
+
+    def is_flush_due(self):
+        if self.min_interval is not None and time() - self.last_flush_time >= self.min_interval:
+            return True
+        if self.min_percent_delta is not None and \
+                abs(self.result["progress_percent"] - self.last_flush_percent) >= self.min_percent_delta:
+            return True
+        return False
+
+    def set_cache(self, force=False):
+        if self.coalesce and not force:
+            self.dirty = True
+            if not self.is_flush_due():
+                return
+        self.flush()
+
+    def flush(self, cache_time=None):
+        """
+        Writes the task stat to the cache regardless of the coalescing thresholds
+        """
+        # The version lets the readers know the stat has changed without comparing the whole stat
+        self.result["version"] += 1
+        self.update_rate()
+        # The backends that can, check the kill flag in the same round trip
+        kill_ids = self.kill_ids() if self.backend.piggyback_kill and self.is_kill_check_due() else None
+        with self.metrics.timer("set_cache"):
+            killed = self.backend.write_stat(self.task_id, self.result, cache_time or self.cache_time,
+                                             changed=self.changed_fields(), kill_ids=kill_ids)
+        self.metrics.written(self.result)
+        if killed is not None:
+            self.last_kill_check = time()
+            self.kill_seen = killed
+        # Once the task has exited, it has reported 100 to the parent whatever its last percent was
+        if self.parent_id and self.result["status"] == "active":
+            self.report_to_parent()
+        self.dirty = False
+        self.last_flush_time = time()
+        self.last_flush_percent = self.result["progress_percent"]
+        self.metrics.push()
+
+    def changed_fields(self):
+        """
+        returns the fields of the stat that changed since the last write, or None if the backend writes them all
+        """
+        if not self.backend.partial_writes:
+            return None
+        changed = dict((key, value) for key, value in self.result.items()
+                       if key not in self.written or self.written[key] != value)
+        self.written = dict(self.result)
+        return changed
 
     def report(self, msg, e=None, obj=None, field=None, fatal=False, sticky_msg="", log_level="info"):
         # msg is what the user sees. e is the actual error that was raised.
@@ -214,8 +565,7 @@ class celery_progressbar_stat(object):
                     else:
                         setattr(obj, "err_msg", msg)
 
-                    obj.save(
-                        update_fields=["err_fields", "is_fine", "err_msg", ])
+                    self.save_err_fields(obj)
                 except:
                     self.msg = "Unable to set object's error fields. The model is not properly set up."
 
@@ -247,7 +597,7 @@ class celery_progressbar_stat(object):
                 setattr(obj, "is_fine", True)
 
             if save:
-                obj.save(update_fields=["err_fields", "is_fine", "err_msg", ])
+                self.save_err_fields(obj)
                 msg = "obj err fields cleanup and saving obj %s" % obj.pk
                 logger.info(msg)
                 print(msg)
@@ -261,6 +611,73 @@ class celery_progressbar_stat(object):
             logger.error(self.msg)
             print(self.msg)
 
+    def init_saves(self, buffer_saves):
+        self.buffer_saves = TASKBAR_BUFFER_ERR_SAVES if buffer_saves is None else buffer_saves
+        # model: {pk: the values of ERR_FIELDS}, in the order the objects were first reported
+        self.pending_saves = {}
+        self.pending_count = 0
+        self.last_saves_flush = time()
+
+    def save_err_fields(self, obj):
+        # An object that is not in the database yet cannot be updated in bulk
+        if not self.buffer_saves or obj.pk is None:
+            with self.metrics.timer("obj_saves"):
+                obj.save(update_fields=ERR_FIELDS)
+            self.metrics.count("db_saves")
+            return
+
+        # The values are copied so the saved ones are the ones at the time of the call, as with obj.save
+        pending = self.pending_saves.setdefault(type(obj), OrderedDict())
+        if obj.pk not in pending:
+            self.pending_count += 1
+        pending[obj.pk] = dict((field, getattr(obj, field)) for field in ERR_FIELDS)
+
+        if self.pending_count >= TASKBAR_ERR_SAVE_BATCH_SIZE or \
+                time() - self.last_saves_flush >= TASKBAR_ERR_SAVE_INTERVAL:
+            self.flush_saves()
+
+    def flush_saves(self):
+        """
+        Writes the pending error fields, one bulk_update per model. If a bulk_update fails, the objects of the model
+        are saved one by one so a single bad object does not lose the changes of the others.
+        """
+        self.last_saves_flush = time()
+        for model in list(self.pending_saves):
+            pending = self.pending_saves[model]
+            objs = [model(pk=pk, **values) for pk, values in pending.items()]
+            with self.metrics.timer("obj_saves"):
+                if hasattr(model.objects, "bulk_update"):
+                    try:
+                        with transaction.atomic():
+                            model.objects.bulk_update(objs, ERR_FIELDS, batch_size=TASKBAR_ERR_SAVE_BATCH_SIZE)
+                        saves = -(-len(objs) // TASKBAR_ERR_SAVE_BATCH_SIZE)
+                    except Exception:
+                        logger.warning("Unable to save the error fields of %s in bulk, saving them one by one" %
+                                       model.__name__, exc_info=True)
+                        saves = self.save_one_by_one(objs)
+                else:
+                    # Django < 2.2
+                    saves = self.save_one_by_one(objs)
+            self.metrics.count("db_saves", saves)
+            del self.pending_saves[model]
+            self.pending_count -= len(pending)
+
+    def save_one_by_one(self, objs):
+        """
+        Saves the error fields of the objects and returns how many saves it took. The objects that cannot be
+        saved are logged and dropped.
+        """
+        saves = 0
+        for obj in objs:
+            try:
+                with transaction.atomic():
+                    obj.save(update_fields=ERR_FIELDS)
+            except Exception:
+                logger.error("Unable to save the error fields of %s %s" % (type(obj).__name__, obj.pk),
+                             exc_info=True)
+            saves += 1
+        return saves
+
     percent = property(get_percent, set_percent,)
     msg = property(get_msg, set_msg,)
     err = property(get_err, set_err,)
@@ -279,15 +696,23 @@ class celery_progressbar_stat_dummy(celery_progressbar_stat):
 
     def __init__(self, task, user_id, cache_time=200):
         self.result = {'msg': "IN PROGRESS", 'sticky_msg': '', 'progress_percent': 0, 'is_killed': False,
-                       'user_id': user_id, 'msg_index': 0, }
-        self.user = User.objects.get(id=user_id)
+                       'user_id': user_id, 'msg_index': 0, 'status': "active", 'version': 0, }
+        self.user_id = user_id
         self.last_err = ""
         self.task_id = "test id"
-        self.task_msg_all_id = "celery-%s-msg-all" % self.task_id
+        self.metrics = NULL_METRICS
+        self.backend = get_backend()
+        self.msg_log = self.backend.message_log(self.task_id, cache_time)
         self.task_kill_id = "celery-kill-%s" % self.task_id
         self.task_stat_id = "celery-stat-%s" % self.task_id
         self.last_err_type = None
         self.fatal = False
+        self.init_coalescing(None, None)
+        self.init_parent(None)
+        self.init_kill_check(None)
+        self.init_rate()
+        self.init_stages()
+        self.init_saves(False)
 
     def __enter__(self):
         return self
@@ -295,7 +720,10 @@ class celery_progressbar_stat_dummy(celery_progressbar_stat):
     def __exit__(self, exit_type, exit_value, traceback):
         pass
 
-    def set_cache(self):
+    def set_cache(self, force=False):
+        pass
+
+    def flush(self, cache_time=None):
         pass
 
     def report(self, msg, e=None, obj=None, field=None, fatal=False, sticky_msg="", log_level="info"):
@@ -314,6 +742,122 @@ class celery_progressbar_stat_dummy(celery_progressbar_stat):
             ipdb.set_trace()
 
 
+def end_task_history(task_id, user_id, status):
+    """
+    Marks the CeleryTasks object of the task with its end status and releases the task key lock of the task
+    """
+    CeleryTasks.objects.filter(task_id=task_id).update(status=status, end_date=timezone.now())
+    invalidate_status_counts(user_id)
+    locks.release_for_task(task_id)
+
+
+def in_pk_batches(queryset, action, batch_size):
+    """
+    Runs the action (update or delete) on the queryset in batches of primary key ranges so no single
+    statement scans or locks the whole table. Returns the total of what the action returns for the batches.
+    """
+    pk_range = queryset.aggregate(Min('pk'), Max('pk'))
+    low, high = pk_range['pk__min'], pk_range['pk__max']
+    total = 0
+    if low is None:
+        return total
+
+    while low <= high:
+        total += action(queryset.filter(pk__gte=low, pk__lt=low + batch_size))
+        low += batch_size
+
+    return total
+
+
+def delete_batch(queryset):
+    deleted = queryset.delete()
+    # Django < 1.9 does not return the number of deleted objects
+    return deleted[0] if deleted else 0
+
+
+def mark_failed(queryset):
+    tasks = list(queryset.exclude(key="").values_list('task_id', 'key'))
+    marked = queryset.update(status="must have failed")
+    # The tasks will never release their key locks themselves
+    for task_id, key in tasks:
+        locks.release_if_owner(key, task_id)
+    return marked
+
+
+@shared_task
+def purge_task_history(stale_hours=None, retention_hours=None, batch_size=None):
+    """
+    Marks the stale tasks as "must have failed", releasing their task key locks, and deletes the old CeleryTasks
+    objects. It is meant to be run periodically, for example with celery beat.
+
+    The ended tasks are only deleted once they are in the task stats. They are rolled up right before the delete,
+    and the ones that could not be (another rollup was running) are left for the next run.
+    """
+    stale_hours = TASKBAR_HISTORY_STALE_HOURS if stale_hours is None else stale_hours
+    retention_hours = TASKBAR_HISTORY_RETENTION_HOURS if retention_hours is None else retention_hours
+    batch_size = TASKBAR_PURGE_BATCH_SIZE if batch_size is None else batch_size
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    now = timezone.now()
+
+    stale_tasks = CeleryTasks.objects.filter(creation_date__lte=now - timezone.timedelta(hours=stale_hours),
+                                             status__in=["active", "waiting"])
+    marked = in_pk_batches(stale_tasks, mark_failed, batch_size)
+
+    analytics.rollup_task_stats()
+    old_tasks = CeleryTasks.objects.filter(Q(rolled_up=True) | ~Q(status__in=TERMINAL_STATUSES),
+                                           creation_date__lte=now - timezone.timedelta(hours=retention_hours))
+    deleted = in_pk_batches(old_tasks, delete_batch, batch_size)
+    if marked or deleted:
+        invalidate_status_counts()
+
+    logger.info("CeleryTasks History cleanup: %s marked as failed, %s deleted" % (marked, deleted))
+    return {'marked': marked, 'deleted': deleted}
+
+
+@shared_task
+def rollup_task_stats(batch_size=None):
+    """
+    Adds the tasks that have ended since the last run to the task stats (see taskbar.analytics).
+    It is meant to be run periodically, for example with celery beat.
+    """
+    rolled_up = analytics.rollup_task_stats(batch_size)
+    logger.info("Task stats rollup: %s tasks rolled up" % rolled_up)
+    return {'rolled_up': rolled_up}
+
+
+def terminate_tasks(queryset):
+    """
+    Terminates the tasks of the queryset that are waiting or active and returns how many there were.
+
+    The kill flags of all of them are set at once. The running tasks see theirs at their next check. The waiting
+    ones would only see it once they start, so they are revoked with one broadcast to the workers and marked as
+    killed with one UPDATE.
+    """
+    tasks = list(queryset.filter(status__in=["waiting", "active"]).values_list('task_id', 'status', 'key', 'user_id'))
+    if not tasks:
+        return 0
+
+    get_backend().set_kills([task_id for task_id, status, key, user_id in tasks], 60 * 5)
+
+    waiting = [(task_id, key, user_id) for task_id, status, key, user_id in tasks if status == "waiting"]
+    if waiting:
+        from celery import current_app
+        current_app.control.revoke([task_id for task_id, key, user_id in waiting])
+        # The ones that have started in the meantime get killed by their flag
+        CeleryTasks.objects.filter(task_id__in=[task_id for task_id, key, user_id in waiting],
+                                   status="waiting").update(status="killed", end_date=timezone.now())
+
+        # The revoked tasks never exit so they can't release their locks
+        for task_id, key, user_id in waiting:
+            if key:
+                locks.release_if_owner(key, task_id)
+        for user_id in set(user_id for task_id, key, user_id in waiting):
+            invalidate_status_counts(user_id)
+
+    return len(tasks)
+
+
 @shared_task
 def test_progressbar(user_id=1):
     from time import sleep
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+from django.db import models
+
+
+class Row(models.Model):
+
+    """ An object with the error fields that report and clean_err set """
+
+    name = models.CharField(max_length=50)
+    err_fields = models.TextField(default="", blank=True)
+    is_fine = models.BooleanField(default=True)
+    err_msg = models.TextField(default="", blank=True)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import, division
+
+from django.contrib.admin import site
+from django.utils import timezone
+
+from taskbar import admin
+from taskbar.models import CeleryTasks
+from taskbar.tests.utils import TaskbarTestCase
+
+
+class CeleryTasksAdminTest(TaskbarTestCase):
+
+    def test_live_stats(self):
+        c_stat = self.start_task()
+        c_stat.percent = 30
+        live_stats = admin.get_live_stats([c_stat.task_id, "missing"])
+        self.assertEqual(live_stats[c_stat.task_id]['progress_percent'], 30)
+        self.assertIsNone(live_stats["missing"])
+
+    def test_duration(self):
+        c_stat = self.start_task()
+        CeleryTasks.objects.filter(task_id=c_stat.task_id).update(
+            end_date=timezone.now() + timezone.timedelta(minutes=2, seconds=5))
+        model_admin = admin.CeleryTasksAdmin(CeleryTasks, site)
+        # The duration is computed by the database
+        history = model_admin.get_queryset(self.factory.get('/')).get(task_id=c_stat.task_id)
+        self.assertEqual(model_admin.duration(history), "00:02:05")
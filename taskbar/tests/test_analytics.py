@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import, division
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from taskbar import analytics
+from taskbar.models import CeleryTasks, TaskStatsBin
+from taskbar.tests.utils import TaskbarTestCase
+
+
+class AnalyticsTest(TaskbarTestCase):
+
+    def make_task(self, key, status, wait, run):
+        created = timezone.now().replace(minute=0, second=0, microsecond=0) - timezone.timedelta(hours=1)
+        start = created + timezone.timedelta(seconds=wait)
+        history = CeleryTasks.objects.create(task_id="%s-%s" % (key, CeleryTasks.objects.count()), user=self.user,
+                                             key=key, status=status)
+        # creation_date is auto_now_add
+        CeleryTasks.objects.filter(pk=history.pk).update(
+            creation_date=created, start_date=start, end_date=start + timezone.timedelta(seconds=run))
+
+    def test_rollup(self):
+        for number in range(10):
+            self.make_task("job", "finished", 1, number + 1)
+        self.make_task("job", "error", 1, 100)
+        self.make_task("job", "killed", 1, 100)
+        self.make_task("job", "active", 1, 100)
+
+        self.assertEqual(analytics.rollup_task_stats(batch_size=5), 12)
+        self.assertEqual(analytics.rollup_task_stats(), 0)
+
+        stats = analytics.task_stats(keys=["job"])
+        self.assertEqual(len(stats), 1)
+        item = stats[0]
+        self.assertEqual((item['total'], item['finished'], item['error'], item['killed']), (12, 10, 1, 1))
+        self.assertAlmostEqual(item['failure_rate'], 1 / 12)
+        self.assertEqual(item['run']['count'], 12)
+        self.assertEqual(item['run']['max'], 100)
+        # Within the width of a bin
+        self.assertAlmostEqual(item['run']['p50'], 6, delta=6 * .1)
+        self.assertAlmostEqual(item['wait']['p99'], 1, delta=.1)
+
+    def test_rollups_are_added_to(self):
+        self.make_task("job", "finished", 1, 1)
+        analytics.rollup_task_stats()
+        self.make_task("job", "finished", 1, 1)
+        analytics.rollup_task_stats()
+
+        self.assertEqual(analytics.task_stats()[0]['total'], 2)
+        self.assertEqual(TaskStatsBin.objects.get(metric="run").count, 2)
+
+    def test_group_by_bucket(self):
+        self.make_task("job", "finished", 1, 1)
+        self.make_task("other", "finished", 1, 1)
+        analytics.rollup_task_stats()
+        stats = analytics.task_stats(group=("bucket",))
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['total'], 2)
+
+    def test_one_rollup_at_a_time(self):
+        self.make_task("job", "finished", 1, 1)
+        cache.add(analytics.ROLLUP_LOCK_KEY, 1)
+        self.assertEqual(analytics.rollup_task_stats(), 0)
+
+    def test_percentiles(self):
+        self.assertEqual(analytics.percentiles({}), {'p50': None, 'p90': None, 'p99': None})
+        histogram = {analytics.time_bin(1): 90, analytics.time_bin(10): 10}
+        result = analytics.percentiles(histogram, max_value=9)
+        self.assertAlmostEqual(result['p50'], 1, delta=.1)
+        self.assertEqual(result['p99'], 9)
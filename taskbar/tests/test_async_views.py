@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import, division
+
+import json
+import unittest
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+
+from taskbar import views
+from taskbar.tests.utils import FakeTask, TaskbarTestCase
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+try:
+    from asgiref.sync import async_to_sync
+    from taskbar import async_views
+except (ImportError, ImproperlyConfigured, SyntaxError):
+    async_views = None
+
+
+@unittest.skipIf(async_views is None, "taskbar.async_views needs asgiref and Django 3.1 or later")
+class AsyncViewsTest(TaskbarTestCase):
+
+    def call(self, view, user=None, **params):
+        request = self.factory.get('/', params)
+        request.user = user or self.user
+        # The sync code of the views runs in this thread, which has the connection to the test database
+        return async_to_sync(view)(request)
+
+    def test_same_json_as_the_sync_view(self):
+        c_stat = self.start_task()
+        c_stat.percent = 30
+        c_stat.err = "hello"
+        params = {'id': c_stat.task_id, 'msg_index_client': 0}
+        self.assertEqual(json.loads(self.call(async_views.task_api, **params).content),
+                         json.loads(self.get(views.task_api, **params).content))
+
+    def test_waiting_task(self):
+        task = FakeTask()
+        views.register_task(self.user, task.request.id, "")
+        response = self.call(async_views.task_api, id=task.request.id, msg_index_client=0)
+        self.assertEqual(json.loads(response.content)['status'], "waiting")
+
+    def test_batch_of_waiting_tasks(self):
+        task = FakeTask()
+        views.register_task(self.user, task.request.id, "")
+        request = self.factory.get('/', {'id': [task.request.id]})
+        request.user = self.user
+        task_stats = json.loads(async_to_sync(async_views.task_batch_api)(request).content)
+        self.assertEqual(task_stats, json.loads(views.task_batch_api(request).content))
+        self.assertEqual(task_stats[task.request.id]['status'], "waiting")
+
+    def test_task_of_another_user(self):
+        c_stat = self.start_task()
+        other = User.objects.create_user('other')
+        self.assertEqual(self.call(async_views.task_api, user=other, id=c_stat.task_id, msg_index_client=0)
+                         .status_code, 401)
+
+    async def read_stream(self, task_id):
+        request = self.factory.get('/', {'id': task_id})
+        request.user = self.user
+        response = await async_views.task_stream(request)
+        return [event async for event in response.streaming_content]
+
+    @unittest.skipIf(async_views is None or not async_views.ASYNC_STREAMING, "needs Django 4.2 or later")
+    def test_stream_polls_the_version(self):
+        c_stat = self.start_task()
+        c_stat.err = "one"
+        with mock.patch.object(views, 'TASKBAR_STREAM_TIMEOUT', .05), \
+                mock.patch.object(views, 'TASKBAR_STREAM_INTERVAL', .01), \
+                mock.patch.object(async_views, 'get_task_stats', wraps=async_views.get_task_stats) as get_task_stats:
+            events = async_to_sync(self.read_stream)(c_stat.task_id)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(get_task_stats.call_count, 1)
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import, division
+
+import unittest
+
+from django.contrib.auth.models import User
+
+from taskbar import backends, msglog
+from taskbar.backends import INVALID_MSG_INDEX, get_backend
+from taskbar.tests.utils import TaskbarTestCase
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+try:
+    from celery import Celery
+except ImportError:
+    Celery = None
+
+
+class DjangoCacheBackendTest(TaskbarTestCase):
+
+    def read(self, c_stat, msg_index=0, user=None):
+        return get_backend().read_task_stats(user or self.user, [c_stat.task_id], [msg_index])[c_stat.task_id]
+
+    def test_stat_of_another_user(self):
+        c_stat = self.start_task()
+        other = User.objects.create_user('other')
+        self.assertIsNone(self.read(c_stat, user=other))
+
+    def test_chunk_after_the_cursor(self):
+        c_stat = self.start_task()
+        c_stat.err = "one"
+        msg_index = self.read(c_stat)['msg_index']
+        c_stat.err = "two"
+
+        task_stat = self.read(c_stat, msg_index)
+        self.assertNotIn("one", task_stat['msg_chunk'])
+        self.assertIn("two", task_stat['msg_chunk'])
+        self.assertNotIn('msg_chunk', self.read(c_stat, task_stat['msg_index']))
+
+    def test_chunk_stops_at_the_msg_index_of_the_stat(self):
+        # With coalescing, the log can be ahead of the stat. The rest is left for the next poll.
+        c_stat = self.start_task(min_interval=1000)
+        c_stat.err = "one"
+        c_stat.set_cache(force=True)
+        c_stat.err = "two"
+
+        task_stat = self.read(c_stat)
+        self.assertIn("one", task_stat['msg_chunk'])
+        self.assertNotIn("two", task_stat['msg_chunk'])
+
+        c_stat.set_cache(force=True)
+        chunk = self.read(c_stat, task_stat['msg_index'])['msg_chunk']
+        self.assertEqual((chunk.count("one"), chunk.count("two")), (0, 1))
+
+    def test_invalid_msg_index(self):
+        c_stat = self.start_task()
+        self.assertEqual(self.read(c_stat, "x")['msg_chunk'], INVALID_MSG_INDEX)
+
+    def test_read_version(self):
+        c_stat = self.start_task()
+        c_stat.percent = 10
+        version = get_backend().read_version(self.user, c_stat.task_id)
+        self.assertEqual(version, (c_stat.result['version'], c_stat.result['msg_index']))
+        c_stat.percent = 20
+        self.assertNotEqual(get_backend().read_version(self.user, c_stat.task_id), version)
+        self.assertIsNone(get_backend().read_version(User.objects.create_user('other'), c_stat.task_id))
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class RedisBackendTest(TaskbarTestCase):
+
+    def setUp(self):
+        super(RedisBackendTest, self).setUp()
+        self.client = fakeredis.FakeStrictRedis()
+        self.client.flushall()
+        backends.backend = backends.RedisBackend(client=self.client)
+
+    def read(self, c_stat, msg_index=0):
+        return get_backend().read_task_stats(self.user, [c_stat.task_id], [msg_index])[c_stat.task_id]
+
+    def test_writes_only_the_changed_fields(self):
+        c_stat = self.start_task()
+        with mock.patch.object(get_backend(), 'write_stat', wraps=get_backend().write_stat) as write_stat:
+            c_stat.percent = 30
+        changed = write_stat.call_args[1]['changed']
+        self.assertIn('progress_percent', changed)
+        self.assertNotIn('user_id', changed)
+        self.assertNotIn('sticky_msg', changed)
+        self.assertEqual(self.read(c_stat)['progress_percent'], 30)
+
+    def test_kill_is_read_with_the_write(self):
+        c_stat = self.start_task(kill_check_interval=0)
+        get_backend().set_kill(c_stat.task_id)
+        c_stat.msg = "working"
+        self.assertTrue(c_stat.kill_seen)
+        with self.assertRaises(SystemExit):
+            c_stat.percent = 10
+
+    def test_expired_stat_is_written_whole(self):
+        c_stat = self.start_task()
+        c_stat.percent = 10
+        self.client.delete(get_backend().stat_key(c_stat.task_id))
+        c_stat.percent = 20
+
+        task_stat = self.read(c_stat)
+        self.assertEqual(task_stat['progress_percent'], 20)
+        self.assertEqual(task_stat['user_id'], self.user.id)
+
+    def test_read_version(self):
+        c_stat = self.start_task()
+        c_stat.err = "one"
+        self.assertEqual(get_backend().read_version(self.user, c_stat.task_id),
+                         (c_stat.result['version'], self.read(c_stat)['msg_index']))
+        self.assertIsNone(get_backend().read_version(User.objects.create_user('other'), c_stat.task_id))
+
+    def test_msg_index_counts_the_messages(self):
+        c_stat = self.start_task()
+        for number in range(5):
+            c_stat.err = "m%s" % number
+
+        task_stat = self.read(c_stat)
+        self.assertEqual(task_stat['msg_index'], 5)
+        self.assertEqual(task_stat['msg_chunk'].count("<p>m"), 5)
+        chunk = self.read(c_stat, 3)['msg_chunk']
+        self.assertEqual((chunk.count("m2"), chunk.count("m3"), chunk.count("m4")), (0, 1, 1))
+
+    def test_append_between_the_reads(self):
+        c_stat = self.start_task()
+        for number in range(3):
+            c_stat.err = "m%s" % number
+
+        read_chunks = get_backend().read_chunks
+
+        def append_first(wanted):
+            c_stat.err = "late"
+            return read_chunks(wanted)
+
+        with mock.patch.object(get_backend(), 'read_chunks', append_first):
+            task_stat = self.read(c_stat, 1)
+        self.assertEqual(task_stat['msg_index'], 3)
+        self.assertNotIn("late", task_stat['msg_chunk'])
+        self.assertIn("m2", task_stat['msg_chunk'])
+        self.assertIn("late", self.read(c_stat, 3)['msg_chunk'])
+
+    def test_log_is_trimmed(self):
+        c_stat = self.start_task()
+        c_stat.msg_log.max_size = 200
+        for number in range(20):
+            c_stat.err = "m%02d" % number
+
+        list_key = backends.RedisMessageLog.list_key(c_stat.task_id)
+        messages = self.client.lrange(list_key, 0, -1)
+        self.assertLessEqual(sum(len(message) for message in messages), 200)
+        self.assertEqual(int(self.client.get(backends.RedisMessageLog.size_key(c_stat.task_id))),
+                         sum(len(message) for message in messages))
+
+        chunk = self.read(c_stat)['msg_chunk']
+        self.assertTrue(chunk.startswith(msglog.TRUNCATED_MARKER))
+        self.assertIn("m19", chunk)
+        self.assertEqual(self.read(c_stat, 18)['msg_chunk'].count("<p>m"), 2)
+
+
+@unittest.skipIf(Celery is None, "celery is not installed")
+class CeleryResultBackendTest(TaskbarTestCase):
+
+    def setUp(self):
+        super(CeleryResultBackendTest, self).setUp()
+        self.app = Celery('taskbar-tests', backend='cache+memory://')
+        patcher = mock.patch.object(backends.CeleryResultBackend, 'result_backend', new_callable=mock.PropertyMock,
+                                    return_value=self.app.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        backends.backend = backends.CeleryResultBackend()
+
+    def test_metas_are_read_at_once(self):
+        running, returned = self.start_task(), self.start_task()
+        running.percent = 30
+        returned.percent = 40
+        self.app.backend.store_result(returned.task_id, 5, "SUCCESS")
+        missing = "missing-task"
+
+        with mock.patch.object(self.app.backend, 'get_task_meta') as get_task_meta:
+            task_stats = get_backend().read_stats([running.task_id, returned.task_id, missing])
+        self.assertFalse(get_task_meta.called)
+        self.assertEqual(task_stats[running.task_id]['progress_percent'], 30)
+        # From the CeleryTasks object once the task has returned
+        self.assertEqual(task_stats[returned.task_id]['status'], "active")
+        self.assertIsNone(task_stats[missing])
+
+    def test_other_result_backends(self):
+        c_stat = self.start_task()
+        c_stat.percent = 30
+        result_backend = mock.Mock(spec=['get_task_meta'])
+        result_backend.get_task_meta.return_value = {'status': "PROGRESS", 'result': c_stat.result}
+        with mock.patch.object(backends.CeleryResultBackend, 'result_backend', new_callable=mock.PropertyMock,
+                               return_value=result_backend):
+            task_stats = get_backend().read_stats([c_stat.task_id])
+        self.assertEqual(task_stats[c_stat.task_id]['progress_percent'], 30)
+
+    def read(self, c_stat, msg_index=0):
+        return get_backend().read_task_stats(self.user, [c_stat.task_id], [msg_index])[c_stat.task_id]
+
+    def test_log_tail_in_the_meta(self):
+        c_stat = self.start_task()
+        c_stat.msg_log.max_size = 30
+        for number in range(3):
+            c_stat.err = "m%s" % number
+
+        with mock.patch.object(backends.cache, 'get_many') as get_many:
+            task_stat = self.read(c_stat)
+        self.assertFalse(get_many.called)
+        self.assertNotIn('msg_tail', task_stat)
+        self.assertTrue(task_stat['msg_chunk'].startswith(msglog.TRUNCATED_MARKER))
+        self.assertEqual(task_stat['msg_chunk'].count("<p>m"), 1)
+        self.assertNotIn('msg_chunk', self.read(c_stat, task_stat['msg_index']))
+        self.assertEqual(self.read(c_stat, "x")['msg_chunk'], INVALID_MSG_INDEX)
+
+    def test_log_of_a_parent(self):
+        c_stat = self.start_task()
+        c_stat.err = "one"
+        c_stat.add_children(1)
+        c_stat.err = "two"
+        chunk = self.read(c_stat)['msg_chunk']
+        self.assertIn("one", chunk)
+        self.assertIn("two", chunk)
+
+    def test_kill_revokes_the_task(self):
+        c_stat = self.start_task()
+        with mock.patch('celery.app.control.Control.revoke') as revoke:
+            get_backend().set_kill(c_stat.task_id)
+        revoke.assert_called_once_with([c_stat.task_id])
+
+        # The writes leave the REVOKED state alone until the task sees it
+        c_stat.flush()
+        self.assertEqual(self.app.backend.get_task_meta(c_stat.task_id)['status'], "REVOKED")
+        self.assertTrue(c_stat.kill)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import, division
+
+import threading
+
+from django.core.cache import cache
+
+from taskbar import metrics
+from taskbar.metrics import NULL_METRICS
+from taskbar.tests.utils import TaskbarTestCase
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class MetricsTest(TaskbarTestCase):
+
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        patcher = mock.patch.object(metrics, 'TASKBAR_METRICS', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def lines(self, metric):
+        return [line for line in metrics.render_prometheus().splitlines() if line.startswith(metric + "{")]
+
+    def test_totals_per_task_key(self):
+        for task_key in ("job", "", "job"):
+            c_stat = self.start_task(task_key=task_key)
+            c_stat.percent = 50
+            c_stat.err = "x"
+            c_stat.__exit__(None, None, None)
+
+        self.assertEqual(self.lines("taskbar_tasks_total"), [
+            'taskbar_tasks_total{task="taskbar.tests",key=""} 1',
+            'taskbar_tasks_total{task="taskbar.tests",key="job"} 2',
+        ])
+        self.assertTrue(all(not line.endswith(" 0") for line in self.lines("taskbar_cache_ops_total")))
+
+    def test_task_key_is_looked_up_once(self):
+        c_stat = self.start_task()
+        c_stat.metrics.label
+        with self.assertNumQueries(0):
+            self.assertEqual(c_stat.metrics.label, ("taskbar.tests", ""))
+
+    def test_disabled(self):
+        with mock.patch.object(metrics, 'TASKBAR_METRICS', False):
+            self.assertIs(self.start_task().metrics, NULL_METRICS)
+
+    def test_labels_registered_at_once(self):
+        labels = [("task %s" % (number % 5), "") for number in range(40)]
+        slots = {}
+
+        def register(label):
+            slots.setdefault(label, set()).add(metrics.register_label(label))
+
+        threads = [threading.Thread(target=register, args=(label,)) for label in labels]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(slots), 5)
+        self.assertTrue(all(len(label_slots) == 1 for label_slots in slots.values()))
+
+    def test_slot_of_a_label_that_lost_the_race(self):
+        label = ("task", "")
+        add = cache.add
+
+        def claimed_in_between(key, value, timeout=None, version=None):
+            if key == metrics.label_key(label):
+                add(key, 99, timeout)
+                return False
+            return add(key, value, timeout)
+
+        with mock.patch.object(cache, 'add', claimed_in_between):
+            self.assertEqual(metrics.register_label(label), 99)
+        self.assertIsNone(cache.get(metrics.slot_key(1)))
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import, division
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from taskbar import msglog
+from taskbar.msglog import MessageLog, SharedMessageLog, TRUNCATED_MARKER
+
+
+class MessageLogTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def make_log(self, messages, **kwargs):
+        log = MessageLog("task", **kwargs)
+        log.reset()
+        for message in messages:
+            log.append(message)
+        return log
+
+    def test_read_from_offset(self):
+        messages = ["aaaa", "bbbbbb", "cc", "ddddddddd", "e"]
+        log = self.make_log(messages, segment_size=10)
+        text = "".join(messages)
+        self.assertEqual(log.length, len(text))
+        self.assertGreater(len(log.starts), 1)
+        for offset in range(len(text)):
+            self.assertEqual(msglog.read_from("task", offset), text[offset:])
+
+    def test_only_the_segments_after_the_offset_are_fetched(self):
+        log = self.make_log(["%08d" % number for number in range(10)], segment_size=8)
+        self.assertEqual(len(msglog.chunk_keys("task", log.index, 0)), 10)
+        self.assertEqual(msglog.chunk_keys("task", log.index, 75), [msglog.segment_key("task", 9)])
+
+    def test_sealed_segments_are_compressed(self):
+        self.make_log(["aaaa", "bbbbbbbbbb"], segment_size=8)
+        self.assertIsInstance(cache.get(msglog.segment_key("task", 0)), tuple)
+        self.assertEqual(cache.get(msglog.segment_key("task", 1)), "bbbbbbbbbb")
+
+    def test_chunk_stops_at_end(self):
+        self.make_log(["aaaa", "bbbb", "cccc"], segment_size=6)
+        self.assertEqual(msglog.read_from("task", 2, end=8), "aabbbb")
+        self.assertEqual(msglog.read_from("task", 8, end=8), "")
+
+    def test_old_segments_are_dropped(self):
+        messages = ["m%04d" % number for number in range(20)]
+        log = self.make_log(messages, segment_size=10, max_size=20)
+        text = "".join(messages)
+
+        self.assertEqual(log.first, len(log.starts) - 2)
+        self.assertIsNone(cache.get(msglog.segment_key("task", 0)))
+        chunk = msglog.read_from("task", 0)
+        self.assertTrue(chunk.startswith(TRUNCATED_MARKER))
+        self.assertTrue(text.endswith(chunk[len(TRUNCATED_MARKER):]))
+        # The offsets past the dropped segments stay valid
+        self.assertEqual(msglog.read_from("task", len(text) - 5), "m0019")
+
+    def test_close_leaves_the_index(self):
+        log = self.make_log(["aaaa", "bbbb"], segment_size=6)
+        log.close()
+        self.assertEqual(msglog.read_from("task", 0), "")
+        self.assertEqual(msglog.parse_index(cache.get(msglog.index_key("task"))), log.index)
+
+
+class SharedMessageLogTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_writers_append_in_order(self):
+        parent = SharedMessageLog("task", segment_size=4)
+        parent.reset()
+        child = SharedMessageLog("task", segment_size=4)
+        for log, message in ((parent, "aa"), (child, "bbb"), (parent, "c"), (child, "dddd")):
+            log.append(message)
+
+        self.assertEqual(msglog.read_from("task", 0), "aabbbcdddd")
+        self.assertEqual(cache.get(msglog.length_key("task")), 10)
+        self.assertIsNone(cache.get(msglog.lock_key("task")))
+
+    def test_message_is_dropped_without_the_lock(self):
+        log = SharedMessageLog("task", segment_size=4)
+        log.reset()
+        log.append("aa")
+        log.lock_timeout = 0
+        cache.set(msglog.lock_key("task"), "other", 60)
+        log.append("bbb")
+
+        self.assertEqual(log.dropped, 1)
+        self.assertEqual(msglog.read_from("task", 0), "aa")
+        self.assertEqual(cache.get(msglog.length_key("task")), 2)
+        self.assertEqual(cache.get(msglog.lock_key("task")), "other")
+
+    def test_lock_of_another_writer_is_kept(self):
+        log = SharedMessageLog("task")
+        token = log.acquire()
+        # The lock expired and another writer took it
+        cache.set(msglog.lock_key("task"), "other", 60)
+        log.release(token)
+        self.assertEqual(cache.get(msglog.lock_key("task")), "other")
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import, division
+
+from concurrent.futures import ThreadPoolExecutor
+
+from taskbar.backends import get_backend
+from taskbar.pool import PoolProgress
+from taskbar.tests.utils import TaskbarTestCase
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class PoolProgressTest(TaskbarTestCase):
+
+    def work(self, item, progress):
+        progress.report("item %s" % item)
+        progress.advance()
+        return item
+
+    def test_threads(self):
+        c_stat = self.start_task()
+        with PoolProgress(c_stat, total=20, interval=.01) as progress:
+            with ThreadPoolExecutor(4) as executor:
+                self.assertEqual(sum(executor.map(lambda item: self.work(item, progress), range(20))), 190)
+
+        self.assertEqual(c_stat.percent, 100)
+        chunk = get_backend().read_task_stats(self.user, [c_stat.task_id], [0])[c_stat.task_id]['msg_chunk']
+        self.assertEqual(chunk.count("<p>item "), 20)
+
+    def test_one_append_and_one_write_per_flush(self):
+        c_stat = self.start_task()
+        progress = PoolProgress(c_stat, total=20)
+        for item in range(5):
+            self.work(item, progress)
+
+        with mock.patch.object(c_stat.msg_log, 'append', wraps=c_stat.msg_log.append) as append, \
+                mock.patch.object(c_stat, 'flush', wraps=c_stat.flush) as flush:
+            progress.flush()
+        self.assertEqual((append.call_count, flush.call_count), (1, 1))
+        self.assertEqual(c_stat.percent, 25)
+
+        # Only messages
+        progress.report("more")
+        with mock.patch.object(c_stat, 'flush', wraps=c_stat.flush) as flush:
+            progress.flush()
+        self.assertEqual(flush.call_count, 1)
+
+    def test_kill_stops_the_workers(self):
+        c_stat = self.start_task(kill_check_interval=0)
+        progress = PoolProgress(c_stat, total=20)
+        get_backend().set_kill(c_stat.task_id)
+        progress.flush()
+        self.assertTrue(progress.stopped)
+        with self.assertRaises(SystemExit):
+            progress.join()
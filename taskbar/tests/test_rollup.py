@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import, division
+
+from django.core.cache import cache
+
+from taskbar import locks, rollup
+from taskbar.backends import get_backend
+from taskbar.models import CeleryTasks
+from taskbar.tests.utils import TaskbarTestCase
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class RollupTest(TaskbarTestCase):
+
+    def start_job(self, children, task_key=""):
+        if task_key:
+            locks.acquire(task_key)
+        parent = self.start_task(task_key=task_key)
+        parent.add_children(children)
+        return parent, [self.start_task(parent_id=parent.task_id) for number in range(children)]
+
+    def read(self, task_id, msg_index=0):
+        return get_backend().read_task_stats(self.user, [task_id], [msg_index])[task_id]
+
+    def status(self, task_id):
+        return CeleryTasks.objects.get(task_id=task_id).status
+
+    def test_children_roll_up_into_the_parent(self):
+        parent, children = self.start_job(2)
+        children[0].percent = 50
+        children[1].percent = 30
+        children[1].err = "child error"
+
+        task_stat = self.read(parent.task_id)
+        self.assertEqual(task_stat['progress_percent'], 40)
+        self.assertIn("child error", task_stat['msg_chunk'])
+
+        children[0].__exit__(None, None, None)
+        children[1].__exit__(ValueError, ValueError(), None)
+        task_stat = self.read(parent.task_id)
+        self.assertEqual((task_stat['progress_percent'], task_stat['children_done'], task_stat['children_failed']),
+                         (100, 2, 1))
+
+    def test_parent_holds_the_job_until_its_children_end(self):
+        parent, children = self.start_job(2, task_key="job")
+        parent.__exit__(None, None, None)
+        self.assertEqual(self.status(parent.task_id), "active")
+        self.assertEqual(self.read(parent.task_id)['status'], "active")
+        self.assertFalse(locks.acquire("job"))
+
+        children[0].__exit__(None, None, None)
+        self.assertEqual(self.status(parent.task_id), "active")
+        self.assertFalse(locks.acquire("job"))
+
+        children[1].__exit__(ValueError, ValueError(), None)
+        self.assertEqual(self.status(parent.task_id), "finished")
+        self.assertTrue(locks.acquire("job"))
+
+    def test_children_end_before_the_parent(self):
+        parent, children = self.start_job(1, task_key="job")
+        children[0].__exit__(None, None, None)
+        self.assertEqual(self.status(parent.task_id), "active")
+
+        parent.__exit__(None, None, None)
+        self.assertEqual(self.status(parent.task_id), "finished")
+        self.assertTrue(locks.acquire("job"))
+
+    def test_version_changes_when_the_percent_goes_down(self):
+        parent, children = self.start_job(1)
+        children[0].percent = 50
+        version = get_backend().read_version(self.user, parent.task_id)
+        children[0].percent = 20
+        new_version = get_backend().read_version(self.user, parent.task_id)
+        self.assertGreater(new_version[0], version[0])
+        self.assertEqual(self.read(parent.task_id)['version'], new_version[0])
+
+    def test_incr_after_a_failed_add(self):
+        incr = cache.incr
+        calls = []
+
+        def key_added_in_between(key, delta=1, version=None):
+            if not calls:
+                calls.append(key)
+                cache.add(key, 5)
+                raise ValueError
+            return incr(key, delta)
+
+        with mock.patch.object(cache, 'incr', key_added_in_between):
+            self.assertEqual(rollup.incr("counter", 3, 60), 8)
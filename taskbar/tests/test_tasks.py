@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import, division
+
+from time import time
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from taskbar import locks
+from taskbar.analytics import ROLLUP_LOCK_KEY
+from taskbar.backends import get_backend
+from taskbar.models import CeleryTasks, TaskStatsBucket
+from taskbar.tasks import celery_progressbar_stat, purge_task_history, terminate_tasks
+from taskbar.tests.models import Row
+from taskbar.tests.utils import FakeTask, TaskbarTestCase
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class ProgressTest(TaskbarTestCase):
+
+    def stat(self, c_stat):
+        return get_backend().read_stats([c_stat.task_id])[c_stat.task_id]
+
+    def test_start_without_progressbarit(self):
+        task = FakeTask()
+        celery_progressbar_stat(task, self.user.id)
+        history = CeleryTasks.objects.get(task_id=task.request.id)
+        self.assertEqual((history.status, history.user_id), ("active", self.user.id))
+        self.assertIsNotNone(history.start_date)
+
+    def test_coalescing(self):
+        c_stat = self.start_task(min_interval=1000, min_percent_delta=10)
+        c_stat.percent = 5
+        c_stat.msg = "working"
+        self.assertEqual(self.stat(c_stat)['progress_percent'], 0)
+        c_stat.percent = 12
+        self.assertEqual(self.stat(c_stat)['msg'], "working")
+
+        c_stat.percent = 15
+        c_stat.__exit__(None, None, None)
+        task_stat = self.stat(c_stat)
+        self.assertEqual((task_stat['progress_percent'], task_stat['status']), (15, "finished"))
+
+    def test_final_state_on_error(self):
+        c_stat = self.start_task(min_interval=1000)
+        c_stat.percent = 5
+        c_stat.__exit__(ValueError, ValueError(), None)
+        task_stat = self.stat(c_stat)
+        self.assertEqual((task_stat['progress_percent'], task_stat['status']), (5, "error"))
+        self.assertEqual(CeleryTasks.objects.get(task_id=c_stat.task_id).status, "error")
+
+    def test_kill_check_interval(self):
+        c_stat = self.start_task(kill_check_interval=1000)
+        c_stat.percent = 1
+        get_backend().set_kill(c_stat.task_id)
+        with mock.patch.object(get_backend(), 'read_kill') as read_kill:
+            c_stat.percent = 2
+        self.assertFalse(read_kill.called)
+
+        c_stat.last_kill_check = 0
+        with self.assertRaises(SystemExit):
+            c_stat.percent = 3
+
+    def test_parent_kill_reaches_the_children(self):
+        parent = self.start_task()
+        parent.add_children(1)
+        child = self.start_task(parent_id=parent.task_id, kill_check_interval=0)
+        get_backend().set_kill(parent.task_id)
+        self.assertTrue(child.kill)
+
+    def test_rate_and_eta(self):
+        c_stat = self.start_task()
+        c_stat.rate_samples.clear()
+        c_stat.rate_samples.append((time() - 10, 0))
+        c_stat.total = 1000
+        c_stat.percent = 10
+        self.assertAlmostEqual(c_stat.result['percent_per_sec'], 1, places=2)
+        self.assertAlmostEqual(c_stat.result['items_per_sec'], 10, places=0)
+        self.assertAlmostEqual(c_stat.result['eta'], 90, delta=1)
+
+    def test_no_rate_before_the_first_change(self):
+        c_stat = self.start_task()
+        c_stat.rate_samples.clear()
+        c_stat.rate_samples.append((time() - 10, 10))
+        c_stat.percent = 10
+        self.assertIsNone(c_stat.result['percent_per_sec'])
+        self.assertIsNone(c_stat.result['eta'])
+
+    def test_slow_task_keeps_its_rate(self):
+        c_stat = self.start_task()
+        c_stat.rate_samples.clear()
+        c_stat.rate_samples.extend([(time() - 120, 0), (time() - 60, 1)])
+        c_stat.percent = 1
+        self.assertAlmostEqual(c_stat.result['percent_per_sec'], 1 / 60, places=3)
+        self.assertAlmostEqual(c_stat.result['eta'], 99 * 60 - 60, delta=1)
+
+    def test_stalled_task_has_no_eta(self):
+        c_stat = self.start_task()
+        c_stat.rate_samples.clear()
+        # No change for 30 seconds after changes 5 seconds apart
+        c_stat.rate_samples.extend([(time() - 40, 0), (time() - 35, 5), (time() - 30, 10)])
+        c_stat.percent = 10
+        self.assertEqual(c_stat.result['percent_per_sec'], 0)
+        self.assertIsNone(c_stat.result['eta'])
+
+    def test_changes_within_the_sample_interval_move_the_last_sample(self):
+        c_stat = self.start_task()
+        for percent in (1, 2, 3):
+            c_stat.percent = percent
+        self.assertEqual([percent for sample_time, percent in c_stat.rate_samples], [0, 3])
+
+    def test_track(self):
+        c_stat = self.start_task()
+        with mock.patch.object(c_stat, 'flush', wraps=c_stat.flush) as flush:
+            self.assertEqual(sum(c_stat.track(range(1000))), sum(range(1000)))
+        self.assertEqual(c_stat.percent, 100)
+        self.assertEqual(flush.call_count, 100)
+
+    def test_track_checks_the_kill_flag(self):
+        c_stat = self.start_task(kill_check_interval=0)
+        get_backend().set_kill(c_stat.task_id)
+        with self.assertRaises(SystemExit):
+            for item in c_stat.track(iter(range(10)), interval=0):
+                pass
+
+    def test_stages(self):
+        c_stat = self.start_task()
+        with c_stat.stage(20):
+            list(c_stat.track(range(10)))
+            self.assertEqual(c_stat.percent, 20)
+        with c_stat.stage(80):
+            items = c_stat.track(range(10))
+            # An item is counted once the next one is asked for
+            for item in range(6):
+                next(items)
+            self.assertEqual(c_stat.percent, 60)
+        self.assertEqual(c_stat.percent, 100)
+
+    def test_add_errs(self):
+        c_stat = self.start_task()
+        with mock.patch.object(c_stat.msg_log, 'append', wraps=c_stat.msg_log.append) as append:
+            c_stat.add_errs(["one", "two"])
+        self.assertEqual(append.call_count, 1)
+        self.assertEqual(c_stat.err, "two")
+        chunk = get_backend().read_task_stats(self.user, [c_stat.task_id], [0])[c_stat.task_id]['msg_chunk']
+        self.assertEqual((chunk.count("one"), chunk.count("two")), (1, 1))
+
+    def test_lock_is_released_on_exit(self):
+        self.assertTrue(locks.acquire("job"))
+        c_stat = self.start_task(task_key="job")
+        self.assertFalse(locks.acquire("job"))
+        c_stat.__exit__(None, None, None)
+        self.assertTrue(locks.acquire("job"))
+
+
+class BufferedSavesTest(TaskbarTestCase):
+
+    def setUp(self):
+        super(BufferedSavesTest, self).setUp()
+        self.rows = [Row.objects.create(name="row %s" % number) for number in range(5)]
+
+    def report(self, c_stat, row, msg="Error: bad name"):
+        c_stat.report(msg, e=ValueError(row.pk), obj=row, field="name")
+
+    def test_saved_in_bulk_on_exit(self):
+        c_stat = self.start_task(buffer_saves=True)
+        for row in self.rows:
+            self.report(c_stat, row)
+        c_stat.clean_err(self.rows[0], "all")
+        self.assertFalse(Row.objects.filter(is_fine=False).exists())
+
+        with mock.patch.object(Row.objects, 'bulk_update', wraps=Row.objects.bulk_update) as bulk_update:
+            c_stat.__exit__(None, None, None)
+        self.assertEqual(bulk_update.call_count, 1)
+        self.assertEqual(list(Row.objects.order_by('pk').values_list('is_fine', 'err_fields')),
+                         [(True, "")] + [(False, "name  ")] * 4)
+
+    def test_same_values_as_unbuffered(self):
+        buffered = self.start_task(buffer_saves=True)
+        unbuffered = self.start_task(buffer_saves=False)
+        other_rows = [Row.objects.create(name="other %s" % number) for number in range(5)]
+        for c_stat, rows in ((buffered, self.rows), (unbuffered, other_rows)):
+            for row in rows:
+                self.report(c_stat, row)
+            c_stat.clean_err(rows[1], "all")
+            c_stat.__exit__(None, None, None)
+
+        def values(rows):
+            return list(Row.objects.filter(pk__in=[row.pk for row in rows]).order_by('pk').values_list(
+                'err_fields', 'is_fine', 'err_msg'))
+        self.assertEqual(values(self.rows), values(other_rows))
+
+    def test_failed_bulk_update_saves_one_by_one(self):
+        c_stat = self.start_task(buffer_saves=True)
+        for row in self.rows:
+            self.report(c_stat, row)
+        # An object that bulk_update rejects
+        c_stat.pending_saves[Row][10 ** 6] = {'err_fields': "name ", 'is_fine': "not a bool", 'err_msg': ""}
+        c_stat.pending_count += 1
+
+        c_stat.flush_saves()
+        self.assertEqual(Row.objects.filter(is_fine=False).count(), 5)
+        self.assertEqual((c_stat.pending_saves, c_stat.pending_count), ({}, 0))
+
+    def test_unsaved_object_is_not_buffered(self):
+        c_stat = self.start_task(buffer_saves=True)
+        self.report(c_stat, Row(name="new"))
+        self.assertEqual(c_stat.pending_count, 0)
+        self.assertIn("Unable to set", c_stat.msg)
+
+
+class PurgeTest(TaskbarTestCase):
+
+    def make_task(self, task_id, status, hours_ago, key=""):
+        history = CeleryTasks.objects.create(task_id=task_id, user=self.user, status=status, key=key)
+        CeleryTasks.objects.filter(pk=history.pk).update(
+            creation_date=timezone.now() - timezone.timedelta(hours=hours_ago))
+
+    def test_purge(self):
+        self.make_task("stale", "active", 30)
+        self.make_task("running", "active", 1)
+        self.make_task("old", "finished", 700)
+        self.make_task("recent", "finished", 1)
+
+        self.assertEqual(purge_task_history(batch_size=1), {'marked': 1, 'deleted': 1})
+        self.assertEqual(sorted(CeleryTasks.objects.values_list('task_id', 'status')),
+                         [("recent", "finished"), ("running", "active"), ("stale", "must have failed")])
+        # The ended ones are rolled up before the delete
+        self.assertEqual(sum(TaskStatsBucket.objects.values_list('total', flat=True)), 3)
+
+    def test_key_locks_of_stale_tasks_are_released(self):
+        self.make_task("stale", "active", 30, key="job")
+        self.make_task("other", "active", 30, key="other-job")
+        locks.assign("job", "stale")
+        locks.assign("other-job", "newer")
+
+        purge_task_history()
+        self.assertTrue(locks.acquire("job"))
+        self.assertFalse(locks.acquire("other-job"))
+
+    def test_tasks_that_are_not_rolled_up_are_kept(self):
+        self.make_task("old", "finished", 700)
+        cache.add(ROLLUP_LOCK_KEY, 1)
+        self.assertEqual(purge_task_history()['deleted'], 0)
+        cache.delete(ROLLUP_LOCK_KEY)
+        self.assertEqual(purge_task_history()['deleted'], 1)
+
+    def test_invalid_batch_size(self):
+        with self.assertRaises(ValueError):
+            purge_task_history(batch_size=0)
+
+
+class TerminateTest(TaskbarTestCase):
+
+    def test_terminate(self):
+        running = self.start_task()
+        waiting = FakeTask()
+        CeleryTasks.objects.create(task_id=waiting.request.id, user=self.user, key="job")
+        locks.acquire("job")
+        locks.assign("job", waiting.request.id)
+        running.__exit__(None, None, None)
+        active = self.start_task()
+
+        with mock.patch('celery.current_app.control.revoke') as revoke:
+            self.assertEqual(terminate_tasks(CeleryTasks.objects.all()), 2)
+        revoke.assert_called_once_with([waiting.request.id])
+        self.assertEqual(CeleryTasks.objects.get(task_id=waiting.request.id).status, "killed")
+        self.assertTrue(get_backend().read_kill([active.task_id]))
+        self.assertTrue(locks.acquire("job"))
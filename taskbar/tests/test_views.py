@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import, division
+
+import json
+
+from django.contrib.auth.models import User
+from django.core.exceptions import PermissionDenied
+from django.db import IntegrityError
+from django.http import HttpResponse
+
+from taskbar import locks, views
+from taskbar.backends import get_backend
+from taskbar.models import CeleryTasks, make_cursor, parse_cursor
+from taskbar.tasks import celery_progressbar_stat
+from taskbar.tests.utils import FakeTask, TaskbarTestCase
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+def content(response):
+    return json.loads(response.content.decode('utf-8'))
+
+
+class TaskApiTest(TaskbarTestCase):
+
+    def test_task_api(self):
+        c_stat = self.start_task()
+        c_stat.percent = 30
+        c_stat.err = "hello"
+        task_stat = content(self.get(views.task_api, id=c_stat.task_id, msg_index_client=0))
+        self.assertEqual(task_stat['progress_percent'], 30)
+        self.assertIn("hello", task_stat['msg_chunk'])
+
+    def test_task_of_another_user(self):
+        c_stat = self.start_task()
+        other = User.objects.create_user('other')
+        self.assertEqual(self.get(views.task_api, user=other, id=c_stat.task_id, msg_index_client=0).status_code,
+                         401)
+
+    def test_terminate(self):
+        c_stat = self.start_task()
+        self.get(views.task_api, id=c_stat.task_id, msg_index_client=0, terminate="1")
+        self.assertTrue(get_backend().read_kill([c_stat.task_id]))
+
+    def test_waiting_task(self):
+        task = FakeTask()
+        views.register_task(self.user, task.request.id, "")
+        task_stat = content(self.get(views.task_api, id=task.request.id, msg_index_client=0))
+        self.assertEqual(task_stat['status'], "waiting")
+        self.assertGreaterEqual(task_stat['poll_after'], views.TASKBAR_POLL_WAITING)
+
+    def test_poll_after(self):
+        with mock.patch.object(views, 'load_factor', return_value=1):
+            self.assertEqual(views.poll_after({'status': "waiting"}), views.TASKBAR_POLL_WAITING)
+            self.assertEqual(views.poll_after({'status': "active", 'percent_per_sec': None}),
+                             views.TASKBAR_POLL_DEFAULT)
+            # A stalled task is not polled as fast as it can be
+            self.assertEqual(views.poll_after({'status': "active", 'percent_per_sec': 0}),
+                             views.TASKBAR_POLL_DEFAULT)
+            self.assertEqual(views.poll_after({'status': "active", 'percent_per_sec': .25}), 4)
+            self.assertEqual(views.poll_after({'status': "active", 'percent_per_sec': 100}), views.TASKBAR_POLL_MIN)
+            self.assertIsNone(views.poll_after({'status': "finished"}))
+
+    def test_not_modified(self):
+        c_stat = self.start_task()
+        c_stat.err = "hello"
+        response = self.get(views.task_api, id=c_stat.task_id, msg_index_client=0)
+        msg_index = content(response)['msg_index']
+        meta = {'HTTP_IF_NONE_MATCH': response['ETag']}
+
+        self.assertEqual(self.get(views.task_api, meta=meta, id=c_stat.task_id, msg_index_client=msg_index)
+                         .status_code, 304)
+        # The client does not have all of the log yet
+        self.assertEqual(self.get(views.task_api, meta=meta, id=c_stat.task_id, msg_index_client=0).status_code,
+                         200)
+        c_stat.percent = 50
+        self.assertEqual(self.get(views.task_api, meta=meta, id=c_stat.task_id, msg_index_client=msg_index)
+                         .status_code, 200)
+
+    def test_batch(self):
+        mine = [self.start_task() for number in range(3)]
+        theirs = self.start_task(user=User.objects.create_user('other'))
+        mine[1].err = "hello"
+        request = self.factory.get('/', {'id': [c_stat.task_id for c_stat in mine] + [theirs.task_id],
+                                         'msg_index_client': [0, 0, 0, 0]})
+        request.user = self.user
+        task_stats = content(views.task_batch_api(request))
+
+        self.assertIsNone(task_stats[theirs.task_id])
+        self.assertEqual(set(task_stats), set([c_stat.task_id for c_stat in mine] + [theirs.task_id]))
+        self.assertIn("hello", task_stats[mine[1].task_id]['msg_chunk'])
+        self.assertIn('poll_after', task_stats[mine[0].task_id])
+
+    def test_batch_of_waiting_tasks(self):
+        waiting = [FakeTask() for number in range(3)]
+        for task in waiting:
+            views.register_task(self.user, task.request.id, "")
+        theirs = FakeTask()
+        views.register_task(User.objects.create_user('other'), theirs.request.id, "")
+        task_ids = [task.request.id for task in waiting] + [theirs.request.id]
+        request = self.factory.get('/', {'id': task_ids})
+        request.user = self.user
+
+        with self.assertNumQueries(1):
+            task_stats = content(views.task_batch_api(request))
+        self.assertEqual([task_stats[task.request.id]['status'] for task in waiting], ["waiting"] * 3)
+        self.assertGreaterEqual(task_stats[waiting[0].request.id]['poll_after'], views.TASKBAR_POLL_WAITING)
+        self.assertIsNone(task_stats[theirs.request.id])
+
+
+class ProgressbaritTest(TaskbarTestCase):
+
+    def test_one_task_per_key(self):
+        task = FakeTask()
+
+        @views.progressbarit(task_key="job", only_staff=False)
+        def dispatch(request):
+            return task.request.id
+
+        request = self.factory.get('/')
+        request.user = self.user
+        self.assertEqual(content(dispatch(request)), task.request.id)
+        self.assertIn("already running", content(dispatch(request)))
+        self.assertEqual(CeleryTasks.objects.get(task_id=task.request.id).status, "waiting")
+
+        locks.release_for_task(task.request.id)
+        task = FakeTask()
+        self.assertEqual(content(dispatch(request)), task.request.id)
+
+    def test_failed_dispatch_releases_the_lock(self):
+        @views.progressbarit(task_key="job", only_staff=False)
+        def dispatch(request):
+            raise ValueError
+
+        request = self.factory.get('/')
+        request.user = self.user
+        self.assertIn("failed", content(dispatch(request)))
+        self.assertTrue(locks.acquire("job"))
+
+    def test_task_that_started_first(self):
+        task = FakeTask()
+        # Started with the id of another user than the one that sent it
+        celery_progressbar_stat(task, User.objects.create_user('worker').id)
+        self.assertTrue(locks.acquire("job"))
+        views.register_task(self.user, task.request.id, "job")
+        self.assertEqual(CeleryTasks.objects.get(task_id=task.request.id).key, "job")
+        locks.release_for_task(task.request.id)
+        self.assertTrue(locks.acquire("job"))
+
+    def test_task_id_of_another_task(self):
+        task = FakeTask()
+        views.register_task(self.user, task.request.id, "other")
+        self.assertTrue(locks.acquire("job"))
+        with mock.patch('celery.current_app.control.revoke') as revoke, self.assertRaises(IntegrityError):
+            views.register_task(self.user, task.request.id, "job")
+        revoke.assert_called_once_with(task.request.id, terminate=True)
+        self.assertTrue(locks.acquire("job"))
+
+
+class TaskStreamTest(TaskbarTestCase):
+
+    def setUp(self):
+        super(TaskStreamTest, self).setUp()
+        patcher = mock.patch.object(views, 'TASKBAR_STREAM_TIMEOUT', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def events(self, task_id, meta=None, **params):
+        response = self.get(views.task_stream, meta=meta, id=task_id, **params)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        text = b"".join(response.streaming_content).decode('utf-8')
+        return [event for event in text.split("\n\n") if event]
+
+    def test_resume_from_last_event_id(self):
+        c_stat = self.start_task()
+        c_stat.err = "one"
+        event = self.events(c_stat.task_id)[0]
+        event_id, data = event.split("\n")
+        task_stat = json.loads(data[len("data: "):])
+        self.assertEqual(event_id, "id: %s" % task_stat['msg_index'])
+        self.assertIn("one", task_stat['msg_chunk'])
+
+        c_stat.err = "two"
+        event = self.events(c_stat.task_id, meta={'HTTP_LAST_EVENT_ID': task_stat['msg_index']},
+                            msg_index_client=0)[0]
+        chunk = json.loads(event.split("\n")[1][len("data: "):])['msg_chunk']
+        self.assertEqual((chunk.count("one"), chunk.count("two")), (0, 1))
+
+    def test_only_the_version_is_polled(self):
+        c_stat = self.start_task()
+        c_stat.err = "one"
+        read_version = get_backend().read_version
+        polls = []
+
+        def changed_on_the_third_poll(user, task_id):
+            polls.append(task_id)
+            if len(polls) == 3:
+                c_stat.err = "two"
+            return read_version(user, task_id)
+
+        with mock.patch.object(views, 'TASKBAR_STREAM_TIMEOUT', .1), \
+                mock.patch.object(views, 'TASKBAR_STREAM_INTERVAL', .01), \
+                mock.patch.object(get_backend(), 'read_version', changed_on_the_third_poll), \
+                mock.patch.object(views, 'get_task_stats', wraps=views.get_task_stats) as get_task_stats:
+            events = self.events(c_stat.task_id)
+
+        self.assertGreater(len(polls), 3)
+        # The first read and the one after the change
+        self.assertEqual(get_task_stats.call_count, 2)
+        self.assertEqual(len(events), 2)
+        self.assertIn("two", events[1])
+
+    def test_version_of_a_parent(self):
+        parent = self.start_task()
+        parent.add_children(1)
+        self.start_task(parent_id=parent.task_id).percent = 50
+        task_stat = get_backend().read_task_stats(self.user, [parent.task_id], [0])[parent.task_id]
+        self.assertEqual(views.stat_version(task_stat), get_backend().read_version(self.user, parent.task_id))
+
+    def test_closes_at_the_end(self):
+        c_stat = self.start_task()
+        c_stat.__exit__(None, None, None)
+        events = self.events(c_stat.task_id)
+        self.assertEqual(events[-1], "event: close\ndata: null")
+
+    def test_task_of_another_user(self):
+        c_stat = self.start_task()
+        other = User.objects.create_user('other')
+        self.assertEqual(self.get(views.task_stream, user=other, id=c_stat.task_id).status_code, 401)
+
+
+class TaskListApiTest(TaskbarTestCase):
+
+    def setUp(self):
+        super(TaskListApiTest, self).setUp()
+        self.running = self.start_task(task_key="job")
+        self.running.percent = 40
+        for number in range(4):
+            self.start_task().__exit__(None, None, None)
+
+    def test_pages(self):
+        task_ids, cursor = [], None
+        while True:
+            params = {'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+                self.assertNotIn("+", cursor)
+            page = content(self.get(views.task_list_api, **params))
+            task_ids.extend(task['task_id'] for task in page['tasks'])
+            cursor = page['next_cursor']
+            if not cursor:
+                break
+
+        self.assertEqual(task_ids, list(CeleryTasks.objects.order_by('-creation_date', '-pk').values_list(
+            'task_id', flat=True)))
+        self.assertEqual(page['counts'], {"active": 1, "finished": 4})
+
+    def test_live_stat_and_filters(self):
+        page = content(self.get(views.task_list_api, status="active", key="job"))
+        self.assertEqual([task['task_id'] for task in page['tasks']], [self.running.task_id])
+        self.assertEqual(page['tasks'][0]['stat']['progress_percent'], 40)
+
+    def test_cursor_round_trip(self):
+        task = CeleryTasks.objects.order_by('pk').first()
+        self.assertEqual(parse_cursor(make_cursor(task)), (task.creation_date, task.pk))
+
+    def test_invalid_cursor(self):
+        for cursor in ("bogus", "1_x", "2020-01-01T00:00:00+00:00_1", "9" * 30 + "_1"):
+            self.assertEqual(self.get(views.task_list_api, cursor=cursor).status_code, 400)
+
+    def test_counts_are_invalidated(self):
+        self.assertEqual(content(self.get(views.task_list_api))['counts'], {"active": 1, "finished": 4})
+        self.running.__exit__(None, None, None)
+        self.assertEqual(content(self.get(views.task_list_api))['counts'], {"finished": 5})
+
+
+class TaskTerminateApiTest(TaskbarTestCase):
+
+    def test_only_post(self):
+        self.assertEqual(self.get(views.task_terminate_api, key="job").status_code, 405)
+
+    def test_invalid_user(self):
+        staff = User.objects.create_user('staff', is_staff=True)
+        for user_id in ("x", "1.5", " "):
+            request = self.factory.post('/', {'user': user_id})
+            request.user = staff
+            self.assertEqual(views.task_terminate_api(request).status_code, 400)
+
+    def test_terminate_by_key(self):
+        tasks = [self.start_task(task_key="job"), self.start_task(task_key="other")]
+        self.assertEqual(content(self.post(views.task_terminate_api, key="job")), 1)
+        self.assertTrue(get_backend().read_kill([tasks[0].task_id]))
+        self.assertFalse(get_backend().read_kill([tasks[1].task_id]))
+
+    def test_tasks_of_other_users(self):
+        other = User.objects.create_user('other')
+        theirs = self.start_task(user=other)
+        request = self.factory.post('/', {'user': other.id})
+        request.user = self.user
+        with self.assertRaises(PermissionDenied):
+            views.task_terminate_api(request)
+        self.assertEqual(content(self.post(views.task_terminate_api, id=theirs.task_id)), 0)
+
+        staff = User.objects.create_user('staff', is_staff=True)
+        self.assertEqual(content(self.post(views.task_terminate_api, user=staff, id=theirs.task_id)), 1)
+
+
+class StaffViewsTest(TaskbarTestCase):
+
+    def test_only_staff(self):
+        for view in (views.task_metrics, views.task_stats_api):
+            with self.assertRaises(PermissionDenied):
+                self.get(view)
+
+    def test_task_stats_api(self):
+        staff = User.objects.create_user('staff', is_staff=True)
+        self.start_task(task_key="job").__exit__(None, None, None)
+        with mock.patch('taskbar.analytics.task_stats', return_value=[]) as task_stats:
+            self.assertEqual(content(self.get(views.task_stats_api, user=staff, key="job")), {'stats': []})
+        self.assertEqual(task_stats.call_args[1]['keys'], ["job"])
+
+        for since in ("2020-13-01T00:00:00", "yesterday"):
+            self.assertEqual(self.get(views.task_stats_api, user=staff, since=since).status_code, 400)
+        self.assertEqual(self.get(views.task_stats_api, user=staff, until="soon").status_code, 400)
+
+    def test_task_metrics(self):
+        staff = User.objects.create_user('staff', is_staff=True)
+        response = self.get(views.task_metrics, user=staff)
+        self.assertIsInstance(response, HttpResponse)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
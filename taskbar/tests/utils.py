@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import, division
+
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import RequestFactory, TestCase
+
+from taskbar import backends
+
+
+class AppendLocMemCache(LocMemCache):
+
+    """ The locmem cache with the append of memcached, which the message log uses """
+
+    def append(self, key, value, version=None):
+        current = self.get(key, version=version)
+        if current is None:
+            return False
+        self.set(key, current + value, version=version)
+        return True
+
+
+class FakeRequest(object):
+
+    def __init__(self):
+        self.id = str(uuid.uuid4())
+
+
+class FakeTask(object):
+
+    """ Stands in for celery's current_task """
+
+    name = "taskbar.tests"
+
+    def __init__(self):
+        self.request = FakeRequest()
+
+
+class TaskbarTestCase(TestCase):
+
+    """ Starts every test with an empty cache and the default backend """
+
+    def setUp(self):
+        cache.clear()
+        backends.backend = None
+        self.addCleanup(setattr, backends, 'backend', None)
+        self.user = User.objects.create_user('user', password='password')
+        self.factory = RequestFactory()
+
+    def start_task(self, user=None, task_key="", **kwargs):
+        """
+        returns the stat of a task that is registered the way progressbarit does it
+        """
+        from taskbar.tasks import celery_progressbar_stat
+        from taskbar.views import register_task
+
+        user = user or self.user
+        task = FakeTask()
+        register_task(user, task.request.id, task_key)
+        return celery_progressbar_stat(task, user.id, **kwargs)
+
+    def get(self, view, user=None, meta=None, **params):
+        request = self.factory.get('/', params, **(meta or {}))
+        request.user = user or self.user
+        return view(request)
+
+    def post(self, view, user=None, **params):
+        request = self.factory.post('/', params)
+        request.user = user or self.user
+        return view(request)
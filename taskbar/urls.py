@@ -1,14 +1,25 @@
 # -*- coding: utf-8 -*-
 from django.conf import settings
-from django.conf.urls import patterns, url
 
-urlpatterns = patterns(
-    '',
-    url(r'^task_api$', 'taskbar.views.task_api', name="task_api"),
-)
+from taskbar import views
+
+try:
+    from django.urls import re_path as url
+except ImportError:
+    # Django < 2.0
+    from django.conf.urls import url
+
+urlpatterns = [
+    url(r'^task_api$', views.task_api, name="task_api"),
+    url(r'^task_batch_api$', views.task_batch_api, name="task_batch_api"),
+    url(r'^task_list_api$', views.task_list_api, name="task_list_api"),
+    url(r'^task_terminate_api$', views.task_terminate_api, name="task_terminate_api"),
+    url(r'^task_stream$', views.task_stream, name="task_stream"),
+    url(r'^task_metrics$', views.task_metrics, name="task_metrics"),
+    url(r'^task_stats_api$', views.task_stats_api, name="task_stats_api"),
+]
 
 if settings.DEBUG:
-    urlpatterns += patterns('',
-                            url(r'^celery_test$',
-                                'taskbar.views.celery_test', name="celery_test"),
-                            )
+    urlpatterns += [
+        url(r'^celery_test$', views.celery_test, name="celery_test"),
+    ]
@@ -7,7 +7,13 @@ def datetime_difference(start_time, end_time):
     returns the time difference of two datetime objects in HH:MM:SS format
     """
 
-    l = end_time - start_time
+    return timedelta_to_hms(end_time - start_time)
+
+
+def timedelta_to_hms(l):
+    """
+    returns the timedelta in HH:MM:SS format
+    """
 
     if l.days < 0:
         return "N/A"
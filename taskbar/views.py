@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
 import json
+import multiprocessing
+import os
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponse
-from django.db import IntegrityError
+from django.http import (HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, HttpResponseNotModified,
+                         StreamingHttpResponse)
+from django.db import IntegrityError, transaction
+from django.utils.dateparse import parse_datetime
 from functools import wraps    # deals with decorats shpinx documentation
+from time import sleep, time
 
-from taskbar import tasks
-from taskbar.models import CeleryTasks
+from taskbar import analytics, locks, metrics, tasks
+from taskbar.backends import get_backend, history_stat
+from taskbar.models import CeleryTasks, TERMINAL_STATUSES, invalidate_status_counts
 from taskbar.utils import decorator_with_args
 
 import logging
@@ -14,6 +21,21 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+TASKBAR_BATCH_MAX_TASKS = getattr(settings, 'TASKBAR_BATCH_MAX_TASKS', 200)
+# How often task_stream looks for changes in the cache and how long it keeps a connection open (seconds)
+TASKBAR_STREAM_INTERVAL = getattr(settings, 'TASKBAR_STREAM_INTERVAL', .5)
+TASKBAR_STREAM_TIMEOUT = getattr(settings, 'TASKBAR_STREAM_TIMEOUT', 300)
+# The default and the maximum number of tasks in a page of task_list_api
+TASKBAR_LIST_PAGE_SIZE = getattr(settings, 'TASKBAR_LIST_PAGE_SIZE', 20)
+TASKBAR_LIST_MAX_PAGE_SIZE = getattr(settings, 'TASKBAR_LIST_MAX_PAGE_SIZE', 100)
+# The bounds (seconds) of the poll_after that task_api recommends, what it recommends for the tasks that are still
+# in the queue and for the ones that have no rate yet
+TASKBAR_POLL_MIN = getattr(settings, 'TASKBAR_POLL_MIN', .5)
+TASKBAR_POLL_MAX = getattr(settings, 'TASKBAR_POLL_MAX', 15)
+TASKBAR_POLL_WAITING = getattr(settings, 'TASKBAR_POLL_WAITING', 5)
+TASKBAR_POLL_DEFAULT = getattr(settings, 'TASKBAR_POLL_DEFAULT', 2)
+
+
 @decorator_with_args
 def progressbarit(fn, task_key="", only_staff=True):
     @wraps(fn)
@@ -21,85 +43,461 @@ def progressbarit(fn, task_key="", only_staff=True):
 
         request = args[0]
 
-        if only_staff:
-            if not request.user.is_staff:
-                raise PermissionDenied
-
-        elif not request.user.is_active:
-            raise PermissionDenied
-
-        if task_key and CeleryTasks.objects.filter(key=task_key, status__in=["waiting", "active"]):
+        check_user(request.user, only_staff)
 
-            json_data = json.dumps("Error: %s Task is already running" % task_key)
-            return HttpResponse(json_data, content_type='application/json')
+        if task_key and not locks.acquire(task_key):
+            return json_response("Error: %s Task is already running" % task_key)
 
         try:
             task_id = fn(*args, **kwargs)
         except:
-            json_data = json.dumps("Error: %s Task failed to run" % task_key)
-            return HttpResponse(json_data, content_type='application/json')
+            if task_key:
+                locks.release(task_key)
+            return json_response("Error: %s Task failed to run" % task_key)
 
-        try:
-            CeleryTasks.objects.create(task_id=task_id, user=request.user, key=task_key)
-        except IntegrityError:
-            # We don't want to have 2 tasks with the same ID
-            logger.critical("There ware 2 tasks with the same ID. Trying to terminate the task.", exc_info=True)
-            from celery.task.control import revoke
-            revoke(task_id, terminate=True)
-            raise
-
-        json_data = json.dumps(task_id)
+        register_task(request.user, task_id, task_key)
 
-        return HttpResponse(json_data, content_type='application/json')
+        return json_response(task_id)
 
     return wrapped
 
 
-def task_api(request):
-    """ A view to report the progress to the user """
+def check_user(user, only_staff):
+    if only_staff:
+        if not user.is_staff:
+            raise PermissionDenied
 
-    if not request.user.is_active:
+    elif not user.is_active:
         raise PermissionDenied
 
+
+def register_task(user, task_id, task_key):
+    """
+    Creates the history object of a task that was just sent to celery
+    """
+    try:
+        with transaction.atomic():
+            CeleryTasks.objects.create(task_id=task_id, user=user, key=task_key)
+    except IntegrityError:
+        # The task has already started and created the object itself. It only knows the user id it was given,
+        # which is not always the user that sent it, so only the key tells it apart from another task.
+        if CeleryTasks.objects.filter(task_id=task_id, key="").update(key=task_key):
+            if task_key:
+                locks.assign(task_key, task_id)
+            return
+
+        # We don't want to have 2 tasks with the same ID
+        logger.critical("There ware 2 tasks with the same ID. Trying to terminate the task.", exc_info=True)
+        from celery import current_app
+        current_app.control.revoke(task_id, terminate=True)
+        if task_key:
+            locks.release(task_key)
+        raise
+
+    invalidate_status_counts(user.id)
+    if task_key:
+        locks.assign(task_key, task_id)
+
+
+def json_response(data):
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+def get_params(request):
     if request.method == "GET":
-        task_id = request.GET.get('id', False)
-        terminate = request.GET.get('terminate', False)
-        msg_index_client = request.GET.get('msg_index_client', False)
+        return request.GET
     elif request.method == "POST":
-        task_id = request.POST.get('id', False)
-        terminate = request.POST.get('terminate', False)
-        msg_index_client = request.POST.get('msg_index_client', False)
-    else:
-        task_id = False
-        terminate = False
-        msg_index_client = False
+        return request.POST
+    return None
+
+
+def get_task_api_params(request):
+    """
+    returns the task_id, terminate and msg_index_client parameters of task_api
+    """
+    params = get_params(request)
+    if params is None:
+        return False, False, False
+    return params.get('id', False), params.get('terminate', False), params.get('msg_index_client', False)
+
+
+def task_api(request):
+    """ A view to report the progress to the user.
+
+        The stat carries poll_after, the number of seconds the client should wait before its next poll. It is
+        null once the task is done. A task that is still in the queue gets a stat with the "waiting" status.
+
+        The response has the version of the stat as its ETag. A poll with that ETag in If-None-Match gets a 304
+        if the stat has not changed and the client has all of the message log. That is checked with a small
+        version key, without reading the stat or the log.
+    """
+
+    if not request.user.is_active:
+        raise PermissionDenied
+
+    task_id, terminate, msg_index_client = get_task_api_params(request)
 
     if task_id:
-        task_key = "celery-stat-%s" % task_id
-        task_stat = cache.get(task_key)
-        try:
-            if task_stat['user_id'] != request.user.id:
-                return HttpResponse('Unauthorized', status=401)
-        except TypeError:
+        if request.META.get('HTTP_IF_NONE_MATCH') and terminate != "1":
+            version = get_backend().read_version(request.user, task_id)
+            if is_not_modified(request, version, msg_index_client):
+                return HttpResponseNotModified()
+
+        task_stat = get_task_stats(request.user, [task_id], [msg_index_client])[task_id]
+        if task_stat is None:
+            task_stat = get_history_stat(request.user, task_id)
+        if task_stat is None:
             return HttpResponse('Unauthorized', status=401)
-
-        else:
-            # logger.info("msg_index_client: %s   task_stat['msg_index']: %s" % (msg_index_client, task_stat['msg_index']))
-            try:
-                msg_index_client = int(msg_index_client)
-            except:
-                task_stat['msg_chunk'] = "Error in pointer index server call"
-            else:
-                if msg_index_client is not False and msg_index_client < task_stat['msg_index']:
-                    whole_msg = cache.get("celery-%s-msg-all" % task_id)
-                    task_stat['msg_chunk'] = whole_msg[msg_index_client:]
+        task_stat['poll_after'] = poll_after(task_stat)
     else:
         task_stat = None
 
     if task_stat and terminate == "1":
-        cache.set("celery-kill-%s" % task_id, True, 60 * 5)
+        get_backend().set_kill(task_id, 60 * 5)
+
+    return add_etag(json_response(task_stat), task_stat)
+
+
+def get_history_stat(user, task_id):
+    """
+    returns the stat of a task of the user that has no stat from its CeleryTasks object, or None
+    """
+    return get_history_stats(user, [task_id]).get(task_id)
+
+
+def get_history_stats(user, task_ids):
+    """
+    returns the stats of the tasks of the user that have no stat from their CeleryTasks objects, with one query.
+    The tasks that do not belong to the user are left out.
+    """
+    statuses = CeleryTasks.objects.filter(task_id__in=task_ids, user=user).values_list('task_id', 'status')
+    return dict((task_id, history_stat(user.id, status)) for task_id, status in statuses)
+
+
+def add_poll_after(task_stats):
+    for task_stat in task_stats.values():
+        if task_stat is not None:
+            task_stat['poll_after'] = poll_after(task_stat)
+    return task_stats
+
+
+def poll_after(task_stat):
+    """
+    returns the number of seconds the client should wait before polling the task again, or None if the task is done.
+
+    A waiting task gets TASKBAR_POLL_WAITING. An active one gets about the time its percent takes to move by one,
+    so the slow tasks are polled less. Both are stretched by the load of the server.
+    """
+    status = task_stat.get('status')
+    if status in TERMINAL_STATUSES:
+        return None
+    if status == "waiting":
+        delay = TASKBAR_POLL_WAITING
+    else:
+        rate = task_stat.get('percent_per_sec')
+        delay = 1 / rate if rate else TASKBAR_POLL_DEFAULT
+    return round(min(max(delay * load_factor(), TASKBAR_POLL_MIN), TASKBAR_POLL_MAX), 2)
+
+
+# The time the load was last read and the factor from it
+server_load = [0, 1]
+
+
+def load_factor():
+    """
+    returns the load average per CPU of the server, at least 1. It is read at most once per 5 seconds.
+    """
+    now = time()
+    if now - server_load[0] >= 5:
+        try:
+            load = os.getloadavg()[0] / multiprocessing.cpu_count()
+        except (AttributeError, OSError, NotImplementedError):
+            load = 1
+        server_load[:] = [now, max(load, 1)]
+    return server_load[1]
+
+
+def make_etag(version):
+    return '"%s"' % version
+
+
+def is_not_modified(request, version, msg_index_client):
+    """
+    True if the client has the stat of the version (and msg_index) that read_version returned and all of the log
+    """
+    if version is None:
+        return False
+    version, msg_index = version
+    try:
+        msg_index_client = int(msg_index_client)
+    except (TypeError, ValueError):
+        return False
+    return request.META.get('HTTP_IF_NONE_MATCH') == make_etag(version) and msg_index_client >= msg_index
+
+
+def add_etag(response, task_stat):
+    if task_stat:
+        response['ETag'] = make_etag(task_stat['version'])
+    return response
+
+
+def task_batch_api(request):
+    """ A view to report the progress of many tasks of the user at once.
+
+        The task ids are passed as repeated id parameters and the msg_index_client of each task as repeated
+        msg_index_client parameters in the same order. The response maps each task id to what task_api would
+        have returned for it, poll_after included, or null if the task does not belong to the user. The tasks
+        that have no stat are looked up in the history with one query.
+    """
+
+    if not request.user.is_active:
+        raise PermissionDenied
+
+    task_ids, msg_indexes = get_task_batch_api_params(request)
+
+    task_stats = get_task_stats(request.user, task_ids, msg_indexes)
+    missing = [task_id for task_id, task_stat in task_stats.items() if task_stat is None]
+    if missing:
+        task_stats.update(get_history_stats(request.user, missing))
+    return json_response(add_poll_after(task_stats))
+
 
-    return HttpResponse(json.dumps(task_stat), content_type='application/json')
+def get_task_batch_api_params(request):
+    params = get_params(request)
+    if params is None:
+        return [], []
+    return params.getlist('id')[:TASKBAR_BATCH_MAX_TASKS], params.getlist('msg_index_client')
+
+
+def get_task_stats(user, task_ids, msg_indexes):
+    """
+    Returns a dictionary of task id to the stat of the task including the msg_chunk after the client's msg index.
+    The stat is None if the task does not belong to the user. See taskbar.backends for how they are read.
+    """
+    return get_backend().read_task_stats(user, task_ids, msg_indexes)
+
+
+def task_terminate_api(request):
+    """ A view to terminate many tasks at once. Only takes POST.
+
+        The tasks are selected with repeated id parameters, a key and/or a user (id). The users can only terminate
+        their own tasks, staff can terminate anyone's. Returns the number of the tasks that were terminated.
+    """
+
+    if not request.user.is_active:
+        raise PermissionDenied
+
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    task_ids = request.POST.getlist('id')[:TASKBAR_BATCH_MAX_TASKS]
+    task_key = request.POST.get('key')
+    user_id = request.POST.get('user')
+
+    if not (task_ids or task_key or user_id):
+        return json_response(0)
+
+    if user_id:
+        try:
+            user_id = int(user_id)
+        except ValueError:
+            return HttpResponseBadRequest('Invalid user')
+
+    queryset = CeleryTasks.objects.all()
+    if not request.user.is_staff:
+        if user_id and user_id != request.user.id:
+            raise PermissionDenied
+        queryset = queryset.filter(user=request.user)
+    if user_id:
+        queryset = queryset.filter(user_id=user_id)
+    if task_ids:
+        queryset = queryset.filter(task_id__in=task_ids)
+    if task_key:
+        queryset = queryset.filter(key=task_key)
+
+    return json_response(tasks.terminate_tasks(queryset))
+
+
+def task_list_api(request):
+    """ A view to list the tasks of the user, newest first.
+
+        Takes optional repeated status parameters, a key, limit and the cursor of the page, which is the
+        next_cursor of the previous page. Each task carries its live stat if it has one, read for the whole page
+        at once. The response also has the counts of all the tasks of the user per status.
+    """
+
+    if not request.user.is_active:
+        raise PermissionDenied
+
+    params = get_params(request)
+    if params is None:
+        return json_response(None)
+
+    try:
+        limit = max(min(int(params.get('limit', TASKBAR_LIST_PAGE_SIZE)), TASKBAR_LIST_MAX_PAGE_SIZE), 1)
+    except ValueError:
+        limit = TASKBAR_LIST_PAGE_SIZE
+
+    try:
+        page, next_cursor = CeleryTasks.objects.page_of_user(
+            request.user, statuses=params.getlist('status'), key=params.get('key'), cursor=params.get('cursor'),
+            limit=limit)
+    except ValueError:
+        return HttpResponseBadRequest('Invalid cursor')
+    live_stats = get_backend().read_stats([task.task_id for task in page]) if page else {}
+
+    return json_response({
+        'tasks': [task_list_item(task, live_stats.get(task.task_id)) for task in page],
+        'next_cursor': next_cursor,
+        'counts': CeleryTasks.objects.status_counts(request.user),
+    })
+
+
+def task_list_item(task, task_stat):
+    def isoformat(date):
+        return date.isoformat() if date else None
+
+    return {'task_id': task.task_id, 'status': task.status, 'key': task.key,
+            'creation_date': isoformat(task.creation_date), 'start_date': isoformat(task.start_date),
+            'end_date': isoformat(task.end_date), 'stat': task_stat}
+
+
+def task_stream(request):
+    """ Streams the progress of a task to the user as Server-Sent Events.
+
+        Takes the same id and msg_index_client parameters as task_api. An event is only sent when the version of
+        the task stat changes and it carries the same JSON as task_api with the new msg_chunk. The stream closes
+        once the task reaches a terminal status or after TASKBAR_STREAM_TIMEOUT seconds. Browsers reconnect by
+        themselves, so a closed stream of a running task just continues on a new connection: the id of the events
+        is the msg_index, which the browser sends back as Last-Event-ID.
+    """
+
+    if not request.user.is_active:
+        raise PermissionDenied
+
+    task_id, msg_index_client = get_task_stream_params(request)
+
+    if not task_id:
+        return HttpResponse('Unauthorized', status=401)
+
+    task_stat = get_task_stats(request.user, [task_id], [msg_index_client])[task_id]
+    # The task might still be waiting in the queue and have no stat yet.
+    if task_stat is None and not CeleryTasks.objects.filter(task_id=task_id, user=request.user).exists():
+        return HttpResponse('Unauthorized', status=401)
+
+    response = StreamingHttpResponse(
+        stream_task_events(request.user, task_id, msg_index_client, task_stat), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Asking nginx not to buffer the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def get_task_stream_params(request):
+    """
+    returns the task id and the msg_index_client of task_stream. The Last-Event-ID of a reconnecting EventSource
+    takes the place of the msg_index_client of the url, which is where the stream started.
+    """
+    return request.GET.get('id', False), request.META.get(
+        'HTTP_LAST_EVENT_ID', request.GET.get('msg_index_client', 0))
+
+
+def stream_task_events(user, task_id, msg_index_client, task_stat=None):
+    """
+    Yields a Server-Sent Event whenever the version of the task stat changes. Between the events only the version
+    is polled, if the backend can read it: the stat and the log are read once it has changed.
+    """
+
+    seen = None
+    deadline = time() + TASKBAR_STREAM_TIMEOUT
+
+    while True:
+        if task_stat is None:
+            # The stat has expired after we have seen it
+            if seen is not None:
+                return
+
+        elif stat_version(task_stat) != seen:
+            seen = stat_version(task_stat)
+            msg_index_client = task_stat['msg_index']
+            yield format_task_event(task_stat)
+
+            if task_stat.get('status') in TERMINAL_STATUSES:
+                return
+
+        if time() >= deadline:
+            return
+
+        sleep(TASKBAR_STREAM_INTERVAL)
+        backend = get_backend()
+        if backend.reads_versions:
+            version = backend.read_version(user, task_id)
+            if version is None:
+                task_stat = None
+                continue
+            if version == seen:
+                continue
+        task_stat = get_task_stats(user, [task_id], [msg_index_client])[task_id]
+
+
+def stat_version(task_stat):
+    """
+    returns what read_version returns for the stat: its version and msg_index
+    """
+    return task_stat.get('version'), task_stat['msg_index']
+
+
+def format_task_event(task_stat):
+    # The id is the cursor in the message log that a reconnecting EventSource sends back as Last-Event-ID
+    event = "id: %s\ndata: %s\n\n" % (task_stat['msg_index'], json.dumps(task_stat))
+    if task_stat.get('status') in TERMINAL_STATUSES:
+        event += "event: close\ndata: null\n\n"
+    return event
+
+
+def task_metrics(request):
+    """ Serves the taskbar metrics in the Prometheus text format. Only for staff. """
+
+    if not request.user.is_staff:
+        raise PermissionDenied
+
+    return HttpResponse(metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def task_stats_api(request):
+    """ Serves the historical stats of the tasks to staff: the queue wait and run time percentiles and the failure
+        and kill rates.
+
+        Takes optional repeated key parameters, since and until (ISO 8601 datetimes) and repeated group
+        parameters, "key" (the default) and/or "bucket". The stats come from the rollups of rollup_task_stats.
+    """
+
+    if not request.user.is_staff:
+        raise PermissionDenied
+
+    params = get_params(request)
+    if params is None:
+        return json_response(None)
+
+    group = [field for field in ("key", "bucket") if field in params.getlist('group')] or ["key"]
+    dates = {}
+    for name in ("since", "until"):
+        value = params.get(name)
+        try:
+            dates[name] = parse_datetime(value) if value else None
+        except ValueError:
+            # Well formed but not a valid date, like month 13
+            dates[name] = None
+        # parse_datetime returns None for what is not formatted as a datetime
+        if value and dates[name] is None:
+            return HttpResponseBadRequest('Invalid %s' % name)
+
+    stats = analytics.task_stats(keys=params.getlist('key'), group=group, **dates)
+    for item in stats:
+        if 'bucket' in item:
+            item['bucket'] = item['bucket'].isoformat()
+
+    return json_response({'stats': stats})
 
 
 @progressbarit(only_staff=False)